@@ -0,0 +1,121 @@
+"""
+the ambiguous reads of a sample kept once, as an index into the alignment
+files they came from instead of as a human and a mouse copy of the same
+reads. the index holds the name hashes of the ambiguous reads and the
+number, in file order, of each of their alignments in the human and in the
+mouse file, the same numbering the columns use. the alignments are only
+written out in the coordinates of one of the genomes when they are asked
+for.
+
+the index points into the alignment files, so it is only good as long as
+they do not change. the fingerprints of the files are kept in the index and
+extracting from a file that changed is an error.
+
+"""
+import json
+import os
+import numpy as np
+from az import bam, disambiguation
+from az.columns import name_hash
+from az.manifest import fingerprint
+
+INDEX_VERSION = 1
+SUFFIX = ".ambiguous.npz"
+GENOMES = (disambiguation.HUMAN, disambiguation.MOUSE)
+
+
+def write_index(out_file, human_in, mouse_in, name_hashes, human_alignments,
+                mouse_alignments):
+    """
+    write the index of the ambiguous reads with name_hashes, whose
+    alignments are numbers human_alignments of human_in and
+    mouse_alignments of mouse_in
+    """
+    sources = {disambiguation.HUMAN: [os.path.realpath(human_in),
+                                      fingerprint(human_in)],
+               disambiguation.MOUSE: [os.path.realpath(mouse_in),
+                                      fingerprint(mouse_in)]}
+    # np.savez adds .npz to names without it, so the suffix stays last
+    tmp_file = out_file + ".tmp.%d.npz" % os.getpid()
+    with open(tmp_file, "wb") as out_handle:
+        np.savez_compressed(
+            out_handle, version=np.array(INDEX_VERSION),
+            sources=np.array(json.dumps(sources)),
+            name_hashes=np.unique(np.asarray(name_hashes, dtype="<u8")),
+            human=np.asarray(human_alignments, dtype="<u8"),
+            mouse=np.asarray(mouse_alignments, dtype="<u8"))
+    os.rename(tmp_file, out_file)
+    return out_file
+
+
+class AmbiguousIndex(object):
+    """
+    the ambiguous reads of a sample written by write_index
+
+    example:
+    index = AmbiguousIndex("results/disambiguate/s1.ambiguous.npz")
+    len(index) -> number of ambiguous reads
+    "HWI-ST:1:1101" in index -> True if the read is ambiguous
+    index.extract("mouse", "s1.ambiguous.mouse.sorted.bam", config)
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with np.load(index_file) as arrays:
+            if int(arrays["version"]) != INDEX_VERSION:
+                raise ValueError("%s was written by another version of the "
+                                 "ambiguous read index." % (index_file))
+            self.sources = json.loads(str(arrays["sources"]))
+            self.name_hashes = arrays["name_hashes"]
+            self.alignments = dict((x, arrays[x]) for x in GENOMES)
+
+    def __len__(self):
+        return len(self.name_hashes)
+
+    def __contains__(self, read_name):
+        key = np.frombuffer(name_hash(read_name), dtype="<u8")[0]
+        i = np.searchsorted(self.name_hashes, key)
+        return i < len(self.name_hashes) and self.name_hashes[i] == key
+
+    def source(self, genome):
+        """
+        the alignment file of genome the index points into, raising
+        ValueError if it changed since the index was written
+        """
+        in_file, expected = self.sources[genome]
+        if not os.path.exists(in_file) or fingerprint(in_file) != expected:
+            raise ValueError("%s changed since the ambiguous reads in %s "
+                             "were indexed." % (in_file, self.index_file))
+        return str(in_file)
+
+    def alignments_of(self, genome, config=None):
+        """
+        yields the header and then the ambiguous alignments of genome, in
+        the order of its alignment file
+        """
+        header, lines = disambiguation.read_sam(
+            bam.read_alignments(self.source(genome), config or {}))
+        for line in header:
+            yield line
+        wanted = iter(self.alignments[genome].tolist())
+        target = next(wanted, None)
+        for i, line in enumerate(lines):
+            if target is None:
+                break
+            if i == target:
+                yield line
+                target = next(wanted, None)
+        if target is not None:
+            raise ValueError("%s has fewer alignments than the ambiguous "
+                             "reads in %s point to."
+                             % (self.source(genome), self.index_file))
+
+    def extract(self, genome, out_file, config=None, threads=1):
+        """
+        write the ambiguous alignments of genome to out_file, a coordinate
+        sorted, indexed BAM file if it ends in .bam and SAM otherwise
+        """
+        with bam.open_writer(out_file, config or {},
+                             threads=threads) as out_handle:
+            out_handle.writelines(self.alignments_of(genome, config))
+        return out_file
@@ -0,0 +1,385 @@
+"""
+an index of gene features from a GTF or refFlat file for looking up the genes
+that overlap an alignment.
+
+parsing a large GTF file takes a long time, so the index can be compiled once
+into a directory of flat numpy arrays under dir: ref, named by a hash of the
+whole annotation file. every job after that memory maps the arrays instead of
+parsing the annotation again, so loading the index is nearly free and the
+pages are shared by all of the jobs running on a node. the transcripts the
+QC metrics need are compiled the same way.
+
+"""
+import os
+import shutil
+import numpy as np
+from bcbio.utils import safe_makedir
+from az.manifest import content_hash, HASH_DIR
+
+# features are looked up by splitting each chromosome into bins of this size
+BIN_SIZE = 16384
+# bump this when the layout of a compiled index changes
+INDEX_VERSION = 1
+ARRAYS = ("starts", "ends", "strands", "gene_numbers", "chrom_bins",
+          "bin_offsets", "bin_features")
+STRAND_CODES = {"+": 1, "-": -1}
+TRANSCRIPT_ARRAYS = ("chrom_numbers", "strands", "gene_numbers",
+                     "exon_offsets", "exon_starts", "exon_ends")
+
+
+def _gtf_attributes(field):
+    attributes = {}
+    for attribute in field.strip().split(";"):
+        attribute = attribute.strip()
+        if not attribute:
+            continue
+        key, _, value = attribute.partition(" ")
+        attributes[key] = value.strip().strip('"')
+    return attributes
+
+
+def read_gtf(gtf_file, feature_type="exon", id_attribute="gene_id"):
+    """
+    yields (chrom, start, end, strand, gene id) for each feature of
+    feature_type in a GTF file, with zero based half open coordinates
+    """
+    with open(gtf_file) as in_handle:
+        for line in in_handle:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[2] != feature_type:
+                continue
+            attributes = _gtf_attributes(fields[8])
+            if id_attribute not in attributes:
+                raise ValueError("Feature on line %s of %s has no %s "
+                                 "attribute." % (line, gtf_file,
+                                                 id_attribute))
+            yield (fields[0], int(fields[3]) - 1, int(fields[4]), fields[6],
+                   attributes[id_attribute])
+
+
+def read_refflat(refflat_file):
+    """
+    yields (chrom, start, end, strand, gene name) for each exon of each
+    transcript in a refFlat file, which are already zero based half open
+    """
+    with open(refflat_file) as in_handle:
+        for line in in_handle:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 11:
+                continue
+            starts = [int(x) for x in fields[9].split(",") if x]
+            ends = [int(x) for x in fields[10].split(",") if x]
+            for start, end in zip(starts, ends):
+                yield fields[2], start, end, fields[3], fields[0]
+
+
+def is_refflat(in_file):
+    """
+    refFlat files have the exon starts and ends as comma separated lists in
+    their tenth and eleventh columns, GTF files only have nine columns
+    """
+    with open(in_file) as in_handle:
+        for line in in_handle:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            return len(fields) >= 11 and fields[8].isdigit()
+    return False
+
+
+def read_annotation(in_file, feature_type="exon", id_attribute="gene_id"):
+    if is_refflat(in_file):
+        return read_refflat(in_file)
+    return read_gtf(in_file, feature_type, id_attribute)
+
+
+def read_transcripts(in_file, id_attribute="gene_id"):
+    """
+    returns a list of (chrom, strand, gene id, exons) for each transcript in
+    a GTF or refFlat file, exons is a sorted list of (start, end) tuples
+    """
+    if is_refflat(in_file):
+        transcripts = []
+        with open(in_file) as in_handle:
+            for line in in_handle:
+                fields = line.rstrip("\n").split("\t")
+                if line.startswith("#") or len(fields) < 11:
+                    continue
+                exons = zip([int(x) for x in fields[9].split(",") if x],
+                            [int(x) for x in fields[10].split(",") if x])
+                transcripts.append((fields[2], fields[3], fields[0],
+                                    sorted(exons)))
+        return transcripts
+    transcripts = {}
+    with open(in_file) as in_handle:
+        for line in in_handle:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#") or len(fields) < 9 or fields[2] != "exon":
+                continue
+            attributes = _gtf_attributes(fields[8])
+            transcript = attributes.get("transcript_id")
+            gene = attributes.get(id_attribute, transcript)
+            transcripts.setdefault(transcript, (fields[0], fields[6], gene,
+                                                []))[3].append(
+                (int(fields[3]) - 1, int(fields[4])))
+    return [x[:3] + (sorted(x[3]),) for _, x in sorted(transcripts.items())]
+
+
+class GeneIndex(object):
+    """
+    the features of an annotation binned by position on each chromosome,
+    kept in flat arrays so it can be saved and memory mapped
+
+    example:
+    index = GeneIndex.from_gtf("genes.gtf")
+    genes = [index.genes[x] for x in index.overlapping("1", 11868, 12000)]
+    """
+
+    def __init__(self, genes, chroms, arrays):
+        # features are sorted by chromosome and start. the bins of chromosome
+        # i are chrom_bins[i] to chrom_bins[i + 1] and the features in bin b
+        # are bin_features[bin_offsets[b]:bin_offsets[b + 1]]
+        self.genes = genes
+        self.chroms = chroms
+        self.chrom_numbers = dict((x, i) for i, x in enumerate(chroms))
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self._chrom_bins = self.chrom_bins.tolist()
+        # the features of the bins looked up on the current chromosome, the
+        # alignments come sorted by coordinate so older ones are not needed
+        self._chrom = None
+        self._bins = {}
+
+    @classmethod
+    def from_features(cls, genes, features):
+        """
+        build the index from the sorted list of gene ids and a list of
+        (chrom, start, end, strand, gene number) tuples
+        """
+        features = sorted(features)
+        chroms = []
+        chrom_bins = [0]
+        bin_members = []
+        for i, (chrom, start, end, _, _) in enumerate(features):
+            if not chroms or chroms[-1] != chrom:
+                if chroms:
+                    chrom_bins.append(chrom_bins[-1] + chrom_size)
+                chroms.append(chrom)
+                chrom_size = 0
+            first_bin = chrom_bins[-1]
+            last = (end - 1) // BIN_SIZE
+            chrom_size = max(chrom_size, last + 1)
+            for b in range(start // BIN_SIZE, last + 1):
+                bin_members.append((first_bin + b, i))
+        if chroms:
+            chrom_bins.append(chrom_bins[-1] + chrom_size)
+        bin_members.sort()
+        member_bins = np.array([x[0] for x in bin_members], dtype=np.int64)
+        counts = np.bincount(member_bins, minlength=chrom_bins[-1])
+        arrays = {
+            "starts": np.array([x[1] for x in features], dtype=np.int64),
+            "ends": np.array([x[2] for x in features], dtype=np.int64),
+            "strands": np.array([STRAND_CODES.get(x[3], 0) for x in features],
+                                dtype=np.int8),
+            "gene_numbers": np.array([x[4] for x in features],
+                                     dtype=np.int32),
+            "chrom_bins": np.array(chrom_bins, dtype=np.int64),
+            "bin_offsets": np.concatenate([[0], np.cumsum(counts)])
+                             .astype(np.int64),
+            "bin_features": np.array([x[1] for x in bin_members],
+                                     dtype=np.int32)}
+        return cls(genes, chroms, arrays)
+
+    @classmethod
+    def from_gtf(cls, gtf_file, feature_type="exon", id_attribute="gene_id"):
+        features = list(read_annotation(gtf_file, feature_type, id_attribute))
+        genes = sorted(set(x[4] for x in features))
+        numbers = dict((gene, i) for i, gene in enumerate(genes))
+        return cls.from_features(genes,
+                                 [x[:4] + (numbers[x[4]],) for x in features])
+
+    def save(self, out_dir):
+        safe_makedir(out_dir)
+        for name in ARRAYS:
+            np.save(os.path.join(out_dir, name + ".npy"), getattr(self, name))
+        for name in ("genes", "chroms"):
+            with open(os.path.join(out_dir, name + ".txt"), "w") as out_handle:
+                out_handle.writelines(x + "\n" for x in getattr(self, name))
+        return out_dir
+
+    @classmethod
+    def load(cls, in_dir):
+        """
+        memory map an index written by save
+        """
+        names = {}
+        for name in ("genes", "chroms"):
+            with open(os.path.join(in_dir, name + ".txt")) as in_handle:
+                names[name] = [x.rstrip("\n") for x in in_handle]
+        arrays = dict((name, np.load(os.path.join(in_dir, name + ".npy"),
+                                     mmap_mode="r")) for name in ARRAYS)
+        return cls(names["genes"], names["chroms"], arrays)
+
+    def _bin(self, b):
+        if b not in self._bins:
+            members = self.bin_features[self.bin_offsets[b]:
+                                        self.bin_offsets[b + 1]]
+            self._bins[b] = zip(self.starts[members].tolist(),
+                                self.ends[members].tolist(),
+                                self.strands[members].tolist(),
+                                self.gene_numbers[members].tolist())
+        return self._bins[b]
+
+    def overlapping(self, chrom, start, end, strand=None):
+        """
+        returns the numbers of the genes with a feature overlapping the
+        half open interval start-end, only counting features on strand if
+        it is given. features without a strand match either strand
+        """
+        found = set()
+        chrom_number = self.chrom_numbers.get(chrom)
+        if chrom_number is None:
+            return found
+        if chrom != self._chrom:
+            self._chrom = chrom
+            self._bins = {}
+        first_bin = self._chrom_bins[chrom_number]
+        last_bin = self._chrom_bins[chrom_number + 1]
+        strand = STRAND_CODES.get(strand)
+        for b in range(first_bin + start // BIN_SIZE,
+                       min(first_bin + (end - 1) // BIN_SIZE + 1, last_bin)):
+            for f_start, f_end, f_strand, gene in self._bin(b):
+                if f_start < end and f_end > start:
+                    if strand is None or f_strand in (strand, 0):
+                        found.add(gene)
+        return found
+
+
+def index_dir(annotation_file, ref_dir, feature_type="exon",
+              id_attribute="gene_id"):
+    """
+    where the compiled index of annotation_file is kept, named by a hash of
+    all of the file so any change to the annotation gets a new index and
+    the same annotation under different paths shares one
+    """
+    key = "%s-%s-%s-v%d" % (content_hash(annotation_file,
+                                         os.path.join(ref_dir, HASH_DIR)),
+                            feature_type, id_attribute, INDEX_VERSION)
+    return os.path.join(ref_dir, "annotation_index", key)
+
+
+def compile_index(annotation_file, ref_dir, feature_type="exon",
+                  id_attribute="gene_id"):
+    """
+    compile annotation_file into an index under ref_dir if that has not
+    been done yet and return the directory it is in
+    """
+    out_dir = index_dir(annotation_file, ref_dir, feature_type, id_attribute)
+    if os.path.exists(out_dir):
+        return out_dir
+    tmp_dir = out_dir + ".tmp.%d" % os.getpid()
+    index = GeneIndex.from_gtf(annotation_file, feature_type, id_attribute)
+    index.save(tmp_dir)
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # another job compiled the same annotation first
+        shutil.rmtree(tmp_dir)
+    return out_dir
+
+
+def load_index(annotation_file, ref_dir, feature_type="exon",
+               id_attribute="gene_id"):
+    """
+    load the compiled index of annotation_file, compiling it first if needed
+
+    example:
+    index = load_index("genes.gtf", config["dir"]["ref"])
+    """
+    return GeneIndex.load(compile_index(annotation_file, ref_dir,
+                                        feature_type, id_attribute))
+
+
+def transcripts_dir(annotation_file, ref_dir, id_attribute="gene_id"):
+    """
+    where the compiled transcripts of annotation_file are kept, named by a
+    hash of all of the file like the index
+    """
+    key = "%s-%s-v%d" % (content_hash(annotation_file,
+                                      os.path.join(ref_dir, HASH_DIR)),
+                         id_attribute, INDEX_VERSION)
+    return os.path.join(ref_dir, "transcript_index", key)
+
+
+def save_transcripts(transcripts, out_dir):
+    """
+    write the transcripts read_transcripts returns as flat arrays, the exons
+    of transcript i are exon_offsets[i] to exon_offsets[i + 1]
+    """
+    safe_makedir(out_dir)
+    names = {"chroms": sorted(set(x[0] for x in transcripts)),
+             "genes": sorted(set(x[2] for x in transcripts))}
+    numbers = dict((x, dict((y, i) for i, y in enumerate(names[x])))
+                   for x in names)
+    exons = [y for x in transcripts for y in x[3]]
+    arrays = {
+        "chrom_numbers": np.array([numbers["chroms"][x[0]]
+                                   for x in transcripts], dtype=np.int32),
+        "strands": np.array([x[1] for x in transcripts], dtype=np.str_),
+        "gene_numbers": np.array([numbers["genes"][x[2]]
+                                  for x in transcripts], dtype=np.int32),
+        "exon_offsets": np.concatenate(
+            [[0], np.cumsum([len(x[3]) for x in transcripts])])
+        .astype(np.int64),
+        "exon_starts": np.array([x[0] for x in exons], dtype=np.int64),
+        "exon_ends": np.array([x[1] for x in exons], dtype=np.int64)}
+    for name in TRANSCRIPT_ARRAYS:
+        np.save(os.path.join(out_dir, name + ".npy"), arrays[name])
+    for name in ("genes", "chroms"):
+        with open(os.path.join(out_dir, name + ".txt"), "w") as out_handle:
+            out_handle.writelines(x + "\n" for x in names[name])
+    return out_dir
+
+
+def load_transcripts(in_dir):
+    """
+    the transcripts written by save_transcripts, as read_transcripts
+    returns them
+    """
+    names = {}
+    for name in ("genes", "chroms"):
+        with open(os.path.join(in_dir, name + ".txt")) as in_handle:
+            names[name] = [x.rstrip("\n") for x in in_handle]
+    arrays = dict((name, np.load(os.path.join(in_dir, name + ".npy")))
+                  for name in TRANSCRIPT_ARRAYS)
+    exons = zip(arrays["exon_starts"].tolist(), arrays["exon_ends"].tolist())
+    offsets = arrays["exon_offsets"].tolist()
+    return [(names["chroms"][chrom], str(strand), names["genes"][gene],
+             exons[offsets[i]:offsets[i + 1]])
+            for i, (chrom, strand, gene) in enumerate(zip(
+                arrays["chrom_numbers"].tolist(),
+                arrays["strands"].tolist(),
+                arrays["gene_numbers"].tolist()))]
+
+
+def compile_transcripts(annotation_file, ref_dir, id_attribute="gene_id"):
+    """
+    compile the transcripts of annotation_file under ref_dir if that has
+    not been done yet and return the directory they are in
+    """
+    out_dir = transcripts_dir(annotation_file, ref_dir, id_attribute)
+    if os.path.exists(out_dir):
+        return out_dir
+    tmp_dir = out_dir + ".tmp.%d" % os.getpid()
+    save_transcripts(read_transcripts(annotation_file, id_attribute),
+                     tmp_dir)
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # another job compiled the same annotation first
+        shutil.rmtree(tmp_dir)
+    return out_dir
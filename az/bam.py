@@ -0,0 +1,282 @@
+"""
+reading SAM and BAM files as a stream of SAM lines and writers that take a
+stream of SAM lines and write them straight to their final location, either
+as SAM or as a coordinate sorted and indexed BAM file. the BGZF compression
+of BAM files can be spread over a number of threads, see az.bgzf
+
+"""
+import errno
+import os
+import pipes
+import subprocess
+import threading
+from az import bgzf
+
+
+def _samtools(config):
+    return config.get("program", {}).get("samtools", "samtools")
+
+
+def read_alignments(in_file, config, threads=1):
+    """
+    yields the lines of a SAM or BAM file including the header, BAM files
+    are decoded with samtools view. with more than one thread the BAM blocks
+    are decompressed on a pool of threads and samtools only decodes them
+    """
+    if not in_file.endswith(".bam"):
+        with open(in_file) as in_handle:
+            for line in in_handle:
+                yield line
+        return
+    if threads > 1:
+        cmd = [_samtools(config), "view", "-h", "-"]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        feeder = _Decompressor(in_file, proc.stdin, threads)
+        feeder.start()
+    else:
+        cmd = [_samtools(config), "view", "-h", in_file]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        feeder = None
+    finished = False
+    try:
+        for line in proc.stdout:
+            yield line
+        finished = True
+    finally:
+        # stop samtools if the reader gave up before the end of the file
+        if not finished and proc.poll() is None:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+        if feeder:
+            feeder.join()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, " ".join(cmd))
+    if feeder and feeder.error:
+        raise feeder.error
+
+
+class _Decompressor(threading.Thread):
+    """
+    decompresses in_file on threads threads into out_handle, for samtools
+    to read as uncompressed BAM
+    """
+
+    def __init__(self, in_file, out_handle, threads):
+        super(_Decompressor, self).__init__()
+        self.daemon = True
+        self.in_file = in_file
+        self.out_handle = out_handle
+        self.threads = threads
+        self.error = None
+
+    def run(self):
+        try:
+            with open(self.in_file, "rb") as in_handle:
+                for data in bgzf.BgzfReader(in_handle, self.threads):
+                    self.out_handle.write(data)
+        except IOError as e:
+            # samtools went away, read_alignments reports why
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.out_handle.close()
+            except IOError:
+                pass
+
+
+class SamWriter(object):
+    """
+    writes SAM lines to a temporary file that is renamed to out_file when
+    the writer is closed, so a killed job never leaves a partial out_file
+    """
+
+    def __init__(self, out_file, config):
+        self.out_file = out_file
+        self.config = config
+        self.tmp_file = out_file + ".tmp"
+        self.handle = open(self.tmp_file, "w")
+
+    def write(self, line):
+        self.handle.write(line)
+
+    def writelines(self, lines):
+        self.handle.writelines(lines)
+
+    def close(self):
+        self.handle.close()
+        os.rename(self.tmp_file, self.out_file)
+
+    def abort(self):
+        self.handle.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def _pipeline_str(cmds):
+    # how the pipeline would be typed into a shell, for error messages
+    return " | ".join(" ".join(map(pipes.quote, x)) for x in cmds)
+
+
+class PipedBamWriter(SamWriter):
+    """
+    pipes SAM lines through a pipeline of samtools commands that writes
+    BAM. the commands are chained without a shell, so paths with spaces or
+    shell characters are passed on as they are. with more than one thread
+    samtools writes uncompressed BAM and the blocks are compressed on a pool
+    of threads instead
+    """
+
+    def _start(self, cmds, threads):
+        self.threads = threads
+        self.compressor = None
+        self.procs = []
+        out_handle = open(self.tmp_file, "wb") if threads <= 1 else None
+        stdin = subprocess.PIPE
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            stdout = out_handle if last and out_handle else subprocess.PIPE
+            # close_fds keeps the later commands from holding the pipes of
+            # the earlier ones open, which would stop them seeing the end
+            proc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+                                    close_fds=True)
+            if self.procs:
+                # only the next command reads it
+                self.procs[-1].stdout.close()
+            self.procs.append(proc)
+            stdin = proc.stdout
+        if out_handle:
+            out_handle.close()
+        else:
+            self.compressor = _Compressor(self.procs[-1].stdout,
+                                          self.tmp_file, threads)
+            self.compressor.start()
+        self.handle = self.procs[0].stdin
+
+    def _finish(self):
+        self.handle.close()
+        returncodes = [x.wait() for x in self.procs]
+        if self.compressor:
+            self.compressor.join()
+        failed = [x for x in returncodes if x != 0]
+        if failed:
+            raise subprocess.CalledProcessError(failed[0],
+                                                _pipeline_str(self.cmds))
+        if self.compressor and self.compressor.error:
+            raise self.compressor.error
+
+    def close(self):
+        self._finish()
+        os.rename(self.tmp_file, self.out_file)
+        if self.index:
+            subprocess.check_call([self.samtools, "index", self.out_file])
+
+    def abort(self):
+        self.handle.close()
+        [x.wait() for x in self.procs]
+        if self.compressor:
+            self.compressor.join()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+
+class _Compressor(threading.Thread):
+    """
+    compresses the uncompressed BAM samtools writes to in_handle into
+    out_file on threads threads
+    """
+
+    def __init__(self, in_handle, out_file, threads):
+        super(_Compressor, self).__init__()
+        self.daemon = True
+        self.in_handle = in_handle
+        self.out_file = out_file
+        self.threads = threads
+        self.error = None
+
+    def run(self):
+        try:
+            with open(self.out_file, "wb") as out_handle:
+                bgzf.recompress(self.in_handle, out_handle, self.threads)
+        except Exception as e:
+            self.error = e
+            # keep draining so samtools is not left blocked on a full pipe
+            while self.in_handle.read(bgzf.MAX_BLOCK):
+                pass
+
+
+class SortedBamWriter(PipedBamWriter):
+    """
+    pipes SAM lines through samtools (1.0 or later) to make a coordinate
+    sorted BAM file and indexes it when the writer is closed
+
+    """
+
+    def __init__(self, out_file, config, threads=1):
+        self.out_file = out_file
+        self.config = config
+        self.samtools = _samtools(config)
+        self.index = True
+        self.tmp_file = out_file + ".tmp.bam"
+        level = ["-l", "0"] if threads > 1 else []
+        self.cmds = [[self.samtools, "view", "-Su", "-"],
+                     [self.samtools, "sort"] + level +
+                     ["-T", out_file + ".tmp", "-O", "bam", "-"]]
+        self._start(self.cmds, threads)
+
+
+class BamWriter(PipedBamWriter):
+    """
+    pipes SAM lines that are already in order through samtools view to make
+    a BAM file, indexing it when the writer is closed if index is set
+    """
+
+    def __init__(self, out_file, config, index=False, threads=1):
+        self.out_file = out_file
+        self.config = config
+        self.samtools = _samtools(config)
+        self.index = index
+        self.tmp_file = out_file + ".tmp.bam"
+        self.cmds = [[self.samtools, "view", "-S",
+                      "-u" if threads > 1 else "-b", "-"]]
+        self._start(self.cmds, threads)
+
+
+def open_writer(out_file, config, sort=True, index=True, threads=1):
+    """
+    returns a writer for out_file, files ending in .bam are written as
+    coordinate sorted, indexed BAM files and everything else as SAM. with
+    sort=False the lines are written to the BAM file in the order they come,
+    and only indexed if index is set. threads is the number of threads
+    compressing the BAM file
+
+    """
+    if out_file.endswith(".bam"):
+        if sort:
+            return SortedBamWriter(out_file, config, threads)
+        return BamWriter(out_file, config, index, threads)
+    return SamWriter(out_file, config)
+
+
+def stage_threads(config, stage):
+    """
+    the threads option of a stage, how many threads compress and decompress
+    the BAM files it reads and writes
+    """
+    stage_config = config.get("stage", {}).get(stage, {})
+    if not isinstance(stage_config, dict):
+        return 1
+    return max(1, int(stage_config.get("threads", 1)))
@@ -0,0 +1,224 @@
+"""
+reading and writing BGZF, the blocked gzip format BAM files are stored in,
+with the blocks compressed and decompressed on a pool of threads.
+
+every BGZF block is a complete gzip member holding at most 64kb of data, so
+the blocks can be compressed or decompressed independently. a bounded number
+of blocks is handed to the pool at a time and the results are collected in
+the order they were handed out, so the output is the same as from a single
+thread. zlib lets go of the interpreter lock while it works on a block, so
+the threads really do run at the same time.
+
+"""
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import struct
+import zlib
+
+# the most data a block holds, as in htslib, so that even data that does not
+# compress fits in a block
+BLOCK_DATA = 0xff00
+MAX_BLOCK = 0x10000
+# gzip header with the BC extra field holding the size of the block - 1
+BLOCK_HEADER = struct.Struct("<4BI2BH2BHH")
+BLOCK_FOOTER = struct.Struct("<2I")
+GZIP_HEADER = struct.Struct("<4BI2BH")
+# the empty block that marks the end of a BGZF file
+EOF_BLOCK = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+             "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+# blocks in flight for each thread
+BLOCKS_PER_THREAD = 4
+
+
+class BgzfError(Exception):
+    pass
+
+
+def compress_block(data, level=6):
+    """
+    a complete BGZF block holding data, which is at most BLOCK_DATA long
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + BLOCK_HEADER.size + BLOCK_FOOTER.size > MAX_BLOCK:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    size = BLOCK_HEADER.size + len(compressed) + BLOCK_FOOTER.size
+    return (BLOCK_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                              size - 1) +
+            compressed +
+            BLOCK_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def _block_size(extra):
+    """
+    the total size of a block from the extra field of its gzip header
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        si1, si2, length = struct.unpack_from("<2BH", extra, offset)
+        if si1 == 66 and si2 == 67 and length == 2:
+            return struct.unpack_from("<H", extra, offset + 4)[0] + 1
+        offset += 4 + length
+    raise BgzfError("gzip block without a BGZF size field.")
+
+
+def read_blocks(handle):
+    """
+    yields the raw blocks of a BGZF file one at a time
+    """
+    while True:
+        header = handle.read(GZIP_HEADER.size)
+        if not header:
+            return
+        if len(header) < GZIP_HEADER.size:
+            raise BgzfError("BGZF file is truncated.")
+        fields = GZIP_HEADER.unpack(header)
+        if fields[:4] != (31, 139, 8, 4):
+            raise BgzfError("not a BGZF block.")
+        extra = handle.read(fields[-1])
+        size = _block_size(extra)
+        rest = handle.read(size - len(header) - len(extra))
+        if len(rest) < size - len(header) - len(extra):
+            raise BgzfError("BGZF file is truncated.")
+        yield header + extra + rest
+
+
+def decompress_block(block):
+    """
+    the data held in a raw BGZF block
+    """
+    xlen = GZIP_HEADER.unpack_from(block)[-1]
+    start = GZIP_HEADER.size + xlen
+    crc, size = BLOCK_FOOTER.unpack_from(block, len(block) -
+                                         BLOCK_FOOTER.size)
+    decompressor = zlib.decompressobj(-15)
+    data = decompressor.decompress(block[start:-BLOCK_FOOTER.size])
+    data += decompressor.flush()
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise BgzfError("BGZF block is corrupt.")
+    return data
+
+
+def _ordered(fn, items, threads):
+    """
+    yields fn(item) for each of items in order, running up to threads of
+    them at a time and only reading ahead a bounded number of items
+    """
+    if threads <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= threads * BLOCKS_PER_THREAD:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+class BgzfReader(object):
+    """
+    iterates over the decompressed data of a BGZF file a block at a time
+
+    example:
+    with open("sample.bam", "rb") as in_handle:
+        for data in BgzfReader(in_handle, threads=8):
+            out_handle.write(data)
+    """
+
+    def __init__(self, handle, threads=1):
+        self.handle = handle
+        self.threads = threads
+
+    def __iter__(self):
+        return _ordered(decompress_block, read_blocks(self.handle),
+                        self.threads)
+
+    def read(self):
+        return "".join(self)
+
+
+class BgzfWriter(object):
+    """
+    writes data to handle as BGZF blocks compressed on threads threads,
+    closing the writer writes the end of file block
+
+    example:
+    with open("sample.bam", "wb") as out_handle:
+        with BgzfWriter(out_handle, threads=8) as writer:
+            writer.write(data)
+    """
+
+    def __init__(self, handle, threads=1, level=6):
+        self.handle = handle
+        self.threads = threads
+        self.level = level
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def _compress(self, data):
+        if self.pool is None:
+            self.handle.write(compress_block(data, self.level))
+            return
+        self.pending.append(self.pool.apply_async(compress_block,
+                                                  (data, self.level)))
+        if len(self.pending) >= self.threads * BLOCKS_PER_THREAD:
+            self.handle.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < BLOCK_DATA:
+            return
+        data = "".join(self.buffer)
+        end = len(data) - len(data) % BLOCK_DATA
+        for start in range(0, end, BLOCK_DATA):
+            self._compress(data[start:start + BLOCK_DATA])
+        self.buffer = [data[end:]]
+        self.buffered = len(data) - end
+
+    def flush(self):
+        if self.buffered:
+            self._compress("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self.handle.write(self.pending.popleft().get())
+
+    def close(self):
+        self.flush()
+        self.handle.write(EOF_BLOCK)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type:
+            self.close()
+        elif self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+def recompress(in_handle, out_handle, threads=1, level=6):
+    """
+    copies a BGZF stream from in_handle to out_handle, compressing the data
+    again at level on threads threads. used to compress the uncompressed
+    BAM output of samtools
+    """
+    with BgzfWriter(out_handle, threads, level) as writer:
+        for data in BgzfReader(in_handle):
+            if data:
+                writer.write(data)
@@ -0,0 +1,299 @@
+"""
+a compact columnar summary of the alignments in a SAM or BAM file, holding
+only what disambiguation looks at: a 64 bit hash of the read name, the flag
+and the score of each alignment, one entry per alignment in file order.
+
+mapping writes the summary next to each tophat output as a directory of flat
+little endian arrays, named after the file with .columns added. with those,
+every read of a sample is disambiguated at once with numpy, and the SAM
+records are only read again, in the order they are in, to write them to
+their outputs. the inputs do not need to be sorted by read name.
+
+two read names with the same hash would be taken for the same read, with 64
+bits that is unlikely to happen even once in billions of reads.
+
+"""
+import hashlib
+import os
+import shutil
+from itertools import izip
+import numpy as np
+from bcbio.utils import safe_makedir
+from az import bam, disambiguation
+from az.disambiguation import (HUMAN, MOUSE, AMBIGUOUS, UNMAPPED_SCORE,
+                                CATEGORIES, MAX_SCORE_DIFFERENCE)
+from az.manifest import fingerprint
+
+# bump this when the layout of the columns changes
+COLUMNS_VERSION = 1
+ARRAYS = (("name_hashes", "<u8"), ("flags", "<u2"), ("scores", "<i4"))
+SUFFIX = ".columns"
+# alignments summarized or written out at a time
+BATCH_SIZE = 1000000
+# the categories are numbered in the order of CATEGORIES in the arrays
+HUMAN_CODE, MOUSE_CODE, AMBIGUOUS_CODE = range(len(CATEGORIES))
+
+
+def columns_dir(in_file):
+    """
+    where the columns of in_file are kept, next to the file a symbolic
+    link points to so the descriptive links share the columns of the file
+    """
+    return os.path.realpath(in_file) + SUFFIX
+
+
+def _source(in_file):
+    return "%s v%d" % (fingerprint(os.path.realpath(in_file)),
+                       COLUMNS_VERSION)
+
+
+def name_hash(name):
+    return hashlib.md5(name).digest()[:8]
+
+
+def _summarize(lines):
+    """
+    yields the raw bytes of each array for batches of SAM lines
+    """
+    hashes, flags, scores = [], [], []
+    for line in lines:
+        if line.startswith("@"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        hashes.append(name_hash(fields[0]))
+        flags.append(int(fields[1]))
+        scores.append(disambiguation.alignment_score(fields))
+        if len(hashes) == BATCH_SIZE:
+            yield ("".join(hashes), np.array(flags, dtype="<u2").tostring(),
+                   np.array(scores, dtype="<i4").tostring())
+            hashes, flags, scores = [], [], []
+    if hashes:
+        yield ("".join(hashes), np.array(flags, dtype="<u2").tostring(),
+               np.array(scores, dtype="<i4").tostring())
+
+
+def write_columns(in_file, config):
+    """
+    write the columns of the SAM or BAM in_file unless they are already
+    there and up to date, returns the directory they are in
+    """
+    out_dir = columns_dir(in_file)
+    source = _source(in_file)
+    if is_current(in_file):
+        return out_dir
+    tmp_dir = out_dir + ".tmp.%d" % os.getpid()
+    safe_makedir(tmp_dir)
+    handles = [open(os.path.join(tmp_dir, name), "wb") for name, _ in ARRAYS]
+    try:
+        for batch in _summarize(bam.read_alignments(
+                in_file, config, bam.stage_threads(config, "columns"))):
+            [x.write(y) for x, y in zip(handles, batch)]
+    finally:
+        [x.close() for x in handles]
+    with open(os.path.join(tmp_dir, "source.txt"), "w") as out_handle:
+        out_handle.write(source + "\n")
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return out_dir
+
+
+def is_current(in_file):
+    source_file = os.path.join(columns_dir(in_file), "source.txt")
+    if not os.path.exists(source_file):
+        return False
+    with open(source_file) as in_handle:
+        return in_handle.read().strip() == _source(in_file)
+
+
+def load_columns(in_file, config=None):
+    """
+    memory map the columns of in_file, writing them first if they are
+    missing or out of date. returns a dict of name_hashes, flags and scores
+    """
+    in_dir = write_columns(in_file, config or {})
+    columns = {}
+    for name, dtype in ARRAYS:
+        path = os.path.join(in_dir, name)
+        if os.path.getsize(path) == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(path, dtype=dtype, mode="r")
+    return columns
+
+
+def read_scores(columns):
+    """
+    the reads in columns as sorted name hashes, the read of each alignment
+    and the best (lowest) score of the first and second end of each read,
+    like disambiguation.group_scores
+    """
+    flags = np.asarray(columns["flags"])
+    reads, inverse = np.unique(columns["name_hashes"], return_inverse=True)
+    best = np.full((len(reads), 2), UNMAPPED_SCORE, dtype=np.int64)
+    mapped = (flags & 0x4) == 0
+    read_numbers = inverse[mapped]
+    ends = np.where(flags[mapped] & 0x40, 0, 1)
+    scores = np.asarray(columns["scores"])[mapped]
+    # the lowest score of each end of each read comes first
+    order = np.lexsort((scores, ends, read_numbers))
+    read_numbers, ends, scores = (read_numbers[order], ends[order],
+                                  scores[order])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ((read_numbers[1:] != read_numbers[:-1]) |
+                 (ends[1:] != ends[:-1]))
+    best[read_numbers[first], ends[first]] = scores[first]
+    return reads, inverse, best
+
+
+def classify(human_scores, mouse_scores):
+    """
+    disambiguation.classify for arrays of (end 1, end 2) scores of many
+    reads, returns the code of the category of each read
+    """
+    h1, h2 = human_scores[:, 0], human_scores[:, 1]
+    m1, m2 = mouse_scores[:, 0], mouse_scores[:, 1]
+    values = np.column_stack([h1, h2, m1, m2])
+    genomes = np.array([HUMAN_CODE, HUMAN_CODE, MOUSE_CODE, MOUSE_CODE],
+                       dtype=np.int8)
+    # a stable sort ranks the ends the same way sorted does
+    order = np.argsort(values, axis=1, kind="mergesort")
+    ranked = np.take_along_axis(values, order, axis=1)
+    ranked_genomes = genomes[order]
+    codes = np.where(
+        (ranked_genomes[:, 0] == ranked_genomes[:, 1]) |
+        (ranked[:, 0] < ranked[:, 1]),
+        ranked_genomes[:, 0], ranked_genomes[:, 2]).astype(np.int8)
+    ambiguous = (((h1 == m1) & (h2 == m2)) | ((h1 == m2) & (h2 == m1)))
+    codes[ambiguous] = AMBIGUOUS_CODE
+    return codes
+
+
+def _histogram(differences):
+    clipped = np.clip(differences, -MAX_SCORE_DIFFERENCE,
+                      MAX_SCORE_DIFFERENCE) + MAX_SCORE_DIFFERENCE
+    return np.bincount(clipped, minlength=2 * MAX_SCORE_DIFFERENCE + 1)
+
+
+def _count(stats, human_best, mouse_best, human_codes, mouse_codes,
+           human_common, mouse_common, codes, human_lines, mouse_lines):
+    """
+    add what categorize decided to a DisambiguationStats
+    """
+    stats.only[HUMAN] += len(human_codes) - len(human_common)
+    stats.only[MOUSE] += len(mouse_codes) - len(mouse_common)
+    human_pairs = (human_best < UNMAPPED_SCORE).all(axis=1)
+    mouse_pairs = (mouse_best < UNMAPPED_SCORE).all(axis=1)
+    differences = (human_best[human_common].sum(axis=1) -
+                   mouse_best[mouse_common].sum(axis=1))
+    for code, category in enumerate(CATEGORIES):
+        if code == MOUSE_CODE:
+            stats.reads[category] += int((mouse_codes == code).sum())
+            stats.pairs[category] += int((mouse_pairs &
+                                          (mouse_codes == code)).sum())
+        else:
+            stats.reads[category] += int((human_codes == code).sum())
+            stats.pairs[category] += int((human_pairs &
+                                          (human_codes == code)).sum())
+        stats.differences[category] = [
+            x + int(y) for x, y in zip(stats.differences[category],
+                                       _histogram(differences[codes == code]))]
+    human_alignments = np.bincount(human_lines, minlength=len(CATEGORIES))
+    mouse_alignments = np.bincount(mouse_lines, minlength=len(CATEGORIES))
+    stats.alignments["human"] += int(human_alignments[HUMAN_CODE])
+    stats.alignments["human_ambiguous"] += int(
+        human_alignments[AMBIGUOUS_CODE])
+    stats.alignments["mouse"] += int(mouse_alignments[MOUSE_CODE])
+    stats.alignments["mouse_ambiguous"] += int(
+        mouse_alignments[AMBIGUOUS_CODE])
+
+
+def categorize(human, mouse, stats=None):
+    """
+    the category code of every alignment in the human and mouse columns and
+    the number of reads in each category. reads only aligned to one of the
+    genomes belong to that genome. the decisions are counted in stats, a
+    DisambiguationStats, if it is given
+    """
+    human_reads, human_inverse, human_best = read_scores(human)
+    mouse_reads, mouse_inverse, mouse_best = read_scores(mouse)
+    _, human_common, mouse_common = np.intersect1d(
+        human_reads, mouse_reads, assume_unique=True, return_indices=True)
+    codes = classify(human_best[human_common], mouse_best[mouse_common])
+    human_codes = np.full(len(human_reads), HUMAN_CODE, dtype=np.int8)
+    mouse_codes = np.full(len(mouse_reads), MOUSE_CODE, dtype=np.int8)
+    human_codes[human_common] = codes
+    mouse_codes[mouse_common] = codes
+    counts = {HUMAN: int((human_codes == HUMAN_CODE).sum()),
+              MOUSE: int((mouse_codes == MOUSE_CODE).sum()),
+              AMBIGUOUS: int((codes == AMBIGUOUS_CODE).sum())}
+    human_lines = human_codes[human_inverse]
+    mouse_lines = mouse_codes[mouse_inverse]
+    if stats is not None:
+        _count(stats, human_best, mouse_best, human_codes, mouse_codes,
+               human_common, mouse_common, codes, human_lines, mouse_lines)
+    return human_lines, mouse_lines, counts
+
+
+def _codes(codes):
+    for start in xrange(0, len(codes), BATCH_SIZE):
+        for code in codes[start:start + BATCH_SIZE].tolist():
+            yield code
+
+
+def write_categories(in_file, codes, out_handles, config=None):
+    """
+    write each alignment of in_file to the handle of its category code,
+    alignments with a code without a handle are left out
+    """
+    header, lines = disambiguation.read_sam(
+        bam.read_alignments(in_file, config or {}))
+    [x.writelines(header) for x in out_handles if x is not None]
+    n = 0
+    # the codes come first so a line left over is not lost by izip
+    for code, line in izip(_codes(codes), lines):
+        out_handle = out_handles[code]
+        if out_handle is not None:
+            out_handle.write(line)
+        n += 1
+    if n != len(codes) or next(lines, None) is not None:
+        raise ValueError("The columns of %s do not match its alignments."
+                         % (in_file))
+
+
+def disambiguate(human_in, mouse_in, human_out, human_ambiguous_out,
+                 mouse_out, mouse_ambiguous_out, config=None, stats=None,
+                 index_file=None):
+    """
+    disambiguate the SAM or BAM files human_in and mouse_in from their
+    columns, writing each read to the human or mouse output or to both
+    ambiguous outputs like disambiguation.disambiguate. the reads are
+    written in the order of the input files and counted in stats if it is
+    given. with index_file the ambiguous reads are also kept in an
+    ambiguous.AmbiguousIndex, the ambiguous outputs can then be None.
+    returns the number of reads assigned to each category.
+
+    example:
+    with open("h.sam", "w") as h, ...:
+        disambiguate("human.sam", "mouse.sam", h, ha, m, ma, config)
+    """
+    human = load_columns(human_in, config)
+    mouse = load_columns(mouse_in, config)
+    human_codes, mouse_codes, counts = categorize(human, mouse, stats)
+    if index_file:
+        # only imported here, it needs the name_hash of this module
+        from az import ambiguous
+        human_ambiguous = np.flatnonzero(human_codes == AMBIGUOUS_CODE)
+        ambiguous.write_index(
+            index_file, human_in, mouse_in,
+            np.asarray(human["name_hashes"])[human_ambiguous],
+            human_ambiguous, np.flatnonzero(mouse_codes == AMBIGUOUS_CODE))
+    handles = [None] * len(CATEGORIES)
+    handles[HUMAN_CODE], handles[AMBIGUOUS_CODE] = (human_out,
+                                                   human_ambiguous_out)
+    write_categories(human_in, human_codes, handles, config)
+    handles = [None] * len(CATEGORIES)
+    handles[MOUSE_CODE], handles[AMBIGUOUS_CODE] = (mouse_out,
+                                                   mouse_ambiguous_out)
+    write_categories(mouse_in, mouse_codes, handles, config)
+    return counts
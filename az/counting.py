@@ -0,0 +1,155 @@
+"""
+counts the reads overlapping each gene the same way htseq-count does in
+union mode, but reading alignments sorted by coordinate so the BAM files do
+not have to be sorted by name and converted to SAM first. the mates of a
+pair are matched up as they go by, so only pairs whose first mate has been
+seen and whose second mate has not are held in memory.
+
+"""
+import re
+
+SPECIAL_COUNTERS = ["__no_feature", "__ambiguous", "__too_low_aQual",
+                    "__not_aligned", "__alignment_not_unique"]
+STRANDED = ("yes", "no", "reverse")
+
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+# cigar operations that count as aligned and that consume the reference
+MATCH_OPS = "M=X"
+REFERENCE_OPS = "MDN=X"
+
+
+def aligned_blocks(pos, cigar):
+    """
+    yields the zero based half open reference intervals of the aligned parts
+    of a read from its one based position and its cigar string
+    """
+    start = pos - 1
+    for length, op in CIGAR_RE.findall(cigar):
+        length = int(length)
+        if op in MATCH_OPS and length > 0:
+            yield start, start + length
+        if op in REFERENCE_OPS:
+            start += length
+
+
+class Alignment(object):
+
+    __slots__ = ("name", "flag", "chrom", "pos", "mapq", "cigar",
+                 "mate_chrom", "mate_pos", "seq", "qual", "nh")
+
+    def __init__(self, line):
+        fields = line.rstrip("\n").split("\t")
+        self.name = fields[0]
+        self.flag = int(fields[1])
+        self.chrom = fields[2]
+        self.pos = int(fields[3])
+        self.mapq = int(fields[4])
+        self.cigar = fields[5]
+        self.mate_chrom = self.chrom if fields[6] == "=" else fields[6]
+        self.mate_pos = int(fields[7])
+        self.seq = fields[9]
+        self.qual = fields[10]
+        self.nh = 1
+        for field in fields[11:]:
+            if field.startswith("NH:i:"):
+                self.nh = int(field[5:])
+                break
+
+    def strand(self, stranded):
+        if stranded == "no":
+            return None
+        reverse = bool(self.flag & 0x10)
+        # the second read of a pair comes from the opposite strand
+        if self.flag & 0x1 and self.flag & 0x80:
+            reverse = not reverse
+        if stranded == "reverse":
+            reverse = not reverse
+        return "-" if reverse else "+"
+
+
+class GeneCounter(object):
+    """
+    counts reads per gene from a stream of SAM lines sorted by coordinate
+
+    example:
+    counter = GeneCounter(GeneIndex.from_gtf("genes.gtf"), stranded="no")
+    counter.count(open("sample.sam"))
+    counter.write("sample.counts")
+    """
+
+    def __init__(self, index, stranded="yes", minaqual=10, secondary=False,
+                 supplementary=False):
+        if stranded not in STRANDED:
+            raise ValueError("stranded must be one of %s, not %s."
+                             % (STRANDED, stranded))
+        self.index = index
+        self.stranded = stranded
+        self.minaqual = minaqual
+        # like htseq-count, secondary and supplementary alignments are
+        # skipped unless asked for
+        self.skip_flags = (0 if secondary else 0x100) | \
+                          (0 if supplementary else 0x800)
+        self.counts = [0] * len(index.genes)
+        self.special = dict((x, 0) for x in SPECIAL_COUNTERS)
+
+    def _assign(self, alignments):
+        mapped = [x for x in alignments if not x.flag & 0x4]
+        if not mapped:
+            self.special["__not_aligned"] += 1
+            return
+        if any(x.nh > 1 for x in mapped):
+            self.special["__alignment_not_unique"] += 1
+            return
+        if any(x.mapq < self.minaqual for x in mapped):
+            self.special["__too_low_aQual"] += 1
+            return
+        genes = set()
+        for alignment in mapped:
+            strand = alignment.strand(self.stranded)
+            for start, end in aligned_blocks(alignment.pos, alignment.cigar):
+                genes.update(self.index.overlapping(alignment.chrom, start,
+                                                    end, strand))
+        if not genes:
+            self.special["__no_feature"] += 1
+        elif len(genes) > 1:
+            self.special["__ambiguous"] += 1
+        else:
+            self.counts[genes.pop()] += 1
+
+    def count(self, lines):
+        waiting = {}
+        for line in lines:
+            if line.startswith("@"):
+                continue
+            alignment = Alignment(line)
+            flag = alignment.flag
+            if flag & self.skip_flags:
+                continue
+            if not flag & 0x1 or flag & 0x8:
+                # a pair with neither mate mapped is only counted once
+                if not (flag & 0x1 and flag & 0x4 and flag & 0x80):
+                    self._assign([alignment])
+                continue
+            # an unmapped read is counted along with its mapped mate
+            if flag & 0x4:
+                continue
+            key = (alignment.name, alignment.chrom, alignment.pos,
+                   alignment.mate_chrom, alignment.mate_pos)
+            mate_key = (alignment.name, alignment.mate_chrom,
+                        alignment.mate_pos, alignment.chrom, alignment.pos)
+            mate = waiting.pop(mate_key, None)
+            if mate is None:
+                waiting[key] = alignment
+            else:
+                self._assign([mate, alignment])
+        # mates that never turned up are counted on their own
+        for alignment in waiting.values():
+            self._assign([alignment])
+
+    def write(self, out_file):
+        with open(out_file, "w") as out_handle:
+            for gene, count in zip(self.index.genes, self.counts):
+                out_handle.write("%s\t%d\n" % (gene, count))
+            for counter in SPECIAL_COUNTERS:
+                out_handle.write("%s\t%d\n" % (counter, self.special[counter]))
+        return out_file
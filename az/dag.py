@@ -0,0 +1,157 @@
+"""
+runs a graph of dependent jobs, starting each job as soon as the jobs it
+depends on have finished instead of waiting for whole phases to finish
+
+"""
+import subprocess
+import threading
+import Queue
+from collections import OrderedDict
+from bcbio.log import logger
+
+
+class Job(object):
+    """
+    a unit of work in the graph, subclasses implement run and cancel
+    """
+
+    def __init__(self, name, depends=()):
+        self.name = name
+        self.depends = list(depends)
+
+    def run(self):
+        raise NotImplementedError
+
+    def cancel(self):
+        pass
+
+
+class CommandJob(Job):
+    """
+    runs a command in a subprocess, failing if it exits with an error
+    """
+
+    def __init__(self, name, cmd, depends=()):
+        super(CommandJob, self).__init__(name, depends)
+        self.cmd = cmd
+        self.proc = None
+        self._cancelled = threading.Event()
+
+    def run(self):
+        if self._cancelled.is_set():
+            return
+        self.proc = subprocess.Popen(self.cmd)
+        if self._cancelled.is_set():
+            self.proc.terminate()
+        if self.proc.wait() != 0 and not self._cancelled.is_set():
+            raise subprocess.CalledProcessError(self.proc.returncode,
+                                                " ".join(self.cmd))
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+class FunctionJob(Job):
+    """
+    calls fn(*args) in the thread of the job, failing if it raises or exits.
+    python can not stop a thread, so cancelling a call that already started
+    only calls on_cancel, which has to make fn stop on its own, like
+    cancelling the az.parallel.CancellableView it maps on. without it the
+    call runs to the end
+    """
+
+    def __init__(self, name, fn, args=(), depends=(), on_cancel=None):
+        super(FunctionJob, self).__init__(name, depends)
+        self.fn = fn
+        self.args = list(args)
+        self.on_cancel = on_cancel
+        self._cancelled = threading.Event()
+
+    def run(self):
+        if self._cancelled.is_set():
+            return
+        try:
+            self.fn(*self.args)
+        except SystemExit as e:
+            # the pipelines exit on errors, which would end the thread
+            # without the executor hearing about it
+            if e.code:
+                raise RuntimeError("%s exited with %s." % (self.name, e.code))
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+
+class DAGExecutor(object):
+    """
+    runs jobs once all of their dependencies are done, with at most max_jobs
+    running at once. if a job fails no new jobs are started and the jobs
+    still running are cancelled, run returns once they have all stopped.
+    command jobs are terminated, function jobs only stop as soon as their
+    function notices, see FunctionJob.
+
+    example:
+    executor = DAGExecutor(max_jobs=4)
+    executor.add(CommandJob("map", ["python", "mapping.py", "map.yaml"]))
+    executor.add(CommandJob("count", ["python", "quantitation.py",
+                                      "count.yaml"], depends=["map"]))
+    executor.run() -> True if every job finished
+    """
+
+    def __init__(self, max_jobs=4):
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+
+    def add(self, job):
+        missing = [x for x in job.depends if x not in self.jobs]
+        if missing:
+            raise ValueError("Job %s depends on unknown jobs %s."
+                             % (job.name, missing))
+        if job.name in self.jobs:
+            raise ValueError("Job %s was added twice." % job.name)
+        self.jobs[job.name] = job
+        return job
+
+    def _run_job(self, job, finished):
+        try:
+            job.run()
+            finished.put((job, None))
+        except Exception as e:
+            finished.put((job, e))
+
+    def run(self):
+        pending = list(self.jobs.values())
+        running = {}
+        done = set()
+        failed = []
+        finished = Queue.Queue()
+        while pending or running:
+            if not failed:
+                ready = [x for x in pending if done.issuperset(x.depends)]
+                for job in ready[:self.max_jobs - len(running)]:
+                    logger.info("Starting %s." % job.name)
+                    pending.remove(job)
+                    thread = threading.Thread(target=self._run_job,
+                                              args=(job, finished))
+                    thread.daemon = True
+                    running[job.name] = job
+                    thread.start()
+            if not running:
+                break
+            job, error = finished.get()
+            del running[job.name]
+            if error is None and not failed:
+                logger.info("Finished %s." % job.name)
+                done.add(job.name)
+            elif error is None or failed:
+                logger.info("Stopped %s." % job.name)
+            else:
+                logger.error("%s failed: %s. Cancelling %s."
+                             % (job.name, error, running.keys()))
+                failed.append(job.name)
+                [x.cancel() for x in running.values()]
+        return not failed
@@ -0,0 +1,398 @@
+"""
+streaming disambiguation of reads mapped to both the human and mouse genomes
+
+this is a reimplementation of the decision rules in disamb_byMapping2.pl
+that does a merge join over two SAM files sorted by read name instead of
+loading both of them into memory. only the alignments for a single read
+(the read name and all of its mates) are held in memory at a time.
+
+the alignments are scored by their tags as the perl script means to,
+which it does not do: it scores every mapped end 0. the results differ
+from the perl script for many reads.
+
+"""
+from itertools import chain, groupby
+import json
+import os
+import thread
+
+HUMAN = "human"
+MOUSE = "mouse"
+AMBIGUOUS = "ambiguous"
+
+# score given to a read end that did not map, any mapping beats this
+UNMAPPED_SCORE = 1000
+# tags summed to score an alignment, lower is better
+SCORE_TAGS = ("NM", "NH", "XO")
+CATEGORIES = (HUMAN, MOUSE, AMBIGUOUS)
+# the outputs the alignments of each category go to
+OUTPUTS = ("human", "human_ambiguous", "mouse", "mouse_ambiguous")
+# score differences further from zero than this are counted with it
+MAX_SCORE_DIFFERENCE = 10
+
+
+def read_name(line):
+    return line.split("\t", 1)[0]
+
+
+def read_sam(handle):
+    """
+    splits an iterable of SAM lines into a list of header lines and an
+    iterator over the alignment lines
+
+    """
+    header = []
+    lines = iter(handle)
+    for line in lines:
+        if line.startswith("@"):
+            header.append(line)
+        else:
+            return header, chain([line], lines)
+    return header, iter([])
+
+
+def is_name_sorted(header):
+    """
+    returns True if the header of a SAM file claims it is sorted by read name.
+    samtools sort -n and Picard claim it for their own orders, which are not
+    the plain string order read_groups needs, check with in_name_order
+
+    """
+    for line in header:
+        if line.startswith("@HD"):
+            return "SO:queryname" in line
+    return False
+
+
+def in_name_order(lines):
+    """
+    returns True if the alignment lines are in the order read_groups
+    expects, a plain string comparison of the read names. only the read
+    names are looked at, so this is much cheaper than sorting
+
+    """
+    last = ""
+    for line in lines:
+        name = read_name(line)
+        if name < last:
+            return False
+        last = name
+    return True
+
+
+def read_groups(lines):
+    """
+    yields (read name, alignment lines) for each read in a stream of SAM
+    lines sorted by read name. raises ValueError if the stream is not sorted
+    the same way as a plain string comparison, which is the order produced
+    by LC_ALL=C sort.
+
+    """
+    last = None
+    for name, group in groupby(lines, read_name):
+        if last is not None and name <= last:
+            raise ValueError("Alignments are not sorted by read name: %s "
+                             "appears after %s." % (name, last))
+        last = name
+        yield name, list(group)
+
+
+def alignment_score(fields):
+    """
+    score a single alignment from its split SAM fields, the sum of the
+    edit distance, the number of hits and the number of gap opens
+
+    """
+    score = 0
+    for field in fields[11:]:
+        if field[:2] in SCORE_TAGS and field[2:5] == ":i:":
+            score += int(field[5:])
+    return score
+
+
+def group_scores(lines):
+    """
+    returns the best (lowest) score for the first and second read of a pair
+    from all of the alignments of a read
+
+    """
+    scores = [UNMAPPED_SCORE, UNMAPPED_SCORE]
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        flag = int(fields[1])
+        if flag & 0x4:
+            continue
+        end = 0 if flag & 0x40 else 1
+        scores[end] = min(scores[end], alignment_score(fields))
+    return tuple(scores)
+
+
+def aligned_ends(lines):
+    """
+    the number of ends of a read with an alignment, from the flags alone,
+    the same ends group_scores gives a score below UNMAPPED_SCORE
+
+    """
+    ends = set()
+    for line in lines:
+        flag = int(line.split("\t", 2)[1])
+        if not flag & 0x4:
+            ends.add(0 if flag & 0x40 else 1)
+    return len(ends)
+
+
+def classify(human_scores, mouse_scores):
+    """
+    decide if a read belongs to human, mouse or is ambiguous given the
+    scores of each of its ends in each genome
+
+    """
+    h1, h2 = human_scores
+    m1, m2 = mouse_scores
+    if (h1, h2) == (m1, m2) or (h1, h2) == (m2, m1):
+        return AMBIGUOUS
+    ranked = sorted([(h1, HUMAN), (h2, HUMAN), (m1, MOUSE), (m2, MOUSE)],
+                    key=lambda x: x[0])
+    # the two best ends are from the same genome
+    if ranked[0][1] == ranked[1][1]:
+        return ranked[0][1]
+    # the best end is better than the best end from the other genome
+    if ranked[0][0] < ranked[1][0]:
+        return ranked[0][1]
+    # the two best ends are tied, so let the next best end decide
+    return ranked[2][1]
+
+
+def disambiguate(human_in, mouse_in, human_out, human_ambiguous_out,
+                 mouse_out, mouse_ambiguous_out, stats=None):
+    """
+    disambiguate two streams of SAM lines sorted by read name, writing each
+    read to the human or mouse output or to both ambiguous outputs. reads
+    that only appear in one of the genomes are written straight to that
+    genome's output without their tags being parsed, stats, a
+    DisambiguationStats, only reads their flags to count them. returns the
+    number of reads assigned to each category.
+
+    """
+    human_header, human_lines = read_sam(human_in)
+    mouse_header, mouse_lines = read_sam(mouse_in)
+    human_out.writelines(human_header)
+    human_ambiguous_out.writelines(human_header)
+    mouse_out.writelines(mouse_header)
+    mouse_ambiguous_out.writelines(mouse_header)
+
+    counts = {HUMAN: 0, MOUSE: 0, AMBIGUOUS: 0}
+    human_groups = read_groups(human_lines)
+    mouse_groups = read_groups(mouse_lines)
+    human = next(human_groups, None)
+    mouse = next(mouse_groups, None)
+    while human is not None or mouse is not None:
+        if mouse is None or (human is not None and human[0] < mouse[0]):
+            human_out.writelines(human[1])
+            counts[HUMAN] += 1
+            if stats:
+                stats.add_only(HUMAN, human[1])
+            human = next(human_groups, None)
+        elif human is None or mouse[0] < human[0]:
+            mouse_out.writelines(mouse[1])
+            counts[MOUSE] += 1
+            if stats:
+                stats.add_only(MOUSE, mouse[1])
+            mouse = next(mouse_groups, None)
+        else:
+            human_scores = group_scores(human[1])
+            mouse_scores = group_scores(mouse[1])
+            category = classify(human_scores, mouse_scores)
+            if category == HUMAN:
+                human_out.writelines(human[1])
+            elif category == MOUSE:
+                mouse_out.writelines(mouse[1])
+            else:
+                human_ambiguous_out.writelines(human[1])
+                mouse_ambiguous_out.writelines(mouse[1])
+            counts[category] += 1
+            if stats:
+                stats.add(category, human[1], mouse[1], human_scores,
+                          mouse_scores)
+            human = next(human_groups, None)
+            mouse = next(mouse_groups, None)
+    return counts
+
+
+class DisambiguationStats(object):
+    """
+    what disambiguation did with the reads of a sample, counted as it
+    writes them: the reads of each category, the reads of each category
+    with both ends aligned, the reads that only aligned to one genome, the
+    alignments written to each output and a histogram of the score of the
+    human alignments minus the score of the mouse alignments of the reads
+    that aligned to both genomes, so below zero the reads looked human. the
+    reads sorted into a genome by their k-mers before mapping, which were
+    only mapped to that genome, are set in preclassified
+
+    example:
+    stats = DisambiguationStats()
+    disambiguate(human_in, mouse_in, *out_handles, stats=stats)
+    stats.write("sample.disambiguation_stats.json",
+                "sample.disambiguation_stats.tsv", "sample")
+    """
+
+    def __init__(self):
+        self.reads = dict((x, 0) for x in CATEGORIES)
+        self.pairs = dict((x, 0) for x in CATEGORIES)
+        self.only = {HUMAN: 0, MOUSE: 0}
+        self.preclassified = {HUMAN: 0, MOUSE: 0}
+        self.alignments = dict((x, 0) for x in OUTPUTS)
+        self.differences = dict((x, [0] * (2 * MAX_SCORE_DIFFERENCE + 1))
+                                for x in CATEGORIES)
+
+    def add(self, category, human_lines, mouse_lines, human_scores,
+            mouse_scores):
+        """
+        count a read aligned to both genomes going to category
+        """
+        self.reads[category] += 1
+        if category == HUMAN:
+            self.alignments["human"] += len(human_lines)
+        elif category == MOUSE:
+            self.alignments["mouse"] += len(mouse_lines)
+        else:
+            self.alignments["human_ambiguous"] += len(human_lines)
+            self.alignments["mouse_ambiguous"] += len(mouse_lines)
+        scores = mouse_scores if category == MOUSE else human_scores
+        if max(scores) < UNMAPPED_SCORE:
+            self.pairs[category] += 1
+        difference = sum(human_scores) - sum(mouse_scores)
+        difference = max(-MAX_SCORE_DIFFERENCE,
+                         min(MAX_SCORE_DIFFERENCE, difference))
+        self.differences[category][difference + MAX_SCORE_DIFFERENCE] += 1
+
+    def add_only(self, genome, lines):
+        """
+        count a read only aligned to genome, from the flags of its lines
+        without parsing their tags
+        """
+        self.reads[genome] += 1
+        self.only[genome] += 1
+        self.alignments[genome] += len(lines)
+        if aligned_ends(lines) == 2:
+            self.pairs[genome] += 1
+
+    def merge(self, other):
+        """
+        add the counts of other, the stats of another part of the sample
+        """
+        for name in ("reads", "pairs", "only", "preclassified",
+                     "alignments"):
+            mine = getattr(self, name)
+            for key, value in getattr(other, name).items():
+                mine[key] += value
+        for category, counts in other.differences.items():
+            self.differences[category] = [x + y for x, y in
+                                          zip(self.differences[category],
+                                              counts)]
+        return self
+
+    def to_dict(self):
+        return {"reads": self.reads, "pairs": self.pairs, "only": self.only,
+                "preclassified": self.preclassified,
+                "alignments": self.alignments,
+                "score_differences": self.differences,
+                "max_score_difference": MAX_SCORE_DIFFERENCE}
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls()
+        for name in ("reads", "pairs", "only", "alignments"):
+            getattr(stats, name).update((str(k), v) for k, v in
+                                        values[name].items())
+        # written before reads were sorted by k-mers
+        stats.preclassified.update((str(k), v) for k, v in
+                                   values.get("preclassified", {}).items())
+        stats.differences.update((str(k), v) for k, v in
+                                 values["score_differences"].items())
+        return stats
+
+    @classmethod
+    def load(cls, in_file):
+        with open(in_file) as in_handle:
+            return cls.from_dict(json.load(in_handle))
+
+    def purity(self):
+        """
+        the fraction of the reads that are human, mouse and ambiguous
+        """
+        total = sum(self.reads.values())
+        return dict((x, float(self.reads[x]) / total if total else 0.0)
+                    for x in CATEGORIES)
+
+    def rows(self):
+        """
+        (metric, category, value) rows of the stats
+        """
+        purity = self.purity()
+        rows = []
+        for category in CATEGORIES:
+            rows.append(("reads", category, self.reads[category]))
+            rows.append(("fraction", category, "%.6f" % purity[category]))
+            rows.append(("pairs", category, self.pairs[category]))
+        for genome in (HUMAN, MOUSE):
+            rows.append(("only_aligned_to", genome, self.only[genome]))
+        for genome in (HUMAN, MOUSE):
+            rows.append(("preclassified", genome,
+                         self.preclassified[genome]))
+        for output in OUTPUTS:
+            rows.append(("alignments", output, self.alignments[output]))
+        for category in CATEGORIES:
+            for i, count in enumerate(self.differences[category]):
+                rows.append(("score_difference_%d"
+                             % (i - MAX_SCORE_DIFFERENCE), category, count))
+        return rows
+
+    def write(self, json_file, tsv_file, sample):
+        """
+        write the stats of sample as JSON and as a table
+        """
+        values = self.to_dict()
+        values["sample"] = sample
+        with open(json_file + ".tmp", "w") as out_handle:
+            json.dump(values, out_handle, indent=2, sort_keys=True)
+        with open(tsv_file + ".tmp", "w") as out_handle:
+            out_handle.write("sample\tmetric\tcategory\tvalue\n")
+            for row in self.rows():
+                out_handle.write("%s\t%s\t%s\t%s\n" % ((sample,) + row))
+        os.rename(json_file + ".tmp", json_file)
+        os.rename(tsv_file + ".tmp", tsv_file)
+        return json_file, tsv_file
+
+
+def summary_table(stats_files, out_file):
+    """
+    a table of the reads of each category of the samples in stats_files,
+    the JSON files written by DisambiguationStats.write, one row per sample
+    """
+    columns = (["sample"] +
+               ["%s_reads" % x for x in CATEGORIES] +
+               ["%s_fraction" % x for x in CATEGORIES] +
+               ["%s_pairs" % x for x in CATEGORIES] +
+               ["only_%s" % x for x in (HUMAN, MOUSE)] +
+               ["preclassified_%s" % x for x in (HUMAN, MOUSE)])
+    # samples disambiguated at the same time can write the table at once
+    tmp_file = out_file + ".tmp.%d.%d" % (os.getpid(), thread.get_ident())
+    with open(tmp_file, "w") as out_handle:
+        out_handle.write("\t".join(columns) + "\n")
+        for stats_file in stats_files:
+            with open(stats_file) as in_handle:
+                values = json.load(in_handle)
+            sample = str(values["sample"])
+            stats = DisambiguationStats.from_dict(values)
+            purity = stats.purity()
+            row = ([sample] +
+                   [stats.reads[x] for x in CATEGORIES] +
+                   ["%.4f" % purity[x] for x in CATEGORIES] +
+                   [stats.pairs[x] for x in CATEGORIES] +
+                   [stats.only[x] for x in (HUMAN, MOUSE)] +
+                   [stats.preclassified[x] for x in (HUMAN, MOUSE)])
+            out_handle.write("\t".join(map(str, row)) + "\n")
+    os.rename(tmp_file, out_file)
+    return out_file
@@ -0,0 +1,255 @@
+"""
+finding the input files of each sample with a single scan of the input
+directories that matches all of the patterns at once. what the scan finds is
+kept in a manifest next to the run manifest, keyed by sample name, so the
+next run only lists the directories that changed.
+
+a directory's modification time changes whenever a file is added to it,
+removed from it or renamed in it, so a directory with the same modification
+time as when it was listed still holds the same files. a rerun on a shared
+filesystem with tens of thousands of files then only has to stat each
+directory instead of listing all of them.
+
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import stat
+import thread
+import time
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from az.samples import sample_name
+
+FASTQ_PATTERNS = ["*.fq", "*.fastq", "*.fq.gz", "*.fastq.gz"]
+SAM_PATTERNS = ["*.sam"]
+DISAMBIGUATED_PATTERNS = ["*.disambiguous*.sorted.bam"]
+MANIFEST_VERSION = 1
+# a directory changed within this many seconds of being listed could have
+# changed again without its modification time moving, so it is listed again
+RACY_SECONDS = 2
+
+
+def _matcher(patterns):
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(x)
+                               for x in patterns)).match
+
+
+def _to_str(item):
+    # json gives back unicode, the pipeline expects plain strings
+    if isinstance(item, unicode):
+        return str(item)
+    if isinstance(item, list):
+        return map(_to_str, item)
+    if isinstance(item, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in item.items())
+    return item
+
+
+def _list_dir(path):
+    """
+    the files, symbolic links to files and directories in path. like
+    os.walk, links to directories are not followed
+    """
+    entry = {"files": [], "links": [], "dirs": []}
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        try:
+            mode = os.lstat(full).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            entry["dirs"].append(name)
+        elif stat.S_ISLNK(mode):
+            if not os.path.isdir(full):
+                entry["links"].append(name)
+        else:
+            entry["files"].append(name)
+    return entry
+
+
+class SampleManifest(object):
+    """
+    the input files found below a set of directories and the samples they
+    belong to, kept in manifest_file between runs
+
+    example:
+    manifest = SampleManifest("log/manifest/samples/fastq.json")
+    files = manifest.scan(["data"], FASTQ_PATTERNS)
+    manifest.samples = pair_fastq(files)
+    manifest.save()
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.dirs = {}
+        self.samples = {}
+        self.seen = set()
+        self.listed = 0
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as in_handle:
+                try:
+                    manifest = _to_str(json.load(in_handle))
+                except ValueError:
+                    manifest = {}
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.dirs = manifest["dirs"]
+                self.samples = manifest["samples"]
+
+    def _entry(self, path, now):
+        mtime = os.stat(path).st_mtime
+        entry = self.dirs.get(path)
+        if (entry is None or entry["mtime"] != mtime or
+                mtime >= entry["listed"] - RACY_SECONDS):
+            entry = _list_dir(path)
+            entry["mtime"] = mtime
+            entry["listed"] = now
+            self.dirs[path] = entry
+            self.listed += 1
+        return entry
+
+    def walk(self, root):
+        """
+        yields (directory, entry) for root and every directory below it,
+        only listing the directories that changed since the last scan
+        """
+        now = time.time()
+        stack = [os.path.abspath(root)]
+        while stack:
+            path = stack.pop()
+            try:
+                entry = self._entry(path, now)
+            except OSError:
+                continue
+            self.seen.add(path)
+            yield path, entry
+            stack.extend(os.path.join(path, x) for x in entry["dirs"])
+
+    def scan(self, roots, patterns, links_only=False):
+        """
+        the sorted files below roots matching any of patterns, only the
+        symbolic links to files if links_only is set
+        """
+        match = _matcher(patterns)
+        found = []
+        for root in roots:
+            for path, entry in self.walk(root):
+                names = entry["links"] if links_only else \
+                    entry["files"] + entry["links"]
+                found.extend(os.path.join(path, x) for x in names
+                             if match(x))
+        return sorted(found)
+
+    def save(self):
+        # directories that were not seen this time are gone or were only
+        # below a root that is no longer scanned
+        dirs = dict((x, y) for x, y in self.dirs.items() if x in self.seen)
+        safe_makedir(os.path.dirname(os.path.abspath(self.manifest_file)))
+        # the pipelines of the in-process runner scan in threads of one
+        # process, each needs its own temporary file
+        tmp_file = self.manifest_file + ".tmp.%d.%d" % (os.getpid(),
+                                                       thread.get_ident())
+        with open(tmp_file, "w") as out_handle:
+            json.dump({"version": MANIFEST_VERSION, "samples": self.samples,
+                       "dirs": dirs}, out_handle)
+        os.rename(tmp_file, self.manifest_file)
+
+
+def manifest_file(config, kind, roots):
+    """
+    the sample manifest for kind of input found below roots, stored in
+    dir: manifest or log_dir/manifest like the run manifest
+    """
+    default = os.path.join(config.get("log_dir", "log"), "manifest")
+    manifest_dir = config.get("dir", {}).get("manifest", default)
+    key = json.dumps(sorted(os.path.abspath(x) for x in roots))
+    return os.path.join(manifest_dir, "samples", "%s-%s.json"
+                        % (kind, hashlib.sha1(key).hexdigest()[:12]))
+
+
+def _pair_key(in_file):
+    stem = sample_name(in_file)
+    return re.sub(r"[_.-]R?[12]$", "", stem)
+
+
+def pair_fastq(in_files):
+    """
+    groups FASTQ files into samples, the two files of a paired sample only
+    differ by their read number:
+    ["ctrl_1.fq", "ctrl_2.fq", "treat.fq"] ->
+    {"ctrl": ["ctrl_1.fq", "ctrl_2.fq"], "treat": ["treat.fq"]}
+    """
+    groups = {}
+    for in_file in sorted(in_files):
+        groups.setdefault((os.path.dirname(in_file), _pair_key(in_file)),
+                          []).append(in_file)
+    samples = {}
+    for files in groups.values():
+        if len(files) == 2:
+            samples[sample_name(files)] = files
+        else:
+            samples.update((sample_name(x), [x]) for x in files)
+    return samples
+
+
+def genome_key(in_file):
+    """
+    the sample a SAM file mapped to one of the genomes belongs to, the name
+    of the file without the genome: sample.human.sam -> sample
+    """
+    return re.sub(r"[_.-](human|mouse)$", "", sample_name(in_file))
+
+
+def pair_genomes(human_files, mouse_files):
+    """
+    pairs each human file with the mouse file of the same sample, raising
+    ValueError if a sample only has files for one of the genomes
+    """
+    human = dict((genome_key(x), x) for x in human_files)
+    mouse = dict((genome_key(x), x) for x in mouse_files)
+    unpaired = sorted(set(human) ^ set(mouse))
+    if unpaired:
+        raise ValueError("These samples were not mapped to both genomes: %s."
+                         % (", ".join(unpaired)))
+    return dict((x, [human[x], mouse[x]]) for x in human)
+
+
+def _discover(config, kind, roots, patterns, group, links_only=False):
+    manifest = SampleManifest(manifest_file(config, kind, roots))
+    files = [manifest.scan([x], patterns, links_only) for x in roots]
+    manifest.samples = group(*files)
+    manifest.save()
+    logger.info("Found %d samples in %s, listed %d of %d directories."
+                % (len(manifest.samples), ", ".join(roots), manifest.listed,
+                   len(manifest.seen)))
+    return [manifest.samples[x] for x in sorted(manifest.samples)]
+
+
+def fastq_samples(config, input_dir):
+    """
+    the FASTQ files of each sample in input_dir, a list of the files of each
+    sample sorted by sample name
+    """
+    return _discover(config, "fastq", [input_dir], FASTQ_PATTERNS,
+                     pair_fastq)
+
+
+def genome_samples(config, human_dir, mouse_dir):
+    """
+    [human, mouse] SAM files of each sample sorted by sample name. the
+    descriptive file names are symbolic links, so only those are found
+    """
+    return _discover(config, "genomes", [human_dir, mouse_dir], SAM_PATTERNS,
+                     pair_genomes, links_only=True)
+
+
+def disambiguated_samples(config, input_dir):
+    """
+    the disambiguated, sorted BAM files in input_dir sorted by name
+    """
+    def group(in_files):
+        return dict((sample_name(x), x) for x in in_files)
+    return _discover(config, "disambiguated", [input_dir],
+                     DISAMBIGUATED_PATTERNS, group)
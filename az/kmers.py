@@ -0,0 +1,279 @@
+"""
+sorting reads into human, mouse and uncertain before they are mapped, from
+the k-mers only one of the two references has. a read is only sent to the
+aligner of the genome it is sure to come from, so for a mostly human sample
+most reads are only mapped once. uncertain reads go to both aligners and are
+disambiguated as before.
+
+the k-mers are stored as 2 bits per base in 64 bit integers, the smaller of
+the k-mer and its reverse complement so a read matches from either strand.
+only about one in sample of the k-mers are kept, picked by a hash of the
+k-mer so the references and the reads keep the same ones, which keeps the
+index small enough to build and memory map and still leaves a few k-mers
+for each read. the human and mouse k-mers the other reference also has are
+left out, what remains is compiled once into sorted arrays under dir: ref.
+
+the references have to be the whole genomes. a k-mer missing from a
+transcriptome can still be in the genome, in an intron, a UTR left out of
+the transcripts, a pseudogene or between genes, so with transcript
+references mouse reads with such k-mers would be called human, only mapped
+to human and never disambiguated. references smaller than min_bases are
+refused for that reason. for the two genomes the kept k-mers take a few GB
+of memory while the index is built.
+
+a read is human if at least min_hits of its k-mers are human only and none
+are mouse only, and the same for mouse. anything else is uncertain.
+
+"""
+import gzip
+import json
+import os
+import shutil
+import numpy as np
+from az.locking import file_lock
+from az.manifest import content_hash, HASH_DIR
+
+INDEX_VERSION = 1
+HUMAN_CODE, MOUSE_CODE, UNCERTAIN_CODE = range(3)
+CLASSES = ("human", "mouse", "uncertain")
+DEFAULT_K = 31
+DEFAULT_SAMPLE = 8
+DEFAULT_MIN_HITS = 2
+# fewer ACGT bases than this is not a whole mammalian genome
+MIN_GENOME_BASES = 1000 * 1000 * 1000
+# bases of a reference turned into k-mers at a time
+CHUNK_SIZE = 16 * 1024 * 1024
+# k-mers collected before they are made unique
+BATCH_SIZE = 64 * 1024 * 1024
+# anything but ACGT is 4 and ends the k-mers it is in
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for _i, _bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    for _base in _bases:
+        ENCODE[ord(_base)] = _i
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def encode(seq):
+    return ENCODE[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def canonical_kmers(codes, k=DEFAULT_K):
+    """
+    the canonical k-mers of an encoded sequence and the position each starts
+    at, leaving out the k-mers with a base that is not ACGT
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    bad = np.concatenate([[0], np.cumsum(codes > 3)])
+    good = (bad[k:] - bad[:-k]) == 0
+    bases = (codes & 3).astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    two = np.uint64(2)
+    for j in range(k):
+        window = bases[j:j + n]
+        forward = (forward << two) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * j)
+    return (np.minimum(forward, reverse)[good],
+            np.flatnonzero(good).astype(np.int64))
+
+
+def keep(kmers, sample=DEFAULT_SAMPLE):
+    """
+    which k-mers are kept, about one in sample of them by their hash
+    """
+    if sample <= 1:
+        return np.ones(len(kmers), dtype=bool)
+    mixed = (kmers * MIX) >> np.uint64(32)
+    return mixed % np.uint64(sample) == 0
+
+
+def _open(in_file):
+    if in_file.endswith(".gz"):
+        return gzip.open(in_file)
+    return open(in_file)
+
+
+def read_fasta_codes(fasta_file, chunk_size=CHUNK_SIZE):
+    """
+    yields the encoded bases of a FASTA file in chunks that overlap by
+    enough for k-mers of up to 32 bases, with a 4 between the records so no
+    k-mer spans two of them
+    """
+    buf = []
+    size = 0
+    with _open(fasta_file) as in_handle:
+        for line in in_handle:
+            line = "N" if line.startswith(">") else line.strip()
+            buf.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                seq = "".join(buf)
+                yield encode(seq)
+                buf = [seq[-31:]]
+                size = len(buf[0])
+    if buf:
+        yield encode("".join(buf))
+
+
+def reference_kmers(fasta_file, k=DEFAULT_K, sample=DEFAULT_SAMPLE,
+                    min_bases=0):
+    """
+    the sorted, unique kept k-mers of a FASTA file, raising ValueError if it
+    has fewer than min_bases ACGT bases
+    """
+    found = []
+    size = 0
+    bases = 0
+    for codes in read_fasta_codes(fasta_file):
+        bases += int((codes < 4).sum())
+        kmers, _ = canonical_kmers(codes, k)
+        kmers = np.unique(kmers[keep(kmers, sample)])
+        found.append(kmers)
+        size += len(kmers)
+        if size >= BATCH_SIZE:
+            found = [np.unique(np.concatenate(found))]
+            size = len(found[0])
+    if bases < min_bases:
+        raise ValueError("%s has %d bases, a whole genome has at least %d. "
+                         "k-mers missing from a transcriptome can still be in "
+                         "the genome, so the index needs the whole genomes."
+                         % (fasta_file, bases, min_bases))
+    if not found:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(found))
+
+
+class KmerIndex(object):
+    """
+    the kept k-mers only the human or only the mouse reference has, as
+    sorted arrays
+
+    example:
+    index = KmerIndex.from_fasta("GRCh37/genome.fa", "NCBIM37/genome.fa")
+    codes = index.classify([["ACGT..."], ["TTGA..."]])
+    """
+
+    def __init__(self, human, mouse, k=DEFAULT_K, sample=DEFAULT_SAMPLE):
+        self.human = human
+        self.mouse = mouse
+        self.k = k
+        self.sample = sample
+
+    @classmethod
+    def from_fasta(cls, human_fasta, mouse_fasta, k=DEFAULT_K,
+                   sample=DEFAULT_SAMPLE, min_bases=MIN_GENOME_BASES):
+        """
+        the index of the whole genome FASTA files, refusing references with
+        fewer than min_bases bases
+        """
+        if not 0 < k <= 32:
+            raise ValueError("k-mers have to be 1 to 32 bases long, not %d."
+                             % (k))
+        human = reference_kmers(human_fasta, k, sample, min_bases)
+        mouse = reference_kmers(mouse_fasta, k, sample, min_bases)
+        return cls(np.setdiff1d(human, mouse, assume_unique=True),
+                   np.setdiff1d(mouse, human, assume_unique=True), k, sample)
+
+    def save(self, out_dir):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        np.save(os.path.join(out_dir, "human.npy"), self.human)
+        np.save(os.path.join(out_dir, "mouse.npy"), self.mouse)
+        with open(os.path.join(out_dir, "params.json"), "w") as out_handle:
+            json.dump({"k": self.k, "sample": self.sample}, out_handle)
+        return out_dir
+
+    @classmethod
+    def load(cls, in_dir):
+        """
+        memory map an index written by save
+        """
+        with open(os.path.join(in_dir, "params.json")) as in_handle:
+            params = json.load(in_handle)
+        return cls(np.load(os.path.join(in_dir, "human.npy"), mmap_mode="r"),
+                   np.load(os.path.join(in_dir, "mouse.npy"), mmap_mode="r"),
+                   params["k"], params["sample"])
+
+    def _hits(self, kmers, reads, specific, n):
+        if len(specific) == 0 or len(kmers) == 0:
+            return np.zeros(n, dtype=np.int64)
+        i = np.minimum(np.searchsorted(specific, kmers), len(specific) - 1)
+        return np.bincount(reads[specific[i] == kmers], minlength=n)
+
+    def classify(self, reads, min_hits=DEFAULT_MIN_HITS):
+        """
+        the class code of each read, given as a list of the sequences of
+        its mates
+        """
+        seqs = []
+        read_numbers = []
+        for i, mates in enumerate(reads):
+            for seq in mates:
+                seqs.append(seq)
+                read_numbers.append(np.full(len(seq) + 1, i, dtype=np.int64))
+        n = len(reads)
+        if not seqs:
+            return np.zeros(0, dtype=np.int8)
+        # the N between the mates and reads ends the k-mers there
+        codes = encode("N".join(seqs) + "N")
+        kmers, starts = canonical_kmers(codes, self.k)
+        kept = keep(kmers, self.sample)
+        kmers = kmers[kept]
+        kmer_reads = np.concatenate(read_numbers)[starts[kept]]
+        human = self._hits(kmers, kmer_reads, self.human, n)
+        mouse = self._hits(kmers, kmer_reads, self.mouse, n)
+        codes = np.full(n, UNCERTAIN_CODE, dtype=np.int8)
+        codes[(human >= min_hits) & (mouse == 0)] = HUMAN_CODE
+        codes[(mouse >= min_hits) & (human == 0)] = MOUSE_CODE
+        return codes
+
+
+def index_dir(human_fasta, mouse_fasta, ref_dir, k=DEFAULT_K,
+              sample=DEFAULT_SAMPLE):
+    """
+    where the k-mer index of the two references is kept, named by hashes
+    of all of them like the annotation index
+    """
+    hash_dir = os.path.join(ref_dir, HASH_DIR)
+    key = "%s-%s-k%d-s%d-v%d" % (content_hash(human_fasta, hash_dir),
+                                 content_hash(mouse_fasta, hash_dir),
+                                 k, sample, INDEX_VERSION)
+    return os.path.join(ref_dir, "kmer_index", key)
+
+
+def compile_index(human_fasta, mouse_fasta, ref_dir, k=DEFAULT_K,
+                  sample=DEFAULT_SAMPLE, min_bases=MIN_GENOME_BASES):
+    """
+    compile the k-mer index of the two references under ref_dir if that has
+    not been done yet and return the directory it is in
+    """
+    out_dir = index_dir(human_fasta, mouse_fasta, ref_dir, k, sample)
+    if os.path.exists(out_dir):
+        return out_dir
+    # compiling takes hours, jobs starting at the same time wait for the
+    # first one instead of all compiling it
+    with file_lock(out_dir + ".lock"):
+        if os.path.exists(out_dir):
+            return out_dir
+        tmp_dir = out_dir + ".tmp.%d" % os.getpid()
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        KmerIndex.from_fasta(human_fasta, mouse_fasta, k, sample,
+                             min_bases).save(tmp_dir)
+        os.rename(tmp_dir, out_dir)
+    return out_dir
+
+
+def load_index(human_fasta, mouse_fasta, ref_dir, k=DEFAULT_K,
+               sample=DEFAULT_SAMPLE, min_bases=MIN_GENOME_BASES):
+    """
+    load the k-mer index of the two references, compiling it first if needed
+
+    example:
+    index = load_index("GRCh37/genome.fa", "NCBIM37/genome.fa",
+                       config["dir"]["ref"])
+    """
+    return KmerIndex.load(compile_index(human_fasta, mouse_fasta, ref_dir,
+                                        k, sample, min_bases))
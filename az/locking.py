@@ -0,0 +1,45 @@
+"""
+locks for work that jobs of a run share, like compiling a reference or
+classifying the reads of a sample both mappings need. the jobs can be
+threads of one process, processes on one machine or engines on different
+machines sharing a filesystem.
+
+"""
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+from bcbio.utils import safe_makedir
+
+# locks on files are held by a process, threads of one process also need
+# one of their own on network filesystems
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(lock_file):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(lock_file, threading.Lock())
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    hold an exclusive lock on lock_file while the block runs, waiting for
+    whoever holds it first. the lock goes away with the process holding it,
+    so a killed job does not leave it behind
+
+    example:
+    with file_lock(out_dir + ".lock"):
+        if not os.path.exists(out_dir):
+            compile_to(out_dir)
+    """
+    lock_file = os.path.abspath(lock_file)
+    safe_makedir(os.path.dirname(lock_file))
+    with _thread_lock(lock_file):
+        with open(lock_file, "a") as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_handle, fcntl.LOCK_UN)
@@ -0,0 +1,265 @@
+"""
+a manifest of the work done by each stage, used to decide what can be
+skipped when a pipeline is rerun.
+
+every time a stage finishes on a set of inputs an entry is written that
+records a fingerprint of the inputs, the other arguments of the call, the
+stage configuration, the version of the program that ran and a fingerprint
+of each output. on a rerun the work is
+only skipped if all of those still match, so a truncated output from a killed
+job or a changed input or configuration causes the stage to run again. each
+entry is its own small JSON file, so stages running on different engines can
+update the manifest at the same time.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+from bcbio.utils import safe_makedir
+from bipy.utils import flatten
+from az import trace
+
+# number of bytes hashed from the start and the end of each file
+SAMPLE_BYTES = 1024 * 1024
+# bytes read at a time when hashing a whole file
+HASH_CHUNK = 16 * 1024 * 1024
+# where the content hashes of the references are kept under dir: ref
+HASH_DIR = "content_hashes"
+# keys of a config that change every run without changing the work
+RUN_KEYS = ("trace", "parallel")
+
+
+def fingerprint(in_file):
+    """
+    fingerprint of a file from its size and a hash of its first and last
+    megabyte, cheap enough to compute on very large files. returns None for
+    files that do not exist or are empty
+    """
+    if not os.path.exists(in_file):
+        return None
+    if os.path.isdir(in_file):
+        return "directory"
+    size = os.path.getsize(in_file)
+    if size == 0:
+        return None
+    digest = hashlib.sha1()
+    with open(in_file, "rb") as in_handle:
+        digest.update(in_handle.read(SAMPLE_BYTES))
+        if size > SAMPLE_BYTES:
+            in_handle.seek(max(SAMPLE_BYTES, size - SAMPLE_BYTES))
+            digest.update(in_handle.read(SAMPLE_BYTES))
+    return "%d:%s" % (size, digest.hexdigest())
+
+
+def content_hash(in_file, cache_dir):
+    """
+    sha1 of the whole of in_file, for the compiled references where an edit
+    in the middle of a file that keeps its size has to be noticed. it is
+    only computed again when the path, size or modification time of the
+    file change, the last one is kept in cache_dir
+    """
+    path = os.path.realpath(in_file)
+    stat = os.stat(path)
+    key = [path, stat.st_size, stat.st_mtime]
+    cache_file = os.path.join(cache_dir,
+                              hashlib.sha1(path).hexdigest() + ".json")
+    if os.path.exists(cache_file):
+        with open(cache_file) as in_handle:
+            cached = json.load(in_handle)
+        if cached["key"] == key:
+            return str(cached["sha1"])
+    digest = hashlib.sha1()
+    with open(path, "rb") as in_handle:
+        for chunk in iter(lambda: in_handle.read(HASH_CHUNK), ""):
+            digest.update(chunk)
+    safe_makedir(cache_dir)
+    tmp_file = cache_file + ".tmp.%d" % os.getpid()
+    with open(tmp_file, "w") as out_handle:
+        json.dump({"key": key, "sha1": digest.hexdigest()}, out_handle)
+    os.rename(tmp_file, cache_file)
+    return digest.hexdigest()
+
+
+def _files(item):
+    if item is None:
+        return []
+    if isinstance(item, basestring):
+        return [item]
+    return [x for x in flatten(item) if isinstance(x, basestring)]
+
+
+def _program_version(program):
+    """
+    the version of a program is the fingerprint of its executable, so
+    upgrading a program causes the stages that use it to run again
+    """
+    if not program:
+        return None
+    for path in [program] + [os.path.join(x, program) for x in
+                             os.environ.get("PATH", "").split(os.pathsep)]:
+        if os.path.isfile(path):
+            return fingerprint(os.path.realpath(path))
+    return program
+
+
+def _name(fn):
+    if hasattr(fn, "__name__"):
+        return "%s.%s" % (fn.__module__, fn.__name__)
+    return "%s.%s" % (type(fn).__module__, type(fn).__name__)
+
+
+def _to_str(item):
+    # json gives back unicode, the pipeline expects plain strings
+    if isinstance(item, unicode):
+        return str(item)
+    if isinstance(item, list):
+        return map(_to_str, item)
+    return item
+
+
+def _without_run_keys(arg):
+    if not isinstance(arg, dict):
+        return arg
+    return dict((k, v) for k, v in arg.items() if k not in RUN_KEYS)
+
+
+def _digest(args):
+    # the arguments besides the input, like the config handed to each call.
+    # the trace and parallel settings of a config are new each run, so they
+    # are left out or every rerun would redo every stage
+    key = json.dumps(map(_without_run_keys, args), sort_keys=True,
+                     default=str)
+    return hashlib.sha1(key).hexdigest()
+
+
+class RunManifest(object):
+    """
+    the manifest for a pipeline run, stored in dir: manifest or in
+    log_dir/manifest if that is not set. args are the other arguments fn
+    is called with besides in_files, a change to them means the work has
+    to be done again
+
+    example:
+    manifest = RunManifest(config)
+    if manifest.is_done("disambiguate", in_files, fn):
+        out_files = manifest.lookup("disambiguate", in_files, fn)
+    else:
+        manifest.invalidate("disambiguate", in_files, fn)
+        out_files = fn(in_files)
+        manifest.record("disambiguate", in_files, fn, out_files)
+    """
+
+    def __init__(self, config):
+        self.config = config
+        default = os.path.join(config.get("log_dir", "log"), "manifest")
+        self.manifest_dir = config["dir"].get("manifest", default)
+
+    def _entry_file(self, stage, in_files, fn):
+        key = json.dumps([stage, _name(fn), _files(in_files)])
+        return os.path.join(self.manifest_dir, stage,
+                            hashlib.sha1(key).hexdigest() + ".json")
+
+    def _signature(self, stage, in_files, fn, args=()):
+        stage_config = self.config.get("stage", {}).get(stage, {})
+        if not isinstance(stage_config, dict):
+            stage_config = {}
+        return {"stage": stage,
+                "function": _name(fn),
+                "config": json.dumps(stage_config, sort_keys=True,
+                                     default=str),
+                "version": _program_version(stage_config.get("program")),
+                "inputs": [fingerprint(x) for x in _files(in_files)],
+                "args": _digest(args)}
+
+    def _load(self, stage, in_files, fn):
+        entry_file = self._entry_file(stage, in_files, fn)
+        if not os.path.exists(entry_file):
+            return None
+        with open(entry_file) as in_handle:
+            return json.load(in_handle)
+
+    def _valid_entry(self, stage, in_files, fn, args=()):
+        entry = self._load(stage, in_files, fn)
+        if entry is None:
+            return None
+        if entry["signature"] != self._signature(stage, in_files, fn, args):
+            return None
+        out_files = _files(entry["outputs"])
+        if [fingerprint(x) for x in out_files] != entry["fingerprints"]:
+            return None
+        return entry
+
+    def is_done(self, stage, in_files, fn, args=()):
+        """
+        returns True if fn was run as stage on in_files and the inputs,
+        arguments, configuration, program and outputs are all unchanged since
+        """
+        return self._valid_entry(stage, in_files, fn, args) is not None
+
+    def lookup(self, stage, in_files, fn, args=()):
+        """
+        returns the recorded outputs of running fn as stage on in_files if
+        the work is still valid, otherwise returns None
+        """
+        entry = self._valid_entry(stage, in_files, fn, args)
+        return None if entry is None else _to_str(entry["outputs"])
+
+    def invalidate(self, stage, in_files, fn):
+        """
+        remove the outputs recorded for fn as stage on in_files so the stage
+        does not mistake them for finished work, leaving the inputs alone
+        """
+        entry = self._load(stage, in_files, fn)
+        if entry is None:
+            return
+        inputs = set(map(os.path.abspath, _files(in_files)))
+        for out_file in _files(entry["outputs"]):
+            if os.path.abspath(out_file) in inputs:
+                continue
+            if os.path.isdir(out_file):
+                shutil.rmtree(out_file)
+            elif os.path.exists(out_file):
+                os.remove(out_file)
+        os.remove(self._entry_file(stage, in_files, fn))
+
+    def record(self, stage, in_files, fn, out_files, args=()):
+        """
+        record that running fn as stage on in_files made out_files
+        """
+        entry_file = self._entry_file(stage, in_files, fn)
+        safe_makedir(os.path.dirname(entry_file))
+        entry = {"signature": self._signature(stage, in_files, fn, args),
+                 "outputs": out_files,
+                 "fingerprints": [fingerprint(x) for x in _files(out_files)]}
+        tmp_file = entry_file + ".tmp.%d" % os.getpid()
+        with open(tmp_file, "w") as out_handle:
+            json.dump(entry, out_handle, indent=2)
+        os.rename(tmp_file, entry_file)
+
+
+def cached_map(view, config, stage, fn, in_files, *args):
+    """
+    view.map(fn, in_files, *args) that skips the inputs the manifest says are
+    already done. the outputs of inputs that have to be redone are removed
+    first so fn does not skip them because they exist. args are lists with one
+    item per input, like the other arguments to view.map. the calls are
+    recorded in the trace of the run if it is being traced.
+    """
+    manifest = RunManifest(config)
+    # the other arguments of each call
+    call_args = [[arg[i] for arg in args] for i in range(len(in_files))]
+    entries = [manifest._valid_entry(stage, x, fn, y)
+               for x, y in zip(in_files, call_args)]
+    results = [None if x is None else _to_str(x["outputs"]) for x in entries]
+    todo = [i for i, x in enumerate(entries) if x is None]
+    if not todo:
+        return results
+    [manifest.invalidate(stage, in_files[i], fn) for i in todo]
+    todo_args = [[arg[i] for i in todo] for arg in args]
+    out_files = view.map(trace.traced(config, stage, fn),
+                         [in_files[i] for i in todo], *todo_args)
+    for i, out_file in zip(todo, out_files):
+        manifest.record(stage, in_files[i], fn, out_file, call_args[i])
+        results[i] = out_file
+    return results
@@ -0,0 +1,254 @@
+"""
+the counts of every sample of a project kept in one binary matrix that new
+samples are added to, instead of combining every table of counts again each
+time a sample is added.
+
+the matrix is a directory holding the genes, a flat little endian array of
+counts with one row of all of the genes for each sample, and the list of
+samples with the fingerprints of the tables they were read from. adding a
+sample appends its row to the array and then replaces the list of samples,
+so a run that dies in between leaves a row that is not listed and is dropped
+the next time the matrix is opened. a table that changed is read again into
+its own row. the array is memory mapped, so picking out the samples of a
+comparison only reads their rows and the combined table is only written
+when it is asked for. samples no longer in the project are removed by
+writing the matrix again without them.
+
+"""
+import json
+import os
+import shutil
+import numpy as np
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from az.manifest import fingerprint
+from az.samples import sample_name
+
+MATRIX_VERSION = 1
+DTYPE = "<u4"
+SUFFIX = ".matrix"
+
+
+def read_counts(count_file):
+    """
+    the genes and counts of a table of counts written by htseq-count or
+    GeneCounter.write, special counters included
+    """
+    genes, counts = [], []
+    with open(count_file) as in_handle:
+        for line in in_handle:
+            if not line.strip():
+                continue
+            gene, count = line.rstrip("\n").split("\t")
+            genes.append(gene)
+            counts.append(int(count))
+    return genes, counts
+
+
+def _stat(in_file):
+    stat = os.stat(in_file)
+    return [stat.st_size, stat.st_mtime]
+
+
+class CountMatrix(object):
+    """
+    a genes by samples matrix of counts in matrix_dir that samples can be
+    added to one at a time
+
+    example:
+    matrix = CountMatrix("results/htseq-count/combined.matrix")
+    matrix.update(["results/htseq-count/ctrl.counts",
+                   "results/htseq-count/treat.counts"])
+    counts = matrix.select(["ctrl", "treat"])
+    matrix.write_table("results/htseq-count/combined.counts")
+    """
+
+    def __init__(self, matrix_dir):
+        self.matrix_dir = matrix_dir
+        self.genes = []
+        self.samples = []
+        self.sources = {}
+        samples_file = self._path("samples.json")
+        if not os.path.exists(samples_file):
+            return
+        with open(samples_file) as in_handle:
+            saved = json.load(in_handle)
+        if saved.get("version") != MATRIX_VERSION:
+            return
+        with open(self._path("genes.txt")) as in_handle:
+            self.genes = [x.rstrip("\n") for x in in_handle]
+        self.samples = [str(x) for x in saved["samples"]]
+        self.sources = dict((str(x), y) for x, y in saved["sources"].items())
+        # drop the row of a sample that was being added when a run died
+        size = len(self.samples) * len(self.genes) * np.dtype(DTYPE).itemsize
+        if os.path.getsize(self._path("counts")) > size:
+            with open(self._path("counts"), "r+b") as out_handle:
+                out_handle.truncate(size)
+
+    def _path(self, name):
+        return os.path.join(self.matrix_dir, name)
+
+    def _save(self):
+        tmp_file = self._path("samples.json.tmp.%d" % os.getpid())
+        with open(tmp_file, "w") as out_handle:
+            json.dump({"version": MATRIX_VERSION, "samples": self.samples,
+                       "sources": self.sources}, out_handle)
+        os.rename(tmp_file, self._path("samples.json"))
+
+    def _start(self, genes):
+        safe_makedir(self.matrix_dir)
+        with open(self._path("genes.txt"), "w") as out_handle:
+            out_handle.writelines(x + "\n" for x in genes)
+        open(self._path("counts"), "wb").close()
+        self.genes = genes
+        self.samples = []
+        self.sources = {}
+        self._save()
+
+    def is_current(self, count_file, sample=None):
+        """
+        True if the counts of count_file are already in the matrix
+        """
+        sample = sample or sample_name(count_file)
+        source = self.sources.get(sample)
+        if source is None:
+            return False
+        if source["stat"] == _stat(count_file):
+            return True
+        return source["fingerprint"] == fingerprint(count_file)
+
+    def add(self, count_file, sample=None):
+        """
+        add the counts in count_file as sample, named after the file if it
+        is not given, replacing the counts of a sample that is already
+        there. returns False if the matrix already had these counts
+        """
+        sample = sample or sample_name(count_file)
+        if self.is_current(count_file, sample):
+            return False
+        genes, counts = read_counts(count_file)
+        if not self.genes and not self.samples:
+            self._start(genes)
+        if genes != self.genes:
+            raise ValueError("The genes of %s are not the genes of the count "
+                             "matrix in %s." % (count_file, self.matrix_dir))
+        row = np.array(counts, dtype=DTYPE)
+        if (row != np.array(counts)).any():
+            raise ValueError("The counts of %s do not fit in the count "
+                             "matrix." % (count_file))
+        if sample in self.samples:
+            with open(self._path("counts"), "r+b") as out_handle:
+                out_handle.seek(self.samples.index(sample) * row.nbytes)
+                out_handle.write(row.tostring())
+        else:
+            with open(self._path("counts"), "ab") as out_handle:
+                out_handle.write(row.tostring())
+            self.samples.append(sample)
+        self.sources[sample] = {"stat": _stat(count_file),
+                                "fingerprint": fingerprint(count_file)}
+        self._save()
+        return True
+
+    def remove(self, samples):
+        """
+        drop samples from the matrix by writing it again without them next
+        to it and putting that in its place, returns the number removed
+        """
+        keep = [x for x in self.samples if x not in samples]
+        if len(keep) == len(self.samples):
+            return 0
+        rows = self.select(keep).T
+        tmp_dir = self.matrix_dir + ".tmp.%d" % os.getpid()
+        kept = CountMatrix(tmp_dir)
+        kept._start(self.genes)
+        with open(kept._path("counts"), "wb") as out_handle:
+            out_handle.write(np.ascontiguousarray(rows, dtype=DTYPE)
+                             .tostring())
+        kept.samples = keep
+        kept.sources = dict((x, self.sources[x]) for x in keep)
+        kept._save()
+        # a run dying here leaves no matrix, it is made again from the files
+        shutil.rmtree(self.matrix_dir)
+        os.rename(tmp_dir, self.matrix_dir)
+        removed = len(self.samples) - len(keep)
+        self.samples = keep
+        self.sources = kept.sources
+        return removed
+
+    def update(self, count_files):
+        """
+        add the counts of the files not already in the matrix, returns the
+        number of samples added or replaced
+        """
+        return sum(self.add(x) for x in count_files)
+
+    @property
+    def counts(self):
+        """
+        the memory mapped genes by samples matrix
+        """
+        if not self.samples:
+            return np.zeros((len(self.genes), 0), dtype=DTYPE)
+        rows = np.memmap(self._path("counts"), dtype=DTYPE, mode="r",
+                         shape=(len(self.samples), len(self.genes)))
+        return rows.T
+
+    def select(self, samples):
+        """
+        the genes by samples matrix of just samples, in that order
+        """
+        missing = [x for x in samples if x not in self.samples]
+        if missing:
+            raise KeyError("%s are not in the count matrix in %s."
+                           % (missing, self.matrix_dir))
+        rows = self.counts.T
+        return np.array([rows[self.samples.index(x)] for x in samples]).T
+
+    def write_table(self, out_file, samples=None):
+        """
+        write the counts of samples, all of them if not given, as a tab
+        separated table with one row per gene like htseq_count.combine_counts
+        """
+        samples = self.samples if samples is None else samples
+        counts = self.select(samples)
+        tmp_file = out_file + ".tmp.%d" % os.getpid()
+        with open(tmp_file, "w") as out_handle:
+            out_handle.write("\t".join(["id"] + samples) + "\n")
+            for gene, row in zip(self.genes, counts):
+                out_handle.write("\t".join([gene] + map(str, row.tolist()))
+                                 + "\n")
+        os.rename(tmp_file, out_file)
+        return out_file
+
+
+def combine_counts(count_files, out_file=None):
+    """
+    add the tables of counts to the count matrix next to them and write the
+    combined table of just their samples, only if a sample was added or
+    removed or the table is missing. samples in the matrix without a file
+    in count_files were dropped from the project or renamed and are removed
+    from it. the table goes in combined.counts in the directory of the first
+    file unless out_file is given
+    """
+    if out_file is None:
+        out_file = os.path.join(os.path.dirname(count_files[0]),
+                                "combined.counts")
+    matrix_dir = os.path.splitext(out_file)[0] + SUFFIX
+    matrix = CountMatrix(matrix_dir)
+    try:
+        added = matrix.update(count_files)
+    except ValueError as e:
+        # counted against another annotation, start over with the new one
+        logger.info("%s Making the count matrix again." % (e))
+        shutil.rmtree(matrix_dir)
+        matrix = CountMatrix(matrix_dir)
+        added = matrix.update(count_files)
+    samples = [sample_name(x) for x in count_files]
+    stale = [x for x in matrix.samples if x not in samples]
+    if stale:
+        logger.info("Removing %s from the count matrix in %s, they have no "
+                    "counts in this run." % (stale, matrix_dir))
+    removed = matrix.remove(stale)
+    if added or removed or not os.path.exists(out_file):
+        matrix.write_table(out_file, samples)
+    return out_file
@@ -0,0 +1,208 @@
+"""
+running the stages of a pipeline in parallel, either on an ipython cluster
+or on a pool of processes on the local machine when cluster: local is set.
+the local view takes the same map calls as the views of cluster_view, so the
+pipelines do not need to know where they are running.
+
+"""
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+
+# how long to wait on results at a time, waiting without a timeout makes a
+# pool ignore KeyboardInterrupt in python 2
+WAIT_TIMEOUT = 60 * 60 * 24 * 365
+# how often a SharedView checks on the maps it is waiting for
+POLL_SECONDS = 1
+
+
+def _apply(job):
+    fn, args = job
+    return fn(*args)
+
+
+class LocalMapResult(object):
+    """
+    the result of a map with block=False, get waits for the results and
+    returns them in order like the AsyncMapResult of an ipython view
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return self.result.ready()
+
+    def wait(self, timeout=None):
+        self.result.wait(timeout)
+
+    def successful(self):
+        return self.result.successful()
+
+    def get(self, timeout=WAIT_TIMEOUT):
+        return self.result.get(timeout)
+
+
+class LocalView(object):
+    """
+    runs view.map calls on a pool of processes, one for each job that fits on
+    the machine. each item of a map is its own task, since the stages take
+    long enough that spreading them out matters more than the overhead
+
+    example:
+    view = LocalView(cores=8, cores_per_job=2)
+    bam_files = view.map(sam.sam2bam, sam_files)
+    fastqc = view.map(FastQC(config), fastq_files, block=False)
+    fastqc.get()
+    view.close()
+    """
+
+    def __init__(self, cores=None, cores_per_job=1):
+        available = multiprocessing.cpu_count() // max(1, cores_per_job)
+        self.processes = max(1, min(cores or available, available))
+        self.pool = multiprocessing.Pool(self.processes)
+
+    def map(self, fn, *iterables, **kwargs):
+        block = kwargs.pop("block", True)
+        if kwargs:
+            raise TypeError("map got unexpected keyword arguments %s."
+                            % (kwargs.keys()))
+        jobs = [(fn, args) for args in zip(*iterables)]
+        result = LocalMapResult(self.pool.map_async(_apply, jobs,
+                                                    chunksize=1))
+        if block:
+            return result.get()
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class SharedMapResult(object):
+    """
+    the result of a map on a SharedView, only touches the result while
+    holding the lock of the view
+    """
+
+    def __init__(self, result, lock):
+        self.result = result
+        self.lock = lock
+
+    def ready(self):
+        with self.lock:
+            return self.result.ready()
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while not self.ready():
+            if timeout is not None and time.time() - start >= timeout:
+                return
+            time.sleep(POLL_SECONDS)
+
+    def successful(self):
+        with self.lock:
+            return self.result.successful()
+
+    def get(self, timeout=WAIT_TIMEOUT):
+        self.wait(timeout)
+        with self.lock:
+            return self.result.get(0)
+
+
+class SharedView(object):
+    """
+    lets the pipelines of several threads map on the same view at once. the
+    client of an ipython view is not thread safe, so the maps are submitted
+    and checked on one at a time and the threads wait for their results
+    without holding the lock, their jobs share the engines in between
+
+    example:
+    with pipeline_view(config["cluster"]) as view:
+        shared = SharedView(view)
+        threads = [threading.Thread(target=mapping.main,
+                                    args=(x, shared, [sample]))
+                   for x in [human_config, mouse_config]]
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.lock = threading.Lock()
+
+    def map(self, fn, *iterables, **kwargs):
+        block = kwargs.pop("block", True)
+        with self.lock:
+            result = SharedMapResult(self.view.map(fn, *iterables,
+                                                   block=False, **kwargs),
+                                     self.lock)
+        if block:
+            return result.get()
+        return result
+
+
+class Cancelled(RuntimeError):
+    pass
+
+
+class CancellableView(object):
+    """
+    a view that refuses new maps once it is cancelled, so a pipeline running
+    on it in a thread stops at its next stage instead of running to the end.
+    maps that already started run to the end
+
+    example:
+    job_view = CancellableView(shared)
+    job = FunctionJob("mapping_s1", mapping.main, [config, job_view, ["s1"]],
+                      on_cancel=job_view.cancel)
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def map(self, fn, *iterables, **kwargs):
+        if self._cancelled.is_set():
+            raise Cancelled("The job was cancelled, not starting %s."
+                            % getattr(fn, "__name__", type(fn).__name__))
+        return self.view.map(fn, *iterables, **kwargs)
+
+
+@contextmanager
+def local_view(cores=None, cores_per_job=1):
+    view = LocalView(cores, cores_per_job)
+    try:
+        yield view
+    except:
+        view.terminate()
+        raise
+    view.close()
+
+
+@contextmanager
+def pipeline_view(cluster_config):
+    """
+    a local view if cluster: local is set and a view of an ipython cluster
+    started with cluster_view otherwise
+
+    example:
+    with pipeline_view(config["cluster"]) as view:
+        main(config, view)
+    """
+    cores_per_job = cluster_config.get("cores_per_job", 1)
+    if cluster_config.get("local", False):
+        with local_view(cluster_config.get("cores"), cores_per_job) as view:
+            yield view
+        return
+    # only needed for running on a cluster
+    from cluster_helper.cluster import cluster_view
+    with cluster_view(cluster_config["scheduler"], cluster_config["queue"],
+                      cluster_config["cores"], cores_per_job) as view:
+        yield view
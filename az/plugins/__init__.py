@@ -0,0 +1,75 @@
+"""
+the stages the pipelines run, found by name without importing them. a stage
+is only imported the first time it is looked up, so a pipeline, or an engine
+unpickling one of its stages, only imports the stages in its run: list and
+not every toolbox.
+
+stages that are not listed here are looked up in the bipy StageRepository,
+which imports all of the plugins in the plugin directory of the config.
+
+"""
+import importlib
+
+# stage name -> "module:class" of the stage
+STAGES = {
+    "cutadapt": "bipy.toolbox.trim:Cutadapt",
+    "disambiguate": "az.plugins.disambiguate:Disambiguate",
+    "fastqc": "bipy.toolbox.fastqc:FastQC",
+    "hard_clip": "bipy.toolbox.fastq:HardClipper",
+    "htseq-count": "az.plugins.count:CountGenes",
+    "kmer_classify": "az.plugins.kmer:KmerClassify",
+    "rnaseq_metrics": "bipy.toolbox.rseqc:RNASeqMetrics",
+    "rrna_fraction": "az.plugins.rrna:ContaminationFractions",
+    "rseqc": "az.plugins.qc:RseqcMetrics",
+    "tophat": "bipy.toolbox.tophat:Tophat",
+    "tophat_disambiguate": "az.plugins.custom_tophat:TophatDisambiguate",
+    "tophat_human": "az.plugins.custom_tophat:TophatHuman",
+    "tophat_mouse": "az.plugins.custom_tophat:TophatMouse",
+}
+
+
+def load(path):
+    """
+    the object at path, given as "module:name"
+    """
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+class StageRepository(object):
+    """
+    the stage classes by stage name, imported the first time they are
+    looked up. takes the place of bipy.plugins.StageRepository
+
+    example:
+    repository = StageRepository(config)
+    disambiguate = repository["disambiguate"](config)
+    """
+
+    def __init__(self, config, stages=None):
+        self.config = config
+        self.stages = dict(STAGES if stages is None else stages)
+        self.loaded = {}
+        self._fallback = None
+
+    @property
+    def plugins(self):
+        return sorted(self.stages)
+
+    def __contains__(self, stage):
+        return stage in self.stages
+
+    def __getitem__(self, stage):
+        if stage not in self.loaded:
+            if stage in self.stages:
+                self.loaded[stage] = load(self.stages[stage])
+            else:
+                self.loaded[stage] = self._bipy_repository()[stage]
+        return self.loaded[stage]
+
+    def _bipy_repository(self):
+        # imports every plugin it finds, so only when it is needed
+        if self._fallback is None:
+            from bipy.plugins import StageRepository as BipyRepository
+            self._fallback = BipyRepository(self.config)
+        return self._fallback
@@ -0,0 +1,102 @@
+"""
+counts reads per gene from coordinate sorted BAM files without running
+htseq-count
+
+"""
+from bipy.pipeline.stages import AbstractStage
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from az.annotation import GeneIndex, compile_index
+from az.counting import GeneCounter
+from az import bam
+import os
+
+# htseq-count's single letter options
+SHORT_OPTIONS = {"-s": "stranded", "-t": "type", "-i": "idattr",
+                 "-m": "mode", "-a": "minaqual"}
+
+
+def parse_htseq_options(options):
+    """
+    turn the htseq-count options from the config, like [--stranded=no] or
+    [-s, "no"], into a dictionary of option name to value
+    """
+    parsed = {}
+    for option in options:
+        if isinstance(option, basestring):
+            option = [option]
+        option = map(str, option)
+        if "=" in option[0]:
+            name, value = option[0].split("=", 1)
+        else:
+            name, value = option[0], option[1] if len(option) > 1 else None
+        name = SHORT_OPTIONS.get(name, name).lstrip("-")
+        parsed[name] = value
+    return parsed
+
+
+class CountGenes(AbstractStage):
+    """
+    counts the reads overlapping each gene straight from a coordinate sorted
+    BAM file, reproducing htseq-count in union mode. uses the options set for
+    htseq-count and the annotation file and writes the same table of counts,
+    so the outputs can be combined with htseq_count.combine_counts. the
+    annotation is compiled once into an index under dir: ref that every job
+    memory maps. turn it on with engine: native:
+
+    stage:
+        htseq-count:
+            engine: native
+            options:
+                - [--stranded=no]
+                - [--type=exon]
+                - [--idattr=gene_id]
+                - [--mode=union]
+
+    """
+
+    stage = "htseq-count"
+
+    def __init__(self, config):
+        super(CountGenes, self).__init__(config)
+        self.config = config
+        self.stage_config = config["stage"][self.stage]
+        self.threads = bam.stage_threads(config, self.stage)
+        options = parse_htseq_options(self.stage_config.get("options", []))
+        if options.get("mode", "union") != "union":
+            logger.error("Only the union mode of htseq-count is supported "
+                         "by the native counter, aborting.")
+            exit(1)
+        self.stranded = options.get("stranded", "yes")
+        self.feature_type = options.get("type", "exon")
+        self.id_attribute = options.get("idattr", "gene_id")
+        self.minaqual = int(options.get("minaqual", 10))
+        self.secondary = options.get("secondary-alignments") == "score"
+        self.supplementary = (options.get("supplementary-alignments") ==
+                              "score")
+        self.gtf = self.stage_config.get("gtf",
+                                         config["annotation"]["file"])
+        self.out_dir = os.path.join(config["dir"].get("results", "results"),
+                                    self.stage)
+        # compile the annotation once here so the jobs only have to map it
+        self.index_dir = compile_index(self.gtf,
+                                       config["dir"].get("ref", "ref"),
+                                       self.feature_type, self.id_attribute)
+
+    def out_file(self, in_file):
+        base, _ = os.path.splitext(os.path.basename(in_file))
+        return os.path.join(self.out_dir, base + ".counts")
+
+    def __call__(self, in_file):
+        self._start_message(in_file)
+        out_file = self.out_file(in_file)
+        safe_makedir(self.out_dir)
+        index = GeneIndex.load(self.index_dir)
+        counter = GeneCounter(index, self.stranded, self.minaqual,
+                              self.secondary, self.supplementary)
+        counter.count(bam.read_alignments(in_file, self.config,
+                                          self.threads))
+        tmp_file = counter.write(out_file + ".tmp")
+        os.rename(tmp_file, out_file)
+        self._end_message(in_file)
+        return out_file
@@ -1,5 +1,11 @@
 from bipy.toolbox.tophat import Tophat, run_with_config
+from bipy.pipeline.stages import AbstractStage
 from bipy.utils import is_pair
+from multiprocessing.pool import ThreadPool
+import copy
+from bcbio.log import logger
+from az.plugins.disambiguate import Disambiguate
+import os
 
 
 class TophatMouse(Tophat):
@@ -21,8 +27,89 @@ class TophatMouse(Tophat):
         else:
             out_file = run_with_config(in_file[0], None, self.ref,
                                        self.stage, self.config, gtf=self.gtf)
+        self._end_message(in_file)
+        return out_file
 
 
 class TophatHuman(TophatMouse):
 
     stage = "tophat_human"
+
+
+class TophatDisambiguate(AbstractStage):
+    """
+    maps a sample to the human and mouse genomes at the same time and
+    disambiguates it as soon as both alignments are done, so one sample is
+    disambiguated while the next one is still mapping instead of waiting
+    for every sample to finish mapping. needs the tophat_human, tophat_mouse
+    and disambiguate stages to be configured and works best with the python
+    disambiguation engine, which streams the alignments through sort
+    without writing name sorted copies.
+
+    tophat only writes its alignments when it finishes, so this overlaps
+    mapping and disambiguation per sample rather than per read. the two
+    tophat runs share the engine, so each gets half of its threads: half of
+    num-threads in the tophat options of its stage or of cores_per_job of
+    the cluster. set cleanup to remove the tophat SAM files once they are
+    disambiguated:
+
+    stage:
+        tophat_disambiguate:
+            cleanup: True
+
+    """
+
+    stage = "tophat_disambiguate"
+
+    def __init__(self, config):
+        super(TophatDisambiguate, self).__init__(config)
+        self.config = config
+        self.stage_config = config["stage"].get(self.stage, {})
+        self.cleanup = self.stage_config.get("cleanup", False)
+        self.aligners = [x(self._aligner_config(x.stage))
+                         for x in (TophatHuman, TophatMouse)]
+        self.disambiguate = Disambiguate(config)
+        if self.cleanup and self.disambiguate.ambiguous == "index":
+            logger.error("The index of the ambiguous reads points into the "
+                         "tophat SAM files, they can not be cleaned up. "
+                         "Aborting.")
+            exit(1)
+
+    def _aligner_config(self, stage):
+        """
+        the config of one of the two tophat runs, with half of the threads
+        of the engine so the two of them do not oversubscribe it
+        """
+        config = copy.deepcopy(self.config)
+        stage_config = config["stage"].setdefault(stage, {})
+        options = stage_config.setdefault("options", {})
+        cluster = config.setdefault("cluster", {})
+        cores = options.get("num-threads", options.get(
+            "p", cluster.get("cores_per_job", 1)))
+        # a human and a mouse run
+        threads = max(1, int(cores) // 2)
+        options.pop("p", None)
+        options["num-threads"] = threads
+        cluster["cores_per_job"] = threads
+        return config
+
+    def __call__(self, in_file):
+        self._start_message(in_file)
+        pool = ThreadPool(len(self.aligners))
+        try:
+            sam_files = pool.map(lambda x: x(in_file), self.aligners)
+        finally:
+            pool.close()
+        out_files = self.disambiguate(tuple(sam_files))
+        if self.cleanup:
+            [self._remove(x) for x in sam_files]
+        self._end_message(in_file)
+        return out_files
+
+    def _remove(self, sam_file):
+        # the descriptive SAM filenames are links to the tophat output
+        real_file = os.path.realpath(sam_file)
+        if os.path.exists(real_file):
+            os.remove(real_file)
+        if os.path.islink(sam_file):
+            os.remove(sam_file)
@@ -6,13 +6,20 @@ wrapper around Qi's diambiguate script
 from bipy.pipeline.stages import AbstractStage
 from bipy.utils import flatten
 from bcbio.utils import safe_makedir, file_exists
+import glob
 import os
-import sh
+import subprocess
+import zlib
 from itertools import groupby, starmap
 #from bipy.log import logger
 import shutil
 from bcbio.log import setup_local_logging, logger
-from bcbio.provenance.do import run
+# ambiguous, columns and the kmer stage pull in numpy, they are only
+# imported by the engines that use them
+from az import disambiguation, bam, trace
+from az.discovery import genome_key
+from az.samples import belongs_to
+from az.manifest import RunManifest
 
 class Disambiguate(AbstractStage):
     """
@@ -28,6 +35,70 @@ class Disambiguate(AbstractStage):
         disambiguate:
             program: /path/to/disamb_byMapping2.pl
 
+    alternatively the reads can be disambiguated in python, which streams
+    over the two files sorted by read name instead of loading them into
+    memory. input files not sorted by read name are piped through sort:
+
+    stage:
+        disambiguate:
+            engine: python
+
+    the columnar engine decides every read of a sample at once with numpy
+    from the columns mapping writes next to each tophat output, and only
+    reads the SAM records again to write them out. the inputs do not have to
+    be sorted by read name and the columns are written here if mapping did
+    not write them:
+
+    stage:
+        disambiguate:
+            engine: columnar
+
+    perl stays the default. the python and columnar engines score each
+    alignment by its NM, NH and XO tags, while disamb_byMapping2.pl matches
+    those tags against the wrong string and scores every mapped end 0, so
+    the engines put many reads in a different category than the perl
+    program does. scripts/benchmark.py reports how far they agree.
+
+    large samples can be split into partitions by hashing the read names,
+    each partition can then be disambiguated on a separate engine with
+    disambiguate_partition and the results joined with combine_partitions.
+    this requires the python engine:
+
+    stage:
+        disambiguate:
+            engine: python
+            partitions: 16
+
+    the python and columnar engines count what they do with the reads as
+    they write them, into sample.disambiguation_stats.json and .tsv in
+    results/disambiguate, without reading the outputs again. the reads the
+    kmer_classify stage sorted into a genome before mapping are added to
+    the stats from its decisions in results/kmer_classify, or kmer_dir:
+
+    stage:
+        disambiguate:
+            kmer_dir: results/kmer_classify
+
+    the columnar engine can keep the ambiguous reads once, as an index of
+    their alignments in the input files, in results/disambiguate/
+    sample.ambiguous.npz instead of writing them to a human and a mouse
+    file. az.ambiguous.AmbiguousIndex writes them out in the coordinates of
+    either genome when they are needed. the index is only good as long as
+    the input files are kept:
+
+    stage:
+        disambiguate:
+            engine: columnar
+            ambiguous: index
+
+    setting output to bam writes coordinate sorted and indexed BAM files
+    straight into their final location instead of SAM files:
+
+    stage:
+        disambiguate:
+            output: bam
+            threads: 4  # threads compressing the BAM files
+
     example:
     stage_runner = Disambiguate(config)
     stage_runner(("human.sam", "mouse.sam") -> creates
@@ -37,7 +108,12 @@ class Disambiguate(AbstractStage):
     """
 
     stage = "disambiguate"
+    # calls are traced by __call__ so the skipped ones are left out
+    records_trace = True
     organisms = ("Human", "Mouse")
+    engines = ("perl", "python", "columnar")
+    outputs = ("sam", "bam")
+    ambiguous_outputs = ("files", "index")
 
     def __init__(self, config):
         # abstract class does some simple initialization for us
@@ -47,6 +123,36 @@ class Disambiguate(AbstractStage):
         self.out_dir = os.path.join(config["dir"].get("results", "results"),
                                     self.stage)
         self.program = self.stage_config.get("program", "disamb_byMapping2.pl")
+        self.engine = self.stage_config.get("engine", "perl")
+        if self.engine not in self.engines:
+            logger.error("Disambiguation engine %s is not one of %s, "
+                         "aborting." % (self.engine, self.engines))
+            exit(1)
+        self.partitions = int(self.stage_config.get("partitions", 1))
+        if self.partitions > 1 and self.engine != "python":
+            logger.error("Splitting disambiguation into partitions requires "
+                         "the python engine, aborting.")
+            exit(1)
+        self.output = self.stage_config.get("output", "sam")
+        if self.output not in self.outputs:
+            logger.error("Disambiguation output %s is not one of %s, "
+                         "aborting." % (self.output, self.outputs))
+            exit(1)
+        self.ambiguous = self.stage_config.get("ambiguous", "files")
+        if self.ambiguous not in self.ambiguous_outputs:
+            logger.error("Disambiguation ambiguous output %s is not one of "
+                         "%s, aborting." % (self.ambiguous,
+                                            self.ambiguous_outputs))
+            exit(1)
+        if self.ambiguous == "index" and self.engine != "columnar":
+            logger.error("Indexing the ambiguous reads requires the columnar "
+                         "engine, aborting.")
+            exit(1)
+        self.kmer_dir = self.stage_config.get(
+            "kmer_dir", os.path.join(config["dir"].get("results", "results"),
+                                     "kmer_classify"))
+        # threads compressing the BAM output
+        self.threads = bam.stage_threads(config, self.stage)
         safe_makedir(self.out_dir)
 
     def out_file(self, in_tuple):
@@ -54,8 +160,24 @@ class Disambiguate(AbstractStage):
         returns the set of output filenames that will be made from
         running this stage on a set of input files
         """
-        return map(self._disambiguate_to_bipy,
-                   self._disambiguate_out(in_tuple))
+        out_files = map(self._disambiguate_to_bipy,
+                        self._disambiguate_out(in_tuple))
+        if self.output == "bam":
+            out_files = [os.path.splitext(x)[0] + ".sorted.bam"
+                         for x in out_files]
+        if self.ambiguous == "index":
+            # human, mouse and the index of the ambiguous reads of both
+            out_files = [out_files[0], out_files[2],
+                         self.ambiguous_index(in_tuple)]
+        return out_files
+
+    def ambiguous_index(self, in_files):
+        """
+        the index of the ambiguous reads of a sample
+        """
+        from az import ambiguous
+        return os.path.join(self.out_dir, genome_key(in_files[0]) +
+                            ambiguous.SUFFIX)
 
     def _disambiguate_out(self, in_tuple):
         """
@@ -99,26 +221,274 @@ class Disambiguate(AbstractStage):
         return [os.path.join(self.out_dir, x) for x in
                 (disamb, ambig)]
 
+    def stats_files(self, in_files):
+        """
+        the JSON and table of the disambiguation stats of a sample
+        """
+        prefix = os.path.join(self.out_dir, genome_key(in_files[0]))
+        return [prefix + ".disambiguation_stats.json",
+                prefix + ".disambiguation_stats.tsv"]
+
+    def _add_kmer_decisions(self, stats, in_file):
+        """
+        add the reads of the sample of in_file that were sorted into a
+        genome by their k-mers to stats, if the sample was
+        """
+        decisions = glob.glob(os.path.join(self.kmer_dir,
+                                           "*.kmer_decisions.json"))
+        samples = [(os.path.basename(x)[:-len(".kmer_decisions.json")], x)
+                   for x in decisions]
+        # the longest name the file belongs to, so s1 does not take s10
+        matches = sorted((len(x), x, y) for x, y in samples
+                         if belongs_to(os.path.basename(in_file), x))
+        if matches:
+            from az.plugins.kmer import read_decisions
+            reads = read_decisions(matches[-1][2])
+            for genome in (disambiguation.HUMAN, disambiguation.MOUSE):
+                stats.preclassified[genome] = reads.get(genome, 0)
+        return stats
+
     def _disambiguate(self, org1_sam, org2_sam):
         #run_disambiguate = sh.Command("perl")
         out_files = self.out_file((org1_sam, org2_sam))
-        # if files exist already and are non-zero, skip this step
-        if all(map(file_exists, out_files)):
-            return out_files
+        stats_files = self.stats_files((org1_sam, org2_sam))
+        if self.engine == "python":
+            return self._disambiguate_python(org1_sam, org2_sam, out_files,
+                                             stats_files)
+        if self.engine == "columnar":
+            return self._disambiguate_columnar(org1_sam, org2_sam, out_files,
+                                               stats_files)
 
+        # only the perl engine runs through bcbio, which imports a lot
+        from bcbio.provenance.do import run
         cmd = ["perl", self.program, org1_sam, org2_sam, self.out_dir]
         # disambiguate and return the output filenames
         #run_disambiguate(self.program, org1_sam, org2_sam, self.out_dir)
         run(cmd, "Disambiguation of %s and %s." % (org1_sam, org2_sam), None)
         return out_files
 
+    def _name_sorted(self, in_file):
+        """
+        iterate over the lines of a SAM file sorted by read name in the order
+        the python engine expects. files not already sorted by read name are
+        piped through sort, so no sorted copy is written to disk. a file
+        that claims to be sorted by read name is checked first, samtools and
+        Picard sort the names in other orders
+        """
+        with open(in_file) as in_handle:
+            header, lines = disambiguation.read_sam(in_handle)
+            name_sorted = (disambiguation.is_name_sorted(header) and
+                           disambiguation.in_name_order(lines))
+        if name_sorted:
+            with open(in_file) as in_handle:
+                for line in in_handle:
+                    yield line
+            return
+        for line in header:
+            if line.startswith("@HD"):
+                line = line.replace("SO:coordinate", "SO:queryname")
+            yield line
+        # chained without a shell so the paths are passed on as they are
+        grep = subprocess.Popen(["grep", "-v", "^@", in_file],
+                                stdout=subprocess.PIPE, close_fds=True)
+        env = dict(os.environ, LC_ALL="C")
+        proc = subprocess.Popen(["sort", "-k1,1", "-s", "-T", self.out_dir],
+                                stdin=grep.stdout, stdout=subprocess.PIPE,
+                                env=env, close_fds=True)
+        grep.stdout.close()
+        for line in proc.stdout:
+            yield line
+        # grep exits 1 when every line is a header line
+        if proc.wait() != 0 or grep.wait() > 1:
+            raise subprocess.CalledProcessError(
+                proc.returncode or grep.returncode,
+                "grep -v '^@' %s | LC_ALL=C sort -k1,1 -s -T %s"
+                % (in_file, self.out_dir))
+
+    def _disambiguate_python(self, org1_sam, org2_sam, out_files,
+                             stats_files):
+        """
+        disambiguate with the streaming python engine, writing directly
+        to the final output files
+        """
+        stats = disambiguation.DisambiguationStats()
+        writers = [bam.open_writer(x, self.config, threads=self.threads)
+                   for x in out_files]
+        try:
+            counts = disambiguation.disambiguate(self._name_sorted(org1_sam),
+                                                 self._name_sorted(org2_sam),
+                                                 *writers, stats=stats)
+        except:
+            [x.abort() for x in writers]
+            raise
+        [x.close() for x in writers]
+        self._add_kmer_decisions(stats, org1_sam)
+        stats.write(stats_files[0], stats_files[1], genome_key(org1_sam))
+        logger.info("Disambiguated %s and %s: %s." % (org1_sam, org2_sam,
+                                                       counts))
+        return out_files
+
+    def _disambiguate_columnar(self, org1_sam, org2_sam, out_files,
+                               stats_files):
+        """
+        disambiguate every read at once from the columns of the inputs,
+        writing directly to the final output files
+        """
+        from az import columns
+        stats = disambiguation.DisambiguationStats()
+        index_file = None
+        if self.ambiguous == "index":
+            human_out, mouse_out, index_file = out_files
+            out_files = [human_out, None, mouse_out, None]
+        writers = [bam.open_writer(x, self.config, threads=self.threads)
+                   if x else None for x in out_files]
+        try:
+            counts = columns.disambiguate(org1_sam, org2_sam, *writers,
+                                          config=self.config, stats=stats,
+                                          index_file=index_file)
+        except:
+            [x.abort() for x in writers if x]
+            raise
+        [x.close() for x in writers if x]
+        self._add_kmer_decisions(stats, org1_sam)
+        stats.write(stats_files[0], stats_files[1], genome_key(org1_sam))
+        logger.info("Disambiguated %s and %s: %s." % (org1_sam, org2_sam,
+                                                       counts))
+        if index_file:
+            return [human_out, mouse_out, index_file]
+        return out_files
+
+    def _partition_dir(self, in_files):
+        base, _ = os.path.splitext(os.path.basename(in_files[0]))
+        return os.path.join(self.out_dir, "partitions", base)
+
+    def _partition_files(self, in_file, out_dir):
+        base, ext = os.path.splitext(os.path.basename(in_file))
+        return [os.path.join(out_dir, "%s.part%03d%s" % (base, x, ext))
+                for x in range(self.partitions)]
+
+    def partition(self, in_files):
+        """
+        split a (human, mouse) tuple of SAM files into partitions by hashing
+        the read names, so all alignments of a read land in the same
+        partition. returns a list of (human, mouse) tuples, one per partition
+        """
+        partition_dir = self._partition_dir(in_files)
+        split_files = []
+        for in_file, organism in zip(in_files, self.organisms):
+            out_dir = safe_makedir(os.path.join(partition_dir,
+                                                organism.lower()))
+            out_files = self._partition_files(in_file, out_dir)
+            if not all(map(file_exists, out_files)):
+                self._split_by_name(in_file, out_files)
+            split_files.append(out_files)
+        return zip(*split_files)
+
+    def _split_by_name(self, in_file, out_files):
+        tmp_files = [x + ".tmp" for x in out_files]
+        out_handles = [open(x, "w") for x in tmp_files]
+        try:
+            with open(in_file) as in_handle:
+                header, lines = disambiguation.read_sam(in_handle)
+                [x.writelines(header) for x in out_handles]
+                for line in lines:
+                    name = disambiguation.read_name(line)
+                    index = (zlib.crc32(name) & 0xffffffff) % len(out_handles)
+                    out_handles[index].write(line)
+        finally:
+            [x.close() for x in out_handles]
+        [os.rename(x[0], x[1]) for x in zip(tmp_files, out_files)]
+
+    def _partition_out(self, in_files):
+        out_dir = os.path.dirname(os.path.dirname(in_files[0]))
+        return [os.path.join(out_dir, os.path.basename(x)) for x in
+                self._disambiguate_out(in_files)]
+
+    def disambiguate_partition(self, in_files):
+        """
+        disambiguate a single (human, mouse) partition made by partition,
+        the results are kept next to the partition
+        """
+        out_files = self._partition_out(in_files)
+        stats_files = self._partition_stats(out_files)
+        if all(map(file_exists, out_files + stats_files)):
+            return out_files
+        return self._disambiguate_python(in_files[0], in_files[1], out_files,
+                                         stats_files)
+
+    def _partition_stats(self, partition_out):
+        return [partition_out[0] + ".stats.json",
+                partition_out[0] + ".stats.tsv"]
+
+    def combine_partitions(self, in_files, partition_out):
+        """
+        concatenate the disambiguated partitions of a (human, mouse) tuple
+        into the final output files and remove the partitions
+        """
+        out_files = self.out_file(in_files)
+        for i, out_file in enumerate(out_files):
+            parts = [x[i] for x in partition_out]
+            with bam.open_writer(out_file, self.config,
+                                 threads=self.threads) as out_handle:
+                for n, part in enumerate(parts):
+                    with open(part) as in_handle:
+                        header, lines = disambiguation.read_sam(in_handle)
+                        if n == 0:
+                            out_handle.writelines(header)
+                        out_handle.writelines(lines)
+        stats = disambiguation.DisambiguationStats()
+        for part in partition_out:
+            stats.merge(disambiguation.DisambiguationStats.load(
+                self._partition_stats(part)[0]))
+        self._add_kmer_decisions(stats, in_files[0])
+        stats_files = self.stats_files(in_files)
+        stats.write(stats_files[0], stats_files[1], genome_key(in_files[0]))
+        shutil.rmtree(self._partition_dir(in_files))
+        return out_files
+
+    def _finalize(self, in_file, out_file):
+        """
+        move a SAM file written by the disambiguation program to its final
+        location, converting it to a sorted BAM file on the way if needed
+        """
+        if self.output == "sam":
+            shutil.move(in_file, out_file)
+            return
+        with open(in_file) as in_handle, \
+                bam.open_writer(out_file, self.config,
+                                threads=self.threads) as out_handle:
+            out_handle.writelines(in_handle)
+        os.remove(in_file)
+
     def __call__(self, in_files):
         setup_local_logging(self.config, self.config["parallel"])
         self._start_message(in_files)
-        # first is human, second is mouse
-        out_files = self._disambiguate(in_files[0], in_files[1])
-        dis_files = self._disambiguate_out(in_files)
-        if all(map(file_exists, dis_files)):
-            [shutil.move(x[0], x[1]) for x in zip(dis_files, out_files)]
+        # skip samples the manifest says are done, a truncated output or a
+        # changed input or configuration means the sample is redone
+        manifest = RunManifest(self.config)
+        out_files = manifest.lookup(self.stage, in_files, self)
+        if out_files is None:
+            manifest.invalidate(self.stage, in_files, self)
+            with trace.span(trace.trace_file(self.config), self.stage,
+                            in_files):
+                # first is human, second is mouse
+                out_files = self._disambiguate(in_files[0], in_files[1])
+                dis_files = self._disambiguate_out(in_files)
+                if all(map(file_exists, dis_files)):
+                    [self._finalize(x[0], x[1])
+                     for x in zip(dis_files, out_files)]
+            manifest.record(self.stage, in_files, self, out_files)
         self._end_message(in_files)
         return out_files
+
+
+def partition(in_files, config):
+    return Disambiguate(config).partition(in_files)
+
+
+def disambiguate_partition(in_files, config):
+    return Disambiguate(config).disambiguate_partition(in_files)
+
+
+def combine_partitions(in_files, partition_out, config):
+    return Disambiguate(config).combine_partitions(in_files, partition_out)
@@ -0,0 +1,248 @@
+"""
+sorts the reads of a sample into human, mouse and uncertain by k-mers
+before mapping
+
+"""
+from bipy.pipeline.stages import AbstractStage
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from itertools import izip
+import json
+import multiprocessing
+import os
+from az import kmers
+from az.locking import file_lock
+from az.manifest import fingerprint
+from az.samples import sample_name
+from az.subsample import open_fastq, read_fastq
+
+GENOMES = ("human", "mouse")
+# reads classified at a time
+BATCH_SIZE = 100000
+
+# the index of each worker process, loaded once when the worker starts
+_index = None
+
+
+def _load_worker(index_dir):
+    global _index
+    _index = kmers.KmerIndex.load(index_dir)
+
+
+def _sequences(batch):
+    # the sequences of the mates of each read
+    return [[x[1].strip() for x in y] for y in batch]
+
+
+def _tmp_file(out_file):
+    # keeps the .gz at the end so the file is compressed
+    return os.path.join(os.path.dirname(out_file), "tmp.%d.%s"
+                        % (os.getpid(), os.path.basename(out_file)))
+
+
+def _classify(args):
+    reads, min_hits = args
+    return _index.classify(reads, min_hits)
+
+
+class KmerClassify(AbstractStage):
+    """
+    sorts the reads of a sample by the k-mers only the human or only the
+    mouse reference has, so the reads sure to come from one genome are only
+    mapped to that genome and only the uncertain reads are mapped to both.
+    the human aligner gets the human and uncertain reads and the mouse
+    aligner the mouse and uncertain reads, with the same file names as the
+    input so the samples keep their names. disambiguation then puts the
+    reads only mapped to one genome in that genome, as it does for reads
+    that only align to one of them.
+
+    the stage goes after trimming and before tophat in the run list of both
+    mapping configurations, with genome set to the genome of each. the
+    reads are only classified once, by whichever mapping gets there first
+    while the other waits for it, into results/kmer_classify, where the
+    decisions about each sample are kept in sample.kmer_decisions.json. the references have to be the
+    whole genome FASTA files, never transcript sequences: a mouse read with
+    k-mers that are in the mouse genome but not in the mouse transcripts
+    would be called human and never disambiguated. the index is compiled
+    once under dir: ref when the stage is made, before any jobs start:
+
+    stage:
+        kmer_classify:
+            genome: human
+            human: /path/to/GRCh37/Sequence/WholeGenomeFasta/genome.fa
+            mouse: /path/to/NCBIM37/Sequence/WholeGenomeFasta/genome.fa
+            k: 31  # at most 32
+            sample: 8  # keep one in sample of the k-mers
+            min_hits: 2  # k-mers of one genome to be sure of a read
+            processes: 4  # processes classifying the reads of a sample
+
+    example:
+    stage_runner = KmerClassify(config)
+    stage_runner(["ctrl_1.fq", "ctrl_2.fq"]) ->
+    ["results/kmer_classify/human/ctrl_1.fq",
+     "results/kmer_classify/human/ctrl_2.fq"]
+    """
+
+    stage = "kmer_classify"
+
+    def __init__(self, config):
+        super(KmerClassify, self).__init__(config)
+        self.config = config
+        self.stage_config = config["stage"][self.stage]
+        self.genome = self.stage_config.get("genome")
+        if self.genome not in GENOMES:
+            logger.error("The genome of the %s stage has to be one of %s, "
+                         "aborting." % (self.stage, GENOMES))
+            exit(1)
+        self.references = [self.stage_config.get(x) for x in GENOMES]
+        if not all(self.references):
+            logger.error("The %s stage needs a human and a mouse reference "
+                         "FASTA file, aborting." % (self.stage))
+            exit(1)
+        self.k = int(self.stage_config.get("k", kmers.DEFAULT_K))
+        if not 0 < self.k <= 32:
+            logger.error("k-mers of %d bases do not fit in 64 bits, "
+                         "aborting." % (self.k))
+            exit(1)
+        self.sample = int(self.stage_config.get("sample",
+                                                kmers.DEFAULT_SAMPLE))
+        self.min_hits = int(self.stage_config.get("min_hits",
+                                                  kmers.DEFAULT_MIN_HITS))
+        self.processes = int(self.stage_config.get("processes", 1))
+        # only lowered by the tests, smaller references are not genomes
+        self.min_bases = int(self.stage_config.get("min_bases",
+                                                   kmers.MIN_GENOME_BASES))
+        results_dir = config["dir"].get("results", "results")
+        self.out_dir = os.path.join(os.path.dirname(results_dir.rstrip("/")),
+                                    self.stage)
+        # compile the index once here so the jobs only have to load it
+        try:
+            self.index_dir = kmers.compile_index(
+                self.references[0], self.references[1],
+                config["dir"].get("ref", "ref"), self.k, self.sample,
+                self.min_bases)
+        except ValueError as e:
+            logger.error("%s Aborting." % (e))
+            exit(1)
+
+    def _out_files(self, in_files, genome):
+        return [os.path.join(self.out_dir, genome, os.path.basename(x))
+                for x in in_files]
+
+    def decisions_file(self, in_files):
+        return os.path.join(self.out_dir,
+                            sample_name(in_files) + ".kmer_decisions.json")
+
+    def _params(self, in_files):
+        return {"inputs": [fingerprint(x) for x in in_files],
+                # named by hashes of all of the references
+                "index": os.path.basename(self.index_dir),
+                "k": self.k, "sample": self.sample,
+                "min_hits": self.min_hits}
+
+    def _is_done(self, in_files):
+        decisions_file = self.decisions_file(in_files)
+        if not os.path.exists(decisions_file):
+            return False
+        with open(decisions_file) as in_handle:
+            decisions = json.load(in_handle)
+        out_files = sum([self._out_files(in_files, x) for x in GENOMES], [])
+        return (decisions["params"] == self._params(in_files) and
+                all(map(os.path.exists, out_files)))
+
+    def _batches(self, records):
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _decide(self, index_dir, batches):
+        """
+        yields each batch of records with the class code of each record
+        """
+        # pools can not be started in the daemonic workers of a local view
+        daemon = multiprocessing.current_process().daemon
+        if self.processes < 2 or daemon:
+            _load_worker(index_dir)
+            for batch in batches:
+                yield batch, _classify((_sequences(batch), self.min_hits))
+            return
+        pool = multiprocessing.Pool(self.processes, _load_worker,
+                                    (index_dir,))
+        try:
+            pending = []
+            for batch in batches:
+                pending.append((batch, pool.apply_async(
+                    _classify, ((_sequences(batch), self.min_hits),))))
+                # keep every process busy without reading the whole sample
+                if len(pending) > self.processes:
+                    done, result = pending.pop(0)
+                    yield done, result.get()
+            for done, result in pending:
+                yield done, result.get()
+        finally:
+            pool.terminate()
+
+    def classify(self, in_files):
+        """
+        write the reads of in_files, a FASTQ file or the two of a pair, for
+        each genome and the decisions about them
+        """
+        out_files = dict((x, self._out_files(in_files, x)) for x in GENOMES)
+        [safe_makedir(os.path.join(self.out_dir, x)) for x in GENOMES]
+        in_handles = [open_fastq(x) for x in in_files]
+        out_handles = dict((x, [open_fastq(_tmp_file(y), "w")
+                                for y in out_files[x]]) for x in GENOMES)
+        counts = dict((x, 0) for x in kmers.CLASSES)
+        try:
+            records = izip(*map(read_fastq, in_handles))
+            for batch, codes in self._decide(self.index_dir,
+                                              self._batches(records)):
+                for record, code in izip(batch, codes.tolist()):
+                    counts[kmers.CLASSES[code]] += 1
+                    for genome in GENOMES:
+                        if code in (kmers.UNCERTAIN_CODE,
+                                    GENOMES.index(genome)):
+                            [x.writelines(y) for x, y in
+                             zip(out_handles[genome], record)]
+        finally:
+            [x.close() for x in in_handles]
+            [x.close() for y in out_handles.values() for x in y]
+        for genome in GENOMES:
+            [os.rename(_tmp_file(x), x) for x in out_files[genome]]
+        decisions_file = self.decisions_file(in_files)
+        with open(_tmp_file(decisions_file), "w") as out_handle:
+            json.dump({"sample": sample_name(in_files), "reads": counts,
+                       "outputs": out_files,
+                       "params": self._params(in_files)}, out_handle,
+                      indent=2)
+        os.rename(_tmp_file(decisions_file), decisions_file)
+        logger.info("Classified the reads of %s by k-mers: %s."
+                    % (in_files, counts))
+        return out_files
+
+    def __call__(self, in_files):
+        single = isinstance(in_files, basestring)
+        in_files = [in_files] if single else list(in_files)
+        self._start_message(in_files)
+        # the human and mouse mapping both run this stage, often at the same
+        # time, whichever gets there first does the work
+        with file_lock(self.decisions_file(in_files) + ".lock"):
+            if not self._is_done(in_files):
+                self.classify(in_files)
+        out_files = self._out_files(in_files, self.genome)
+        self._end_message(in_files)
+        return out_files[0] if single else out_files
+
+
+def read_decisions(decisions_file):
+    """
+    the number of reads of a sample classified as human, mouse and uncertain
+    """
+    with open(decisions_file) as in_handle:
+        return dict((str(x), y) for x, y in
+                    json.load(in_handle)["reads"].items())
@@ -0,0 +1,83 @@
+"""
+RNA-seq quality metrics for each BAM file from one pass over it, replacing
+the separate bam_stat, geneBody_coverage, junction_annotation and RPKM_count
+runs of the rseqc stage
+
+"""
+from bipy.pipeline.stages import AbstractStage
+from bcbio.utils import safe_makedir
+from az.annotation import compile_transcripts, load_transcripts
+from az.qc import (BamStat, GeneBodyCoverage, JunctionAnnotation, RPKMCount,
+                   run_metrics, MAPQ_CUT)
+from az import bam
+import os
+
+
+class RseqcMetrics(AbstractStage):
+    """
+    computes the metrics of bam_stat.py, geneBody_coverage.py,
+    junction_annotation.py and RPKM_count.py reading each BAM file once and
+    writes them in the same formats. the RPKM table can be passed on to
+    rseqc.fix_RPKM_count_file as before. the transcripts of the annotation
+    are compiled once under dir: ref. turn it on with engine: native:
+
+    stage:
+        rseqc:
+            name: rseqc
+            engine: native
+            mapq: 30  # reads with a lower mapping quality are not unique
+
+    example:
+    metrics = RseqcMetrics(config)
+    metrics("sample.sorted.bam") -> ["sample.bam_stat.txt",
+    "sample.geneBodyCoverage.txt", "sample.junction.xls",
+    "sample_read_count.xls"] in results/rseqc/sample
+    """
+
+    stage = "rseqc"
+
+    def __init__(self, config):
+        super(RseqcMetrics, self).__init__(config)
+        self.config = config
+        self.stage_config = config["stage"][self.stage]
+        self.threads = bam.stage_threads(config, self.stage)
+        self.mapq = int(self.stage_config.get("mapq", MAPQ_CUT))
+        self.gtf = self.stage_config.get("gtf", config["annotation"]["file"])
+        self.out_dir = os.path.join(config["dir"].get("results", "results"),
+                                    self.stage)
+        # compile the transcripts once here so the jobs only have to load
+        # them instead of parsing the annotation for every sample
+        self.transcripts_dir = compile_transcripts(
+            self.gtf, config["dir"].get("ref", "ref"))
+
+    def out_prefix(self, in_file):
+        base, _ = os.path.splitext(os.path.basename(in_file))
+        return os.path.join(self.out_dir, base, base)
+
+    def out_file(self, in_file):
+        prefix = self.out_prefix(in_file)
+        return [prefix + ".bam_stat.txt", prefix + ".geneBodyCoverage.txt",
+                prefix + ".junction.xls", prefix + "_read_count.xls"]
+
+    def __call__(self, in_file):
+        self._start_message(in_file)
+        prefix = self.out_prefix(in_file)
+        safe_makedir(os.path.dirname(prefix))
+        transcripts = load_transcripts(self.transcripts_dir)
+        bam_stat = BamStat(self.mapq)
+        coverage = GeneBodyCoverage(transcripts)
+        junctions = JunctionAnnotation(transcripts, self.mapq)
+        rpkm = RPKMCount(transcripts, self.mapq)
+        run_metrics(bam.read_alignments(in_file, self.config, self.threads),
+                    [bam_stat, coverage, junctions, rpkm])
+        out_files = self.out_file(in_file)
+        # write to temporary files first so a killed job leaves nothing
+        # that looks finished
+        tmp_files = [x + ".tmp" for x in out_files]
+        bam_stat.write(tmp_files[0])
+        coverage.write(tmp_files[1], os.path.basename(prefix))
+        junctions.write(tmp_files[2], prefix + ".junction_summary.txt")
+        rpkm.write(tmp_files[3])
+        [os.rename(x, y) for x, y in zip(tmp_files, out_files)]
+        self._end_message(in_file)
+        return out_files
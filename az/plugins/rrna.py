@@ -0,0 +1,62 @@
+"""
+the fraction of reads in each BAM file from ribosomal RNA, the mitochondria
+and each chromosome
+
+"""
+from bipy.pipeline.stages import AbstractStage
+from bcbio.utils import safe_makedir
+from az.rrna import FractionCounter, read_interval_list
+from az import bam
+import os
+
+
+class ContaminationFractions(AbstractStage):
+    """
+    counts the reads overlapping the ribosomal intervals of a Picard
+    interval list, the reads on the mitochondrial chromosome and the reads
+    on each chromosome. the intervals default to the ribo file of the
+    rnaseq_metrics stage:
+
+    stage:
+        rrna_fraction:
+            name: rrna_fraction
+            ribo: meta/human_rrna.bed
+
+    example:
+    fractions = ContaminationFractions(config)
+    fractions("sample.sorted.bam") -> ["sample.rrna.txt",
+    "sample.chrom_fractions.txt"] in results/rrna_fraction
+    """
+
+    stage = "rrna_fraction"
+
+    def __init__(self, config):
+        super(ContaminationFractions, self).__init__(config)
+        self.config = config
+        self.stage_config = config["stage"].get(self.stage, {})
+        self.threads = bam.stage_threads(config, self.stage)
+        self.ribo = self.stage_config.get(
+            "ribo", config["stage"].get("rnaseq_metrics", {}).get("ribo"))
+        if not self.ribo:
+            raise ValueError("No ribosomal interval list is set, add ribo "
+                             "to the %s stage." % (self.stage))
+        self.out_dir = os.path.join(config["dir"].get("results", "results"),
+                                    self.stage)
+
+    def out_file(self, in_file):
+        base, _ = os.path.splitext(os.path.basename(in_file))
+        prefix = os.path.join(self.out_dir, base)
+        return [prefix + ".rrna.txt", prefix + ".chrom_fractions.txt"]
+
+    def __call__(self, in_file):
+        self._start_message(in_file)
+        safe_makedir(self.out_dir)
+        counter = FractionCounter(*read_interval_list(self.ribo))
+        counter.count(bam.read_alignments(in_file, self.config,
+                                          self.threads))
+        out_files = self.out_file(in_file)
+        tmp_files = [x + ".tmp" for x in out_files]
+        counter.write(*tmp_files)
+        [os.rename(x, y) for x, y in zip(tmp_files, out_files)]
+        self._end_message(in_file)
+        return out_files
@@ -0,0 +1,465 @@
+"""
+RNA-seq quality metrics computed in a single pass over an alignment file.
+
+the rseqc stage used to run bam_stat, geneBody_coverage, junction_annotation
+and RPKM_count one after the other, each of them decoding the whole BAM file
+again. here each alignment is read once and handed to every metric, and each
+metric writes its results in the layout of the RSeQC program it replaces.
+
+"""
+from collections import defaultdict
+import copy
+import os
+import shutil
+import tempfile
+import numpy as np
+from az.counting import Alignment, aligned_blocks, CIGAR_RE
+
+# RSeQC's default for calling a read uniquely mapped
+MAPQ_CUT = 30
+# junctions with shorter introns are ignored, as in junction_annotation.py
+MIN_INTRON = 50
+# transcripts shorter than this are left out of the gene body coverage
+MIN_MRNA = 100
+
+UNMAPPED, SECONDARY, QC_FAIL, DUPLICATE = 0x4, 0x100, 0x200, 0x400
+# the log the RSeQC programs append to in the current directory
+RSEQC_LOG = "log.txt"
+
+
+def introns(pos, cigar):
+    """
+    yields the zero based half open reference intervals skipped by the N
+    operations of a cigar string
+    """
+    start = pos - 1
+    for length, op in CIGAR_RE.findall(cigar):
+        length = int(length)
+        if op == "N":
+            yield start, start + length
+        if op in "MDN=X":
+            start += length
+
+
+def is_unique(alignment, mapq_cut=MAPQ_CUT):
+    """
+    RSeQC only uses primary, mapped, unique reads that passed QC and are not
+    marked as duplicates
+    """
+    return (not alignment.flag & (UNMAPPED | SECONDARY | QC_FAIL | DUPLICATE)
+            and alignment.mapq >= mapq_cut)
+
+
+class BamStat(object):
+    """
+    the read counts reported by bam_stat.py
+    """
+
+    def __init__(self, mapq_cut=MAPQ_CUT):
+        self.mapq_cut = mapq_cut
+        self.counts = defaultdict(int)
+
+    def add(self, alignment):
+        counts = self.counts
+        flag = alignment.flag
+        counts["total"] += 1
+        if flag & QC_FAIL:
+            counts["qc_fail"] += 1
+        elif flag & DUPLICATE:
+            counts["duplicate"] += 1
+        elif flag & SECONDARY:
+            counts["non_primary"] += 1
+        elif flag & UNMAPPED:
+            counts["unmapped"] += 1
+        elif alignment.mapq < self.mapq_cut:
+            counts["multiple"] += 1
+        else:
+            counts["unique"] += 1
+            if flag & 0x40:
+                counts["read1"] += 1
+            elif flag & 0x80:
+                counts["read2"] += 1
+            counts["reverse" if flag & 0x10 else "forward"] += 1
+            counts["splice" if "N" in alignment.cigar else "non_splice"] += 1
+            if flag & 0x2:
+                counts["proper_pair"] += 1
+                if alignment.mate_chrom != alignment.chrom:
+                    counts["proper_pair_diff_chrom"] += 1
+
+    def write(self, out_file):
+        c = self.counts
+        rows = [("Total records:", c["total"]), None,
+                ("QC failed:", c["qc_fail"]),
+                ("Optical/PCR duplicate:", c["duplicate"]),
+                ("Non primary hits", c["non_primary"]),
+                ("Unmapped reads:", c["unmapped"]),
+                ("mapq < mapq_cut (non-unique):", c["multiple"]), None,
+                ("mapq >= mapq_cut (unique):", c["unique"]),
+                ("Read-1:", c["read1"]),
+                ("Read-2:", c["read2"]),
+                ("Reads map to '+':", c["forward"]),
+                ("Reads map to '-':", c["reverse"]),
+                ("Non-splice reads:", c["non_splice"]),
+                ("Splice reads:", c["splice"]),
+                ("Reads mapped in proper pairs:", c["proper_pair"]),
+                ("Proper-paired reads map to different chrom:",
+                 c["proper_pair_diff_chrom"])]
+        with open(out_file, "w") as out_handle:
+            out_handle.write("\n#" + "=" * 50 + "\n")
+            out_handle.write("#All numbers are READ count\n")
+            out_handle.write("#" + "=" * 50 + "\n\n")
+            for row in rows:
+                out_handle.write("\n" if row is None else "%-40s%d\n" % row)
+        return out_file
+
+
+def _percentile_positions(exons):
+    """
+    the positions of the 1st to the 100th percentile along the exons of a
+    transcript, worked out like RSeQC does from the one based positions of
+    its bases. the interpolated positions can fall between two exons and
+    positions that come out the same are only kept once. returns a sorted
+    numpy array, empty for transcripts that are too short
+    """
+    starts = np.array([x[0] for x in exons], dtype=np.int64)
+    lengths = np.array([x[1] - x[0] for x in exons], dtype=np.int64)
+    length = int(lengths.sum())
+    if length < MIN_MRNA:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    def base(i):
+        # the one based position of the i-th base of the transcript
+        exon = np.searchsorted(offsets, i, side="right") - 1
+        return starts[exon] + i - offsets[exon] + 1
+
+    k = (length - 1) * np.arange(1, 101) / 100.0
+    f, c = np.floor(k), np.ceil(k)
+    # rint rounds halves to the even neighbour like RSeQC on python 3
+    between = np.rint(base(f.astype(np.int64)) * (c - k) +
+                      base(c.astype(np.int64)) * (k - f)).astype(np.int64)
+    positions = np.where(f == c, base(k.astype(np.int64)), between)
+    # back to zero based positions
+    return np.unique(positions) - 1
+
+
+class GeneBodyCoverage(object):
+    """
+    the coverage at each percentile of the length of every transcript, summed
+    over the transcripts, as geneBody_coverage.py reports it. percentiles run
+    from the 5' to the 3' end, so they are flipped for minus strand genes.
+    like the samtools pileup it is based on, bases below a quality of 13 and
+    reads from pairs that are not properly paired are not counted
+    """
+
+    min_base_quality = 13
+
+    def __init__(self, transcripts):
+        # about 100 points for each transcript, kept in arrays rather than
+        # lists so a whole human annotation stays small
+        positions = defaultdict(list)
+        slots = defaultdict(list)
+        for chrom, strand, _, exons in transcripts:
+            chrom_positions = _percentile_positions(exons)
+            chrom_slots = np.arange(len(chrom_positions))
+            if strand == "-":
+                chrom_slots = chrom_slots[::-1]
+            positions[chrom].append(chrom_positions)
+            slots[chrom].append(chrom_slots)
+        self.slots = {}
+        self.positions = {}
+        self.depths = {}
+        for chrom in positions:
+            chrom_positions = np.concatenate(positions[chrom])
+            chrom_slots = np.concatenate(slots[chrom])
+            order = np.lexsort((chrom_slots, chrom_positions))
+            self.positions[chrom] = chrom_positions[order]
+            self.slots[chrom] = chrom_slots[order]
+            self.depths[chrom] = np.zeros(len(order), dtype=np.int64)
+        # the points covered by the first mate of each pair seen so far
+        self.overlapping = {}
+
+    def add(self, alignment):
+        flag = alignment.flag
+        if flag & (UNMAPPED | SECONDARY | QC_FAIL | DUPLICATE):
+            return
+        if flag & 0x1 and not flag & 0x2:
+            return
+        positions = self.positions.get(alignment.chrom)
+        if positions is None or not len(positions):
+            return
+        depths = self.depths[alignment.chrom]
+        minimum = self.min_base_quality
+        covered = self._covered(alignment, positions)
+        mate = self.overlapping.pop(alignment.name, None)
+        if mate is not None:
+            # where the mates of a pair overlap the samtools pileup gives one
+            # of them the summed base quality, or 80% of the higher quality
+            # if the bases disagree, and the other a quality of zero
+            for i, (base, quality) in covered.items():
+                if i not in mate:
+                    if quality >= minimum:
+                        depths[i] += 1
+                    continue
+                mate_base, mate_quality = mate[i]
+                if mate_quality >= minimum:
+                    # already counted when the first mate went by
+                    depths[i] -= 1
+                if base == mate_base:
+                    quality = min(quality + mate_quality, 200)
+                else:
+                    quality = int(0.8 * max(quality, mate_quality))
+                if quality >= minimum:
+                    depths[i] += 1
+            return
+        for i, (_, quality) in covered.items():
+            if quality >= minimum:
+                depths[i] += 1
+        # the file need not be sorted, so keep the points of any mate that
+        # can still overlap the other one
+        if covered and alignment.mate_chrom == alignment.chrom and \
+           not flag & 0x8:
+            self.overlapping[alignment.name] = covered
+
+    def _covered(self, alignment, positions):
+        """
+        returns the indexes of the points covered by an aligned base of the
+        read with the base and its quality
+        """
+        covered = {}
+        seq = alignment.seq
+        qual = alignment.qual
+        start = alignment.pos - 1
+        offset = 0
+        for length, op in CIGAR_RE.findall(alignment.cigar):
+            length = int(length)
+            if op in "M=X":
+                first, last = positions.searchsorted([start, start + length])
+                for i, position in enumerate(
+                        positions[first:last].tolist(), first):
+                    j = offset + position - start
+                    covered[i] = (seq[j] if seq != "*" else "N",
+                                  ord(qual[j]) - 33 if qual != "*" else 255)
+            if op in "MIS=X":
+                offset += length
+            if op in "MDN=X":
+                start += length
+        return covered
+
+    def coverage(self):
+        totals = np.zeros(100, dtype=np.int64)
+        for chrom, depths in self.depths.items():
+            np.add.at(totals, self.slots[chrom], depths)
+        return totals
+
+    def write(self, out_file, sample):
+        with open(out_file, "w") as out_handle:
+            out_handle.write("Percentile\t" +
+                             "\t".join(map(str, range(1, 101))) + "\n")
+            out_handle.write(sample + "\t" +
+                             "\t".join(map(str, map(float, self.coverage())))
+                             + "\n")
+        return out_file
+
+
+class JunctionAnnotation(object):
+    """
+    the splice junctions in the reads and whether each side of them is a
+    known splice site, as junction_annotation.py reports them
+    """
+
+    def __init__(self, transcripts, mapq_cut=MAPQ_CUT):
+        self.mapq_cut = mapq_cut
+        self.known_starts = set()
+        self.known_ends = set()
+        for chrom, _, _, exons in transcripts:
+            chrom = chrom.upper()
+            for (_, end), (start, _) in zip(exons, exons[1:]):
+                self.known_starts.add((chrom, end))
+                self.known_ends.add((chrom, start))
+        self.junctions = defaultdict(int)
+        self.filtered = 0
+
+    def add(self, alignment):
+        if "N" not in alignment.cigar or not is_unique(alignment,
+                                                       self.mapq_cut):
+            return
+        # junction_annotation.py reports chromosome names in upper case
+        chrom = alignment.chrom.upper()
+        for start, end in introns(alignment.pos, alignment.cigar):
+            if end - start >= MIN_INTRON:
+                self.junctions[(chrom, start, end)] += 1
+            else:
+                self.filtered += 1
+
+    def annotate(self, chrom, start, end):
+        known = ((chrom, start) in self.known_starts,
+                 (chrom, end) in self.known_ends)
+        if all(known):
+            return "annotated"
+        if any(known):
+            return "partial_novel"
+        return "complete_novel"
+
+    def write(self, out_file, summary_file):
+        events = defaultdict(int)
+        junctions = defaultdict(int)
+        with open(out_file, "w") as out_handle:
+            out_handle.write("chrom\tintron_st(0-based)\tintron_end(1-based)"
+                             "\tread_count\tannotation\n")
+            for (chrom, start, end), count in sorted(self.junctions.items()):
+                annotation = self.annotate(chrom, start, end)
+                events[annotation] += count
+                junctions[annotation] += 1
+                out_handle.write("%s\t%d\t%d\t%d\t%s\n"
+                                 % (chrom, start, end, count, annotation))
+        # the short introns only count towards the total of the events
+        events["filtered"] = self.filtered
+        with open(summary_file, "w") as out_handle:
+            out_handle.write("=" * 67 + "\n")
+            for kind, totals in (("Events", events),
+                                 ("Junctions", junctions)):
+                out_handle.write("Total splicing  %s:\t%d\n"
+                                 % (kind, sum(totals.values())))
+                out_handle.write("Known Splicing %s:\t%d\n"
+                                 % (kind, totals["annotated"]))
+                out_handle.write("Partial Novel Splicing %s:\t%d\n"
+                                 % (kind, totals["partial_novel"]))
+                out_handle.write("Novel Splicing %s:\t%d\n"
+                                 % (kind, totals["complete_novel"]))
+                if kind == "Events":
+                    out_handle.write("Filtered Splicing Events:\t%d\n"
+                                     % self.filtered)
+                out_handle.write("\n")
+            out_handle.write("=" * 67 + "\n")
+        return out_file
+
+
+def _merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RPKMCount(object):
+    """
+    reads and RPKM for each gene as RPKM_count.py counts them: every aligned
+    block of a unique read is counted by its midpoint and a gene counts the
+    midpoints falling in the union of the exons of its transcripts
+    """
+
+    def __init__(self, transcripts, mapq_cut=MAPQ_CUT):
+        self.mapq_cut = mapq_cut
+        gene_exons = defaultdict(list)
+        for chrom, strand, gene, exons in transcripts:
+            gene_exons[(chrom, strand, gene)].extend(exons)
+        self.genes = sorted(gene_exons)
+        self.exons = defaultdict(list)
+        for i, gene in enumerate(self.genes):
+            gene_exons[gene] = _merge(gene_exons[gene])
+            for start, end in gene_exons[gene]:
+                self.exons[gene[0]].append((start, end, i))
+        self.gene_exons = gene_exons
+        self.counts = np.zeros(len(self.genes), dtype=np.int64)
+        self.total = 0
+        self.chrom = None
+        self.midpoints = []
+
+    def _flush(self):
+        exons = self.exons.get(self.chrom)
+        if exons and self.midpoints:
+            midpoints = np.sort(np.array(self.midpoints, dtype=np.int64))
+            starts, ends, genes = [np.array(x, dtype=np.int64)
+                                   for x in zip(*exons)]
+            found = (np.searchsorted(midpoints, ends) -
+                     np.searchsorted(midpoints, starts))
+            np.add.at(self.counts, genes, found)
+        self.midpoints = []
+
+    def add(self, alignment):
+        if not is_unique(alignment, self.mapq_cut):
+            return
+        self.total += 1
+        if alignment.chrom != self.chrom:
+            self._flush()
+            self.chrom = alignment.chrom
+        for start, end in aligned_blocks(alignment.pos, alignment.cigar):
+            self.midpoints.append(start + (end - start) // 2)
+
+    def write(self, out_file):
+        self._flush()
+        with open(out_file, "w") as out_handle:
+            out_handle.write("#chrom\tst\tend\taccession\tscore\tgene_strand"
+                             "\ttag_count\tRPKM\n")
+            for gene, count in zip(self.genes, self.counts):
+                chrom, strand, name = gene
+                exons = self.gene_exons[gene]
+                length = sum(end - start for start, end in exons)
+                rpkm = (count * 1e9 / (length * self.total)
+                        if self.total and length else 0.0)
+                out_handle.write("%s\t%d\t%d\t%s\t0\t%s\t%d\t%.3f\n"
+                                 % (chrom, exons[0][0], exons[-1][1], name,
+                                    strand, count, rpkm))
+        return out_file
+
+
+def run_metrics(lines, metrics):
+    """
+    hand each alignment in a stream of SAM lines to every metric
+    """
+    adders = [x.add for x in metrics]
+    for line in lines:
+        if line.startswith("@"):
+            continue
+        alignment = Alignment(line)
+        for add in adders:
+            add(alignment)
+    return metrics
+
+
+class KeepRseqcLog(object):
+    """
+    calls fn, one of the bipy.toolbox.rseqc functions, in a temporary
+    directory so the log.txt the RSeQC programs write to the current
+    directory is appended to log_dir/rseqc.log instead of left wherever
+    the engine was started. the input and the directories of the config are
+    made absolute first so they still point to the same place. it keeps the
+    name of fn so the manifest tells the wrapped functions apart
+
+    example:
+    cached_map(view, config, "rseqc",
+               KeepRseqcLog(rseqc.bam_stat, config["log_dir"]),
+               bam_files, [config] * len(bam_files))
+    """
+
+    def __init__(self, fn, log_dir):
+        self.fn = fn
+        self.log_dir = os.path.abspath(log_dir)
+        self.__name__ = fn.__name__
+        self.__module__ = fn.__module__
+
+    def __call__(self, in_file, config):
+        config = copy.deepcopy(config)
+        config["dir"] = dict((x, os.path.abspath(y)) for x, y in
+                             config.get("dir", {}).items())
+        in_file = os.path.abspath(in_file)
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        work_dir = tempfile.mkdtemp(prefix="rseqc.", dir=self.log_dir)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            return self.fn(in_file, config)
+        finally:
+            os.chdir(cwd)
+            log_file = os.path.join(work_dir, RSEQC_LOG)
+            if os.path.exists(log_file):
+                with open(log_file) as in_handle, \
+                        open(os.path.join(self.log_dir, "rseqc.log"),
+                             "a") as out_handle:
+                    shutil.copyfileobj(in_handle, out_handle)
+            shutil.rmtree(work_dir)
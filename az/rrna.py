@@ -0,0 +1,171 @@
+"""
+the fraction of reads coming from ribosomal RNA, from the mitochondria and
+from each chromosome, as a quick check for contamination without running
+picard. the ribosomal intervals come from the same Picard interval lists the
+rnaseq_metrics stage uses, like meta/human_rrna.bed
+
+"""
+from collections import defaultdict
+import numpy as np
+from az.counting import CIGAR_RE, REFERENCE_OPS
+
+# names the mitochondrial chromosome goes by in the references we use
+MITOCHONDRIAL = ("MT", "M", "chrM", "chrMT")
+# alignments are parsed into arrays of this many reads at a time
+BATCH_SIZE = 100000
+SKIPPED = 0x100 | 0x800
+
+
+def read_interval_list(in_file):
+    """
+    reads a Picard interval list, a SAM header followed by one based closed
+    intervals, and returns the sequence names in header order and a dict of
+    chrom -> (starts, ends) numpy arrays of the merged, zero based half open
+    intervals on it
+    """
+    chroms = []
+    intervals = defaultdict(list)
+    with open(in_file) as in_handle:
+        for line in in_handle:
+            if line.startswith("@"):
+                if line.startswith("@SQ"):
+                    tags = dict(x.split(":", 1) for x in
+                                line.rstrip("\n").split("\t")[1:])
+                    chroms.append(tags["SN"])
+                continue
+            fields = line.split("\t")
+            if len(fields) < 3:
+                continue
+            intervals[fields[0]].append((int(fields[1]) - 1, int(fields[2])))
+    merged = {}
+    for chrom, chrom_intervals in intervals.items():
+        starts, ends = [], []
+        for start, end in sorted(chrom_intervals):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        merged[chrom] = (np.array(starts, dtype=np.int64),
+                         np.array(ends, dtype=np.int64))
+    return chroms, merged
+
+
+def reference_length(cigar):
+    return sum(int(length) for length, op in CIGAR_RE.findall(cigar)
+               if op in REFERENCE_OPS)
+
+
+def overlaps(starts, ends, read_starts, read_ends):
+    """
+    returns a boolean array that is True for each read overlapping one of
+    the sorted, non overlapping intervals starts-ends
+    """
+    if not len(starts):
+        return np.zeros(len(read_starts), dtype=bool)
+    # the first interval ending after the read starts is the only candidate
+    i = np.searchsorted(ends, read_starts, side="right")
+    found = i < len(starts)
+    found[found] = starts[i[found]] < read_ends[found]
+    return found
+
+
+class FractionCounter(object):
+    """
+    counts the primary alignments in a stream of SAM lines that are
+    unmapped, that overlap the ribosomal intervals, that are on the
+    mitochondrial chromosome and that are on each chromosome
+
+    example:
+    counter = FractionCounter(*read_interval_list("meta/human_rrna.bed"))
+    counter.count(open("sample.sam"))
+    counter.write("sample.rrna.txt", "sample.chrom_fractions.txt")
+    """
+
+    def __init__(self, chroms, intervals, batch_size=BATCH_SIZE):
+        self.chroms = list(chroms)
+        self.chrom_numbers = dict((x, i) for i, x in enumerate(self.chroms))
+        self.intervals = intervals
+        self.batch_size = batch_size
+        self.chrom_counts = np.zeros(len(self.chroms), dtype=np.int64)
+        self.rrna = 0
+        self.unmapped = 0
+
+    def _chrom_number(self, chrom):
+        if chrom not in self.chrom_numbers:
+            self.chrom_numbers[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+            self.chrom_counts = np.append(self.chrom_counts, 0)
+        return self.chrom_numbers[chrom]
+
+    def _count_batch(self, chroms, starts, ends):
+        chroms = np.array(chroms, dtype=np.int64)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        self.chrom_counts += np.bincount(chroms,
+                                         minlength=len(self.chrom_counts))
+        for chrom in np.unique(chroms):
+            if self.chroms[chrom] not in self.intervals:
+                continue
+            on_chrom = chroms == chrom
+            interval_starts, interval_ends = self.intervals[self.chroms[chrom]]
+            self.rrna += int(overlaps(interval_starts, interval_ends,
+                                      starts[on_chrom],
+                                      ends[on_chrom]).sum())
+
+    def count(self, lines):
+        chroms, starts, ends = [], [], []
+        chrom, chrom_number = None, None
+        for line in lines:
+            if line.startswith("@"):
+                continue
+            fields = line.split("\t", 6)
+            flag = int(fields[1])
+            if flag & SKIPPED:
+                continue
+            if flag & 0x4:
+                self.unmapped += 1
+                continue
+            if fields[2] != chrom:
+                chrom = fields[2]
+                chrom_number = self._chrom_number(chrom)
+            start = int(fields[3]) - 1
+            chroms.append(chrom_number)
+            starts.append(start)
+            ends.append(start + reference_length(fields[5]))
+            if len(chroms) == self.batch_size:
+                self._count_batch(chroms, starts, ends)
+                chroms, starts, ends = [], [], []
+        if chroms:
+            self._count_batch(chroms, starts, ends)
+        return self
+
+    def summary(self):
+        mapped = int(self.chrom_counts.sum())
+        mito = sum(int(self.chrom_counts[self.chrom_numbers[x]])
+                   for x in MITOCHONDRIAL if x in self.chrom_numbers)
+
+        def fraction(count):
+            return float(count) / mapped if mapped else 0.0
+
+        return [("total_reads", mapped + self.unmapped),
+                ("mapped_reads", mapped),
+                ("unmapped_reads", self.unmapped),
+                ("rrna_reads", self.rrna),
+                ("rrna_fraction", fraction(self.rrna)),
+                ("mitochondrial_reads", mito),
+                ("mitochondrial_fraction", fraction(mito))]
+
+    def write(self, summary_file, chrom_file):
+        with open(summary_file, "w") as out_handle:
+            out_handle.write("metric\tvalue\n")
+            for metric, value in self.summary():
+                out_handle.write("%s\t%s\n" % (metric, value))
+        mapped = self.chrom_counts.sum()
+        with open(chrom_file, "w") as out_handle:
+            out_handle.write("chrom\treads\tfraction\n")
+            for chrom, count in zip(self.chroms, self.chrom_counts):
+                out_handle.write("%s\t%d\t%f\n"
+                                 % (chrom, count,
+                                    float(count) / mapped if mapped else 0.0))
+        return summary_file, chrom_file
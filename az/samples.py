@@ -0,0 +1,55 @@
+"""
+helpers for grouping input files by sample
+
+"""
+import os
+import re
+
+
+def _stem(in_file):
+    base, ext = os.path.splitext(os.path.basename(in_file))
+    if ext in (".gz", ".bz2"):
+        base, _ = os.path.splitext(base)
+    return base
+
+
+def sample_name(in_files):
+    """
+    returns the name of the sample a set of files came from, the common
+    prefix of the file names without the read number of paired files:
+    ["ctrl_1.fq", "ctrl_2.fq"] -> "ctrl"
+    ["ctrl_R1.fastq", "ctrl_R2.fastq"] -> "ctrl"
+    """
+    if isinstance(in_files, basestring):
+        in_files = [in_files]
+    stems = map(_stem, in_files)
+    if len(stems) == 1:
+        return stems[0]
+    prefix = os.path.commonprefix(stems)
+    return re.sub(r"[_.-]R?$", "", prefix).rstrip("_.-") or stems[0]
+
+
+def belongs_to(in_file, sample):
+    """
+    returns True if in_file is named after sample, so sample s1 matches
+    s1_1.fq and s1.sam but not s10_1.fq
+    """
+    base = os.path.basename(in_file)
+    if not base.startswith(sample):
+        return False
+    return len(base) == len(sample) or not base[len(sample)].isalnum()
+
+
+def filter_samples(in_files, samples):
+    """
+    keep only the files (or tuples of files, by their first file) that
+    belong to one of samples, keeping every file if no samples are given
+    """
+    if not samples:
+        return in_files
+    keep = []
+    for in_file in in_files:
+        first = in_file if isinstance(in_file, basestring) else in_file[0]
+        if any(belongs_to(first, sample) for sample in samples):
+            keep.append(in_file)
+    return keep
@@ -0,0 +1,385 @@
+"""
+sorting SAM and BAM files by coordinate or by read name within a fixed
+memory budget.
+
+alignments are read into memory until the budget is used up, sorted and
+spilled to a temporary run file, so sorting never holds more than about the
+budget in memory no matter how big the file is. the sorted runs are then
+merged, a limited number at a time, straight into the output file. each run
+stores a small packed sort key in front of every alignment and is compressed
+in blocks, so spilling costs far less disk than the SAM text. the budget and
+where the runs go come from the sort stage:
+
+stage:
+    sort:
+        memory: 2G  # for each sort, size engines so this many fit on a node
+        tmp_dir: /scratch/sort  # defaults to a tmp directory next to the output
+        threads: 4  # threads compressing and decompressing the BAM files
+
+"""
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from az import bam
+
+ORDERS = ("coordinate", "queryname")
+DEFAULT_MEMORY = "768M"
+# rough cost in bytes of holding one alignment in memory on top of its text
+RECORD_OVERHEAD = 200
+# how many runs are merged at once, more than this are merged in passes
+MAX_OPEN_RUNS = 64
+# size of the uncompressed blocks written to the run files
+BLOCK_SIZE = 1024 * 1024
+COORDINATE_RECORD = struct.Struct("<iiBI")
+QUERYNAME_RECORD = struct.Struct("<HBI")
+BLOCK_HEADER = struct.Struct("<I")
+UNMAPPED = 2 ** 31 - 1
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_memory(memory):
+    """
+    bytes in a memory size like 512M or 2G, plain numbers are bytes
+    """
+    memory = str(memory).strip().upper().rstrip("B")
+    if memory and memory[-1] in SIZE_SUFFIXES:
+        return int(float(memory[:-1]) * SIZE_SUFFIXES[memory[-1]])
+    return int(memory)
+
+
+class CoordinateKey(object):
+    """
+    sorts by reference in header order, then position, then strand, with
+    unmapped reads last like samtools sort
+    """
+
+    order = "coordinate"
+    record = COORDINATE_RECORD
+
+    def __init__(self, refs):
+        self.refs = dict((x, i) for i, x in enumerate(refs))
+
+    def key(self, line):
+        fields = line.split("\t", 4)
+        ref = self.refs.get(fields[2], UNMAPPED)
+        if ref == UNMAPPED:
+            return (UNMAPPED, 0, 0)
+        return (ref, int(fields[3]), (int(fields[1]) >> 4) & 1)
+
+    def pack(self, key, line):
+        return self.record.pack(key[0], key[1], key[2], len(line)) + line
+
+    def unpack(self, data, offset):
+        ref, pos, strand, length = self.record.unpack_from(data, offset)
+        start = offset + self.record.size
+        return (ref, pos, strand), data[start:start + length], start + length
+
+
+class QuerynameKey(object):
+    """
+    sorts by read name with the first read of a pair before the second, so
+    the mates of a pair end up next to each other
+    """
+
+    order = "queryname"
+    record = QUERYNAME_RECORD
+
+    def __init__(self, refs):
+        pass
+
+    def key(self, line):
+        name, flag, _ = line.split("\t", 2)
+        return (name, (int(flag) >> 6) & 3)
+
+    def pack(self, key, line):
+        # the name is the start of the line, so only its length is stored
+        return self.record.pack(len(key[0]), key[1], len(line)) + line
+
+    def unpack(self, data, offset):
+        name_length, mate, length = self.record.unpack_from(data, offset)
+        start = offset + self.record.size
+        line = data[start:start + length]
+        return (line[:name_length], mate), line, start + length
+
+
+KEYS = {"coordinate": CoordinateKey, "queryname": QuerynameKey}
+
+
+def _header_refs(header):
+    refs = []
+    for line in header:
+        if line.startswith("@SQ"):
+            for field in line.rstrip("\n").split("\t")[1:]:
+                if field.startswith("SN:"):
+                    refs.append(field[3:])
+    return refs
+
+
+def _set_sort_order(header, order):
+    """
+    the header with its @HD line saying it is sorted in order
+    """
+    hd = "@HD\tVN:1.0\tSO:%s\n" % order
+    if header and header[0].startswith("@HD"):
+        fields = [x for x in header[0].rstrip("\n").split("\t")
+                  if not x.startswith("SO:")]
+        hd = "\t".join(fields + ["SO:%s" % order]) + "\n"
+        return [hd] + header[1:]
+    return [hd] + header
+
+
+def _write_run(records, sort_key, tmp_dir):
+    handle, run_file = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(handle, "wb") as out_handle:
+        block = []
+        size = 0
+        for key, line in records:
+            record = sort_key.pack(key, line)
+            block.append(record)
+            size += len(record)
+            if size >= BLOCK_SIZE:
+                _write_block(out_handle, block)
+                block = []
+                size = 0
+        if block:
+            _write_block(out_handle, block)
+    return run_file
+
+
+def _write_block(out_handle, block):
+    data = zlib.compress("".join(block), 1)
+    out_handle.write(BLOCK_HEADER.pack(len(data)))
+    out_handle.write(data)
+
+
+def _read_run(run_file, sort_key):
+    """
+    yields the (key, line) records of a run file in order
+    """
+    with open(run_file, "rb") as in_handle:
+        while True:
+            header = in_handle.read(BLOCK_HEADER.size)
+            if not header:
+                break
+            data = zlib.decompress(
+                in_handle.read(BLOCK_HEADER.unpack(header)[0]))
+            offset = 0
+            while offset < len(data):
+                key, line, offset = sort_key.unpack(data, offset)
+                yield key, line
+
+
+def _tag(run, i):
+    for key, line in run:
+        yield key, i, line
+
+
+def _merge(runs):
+    """
+    merges sorted (key, line) streams, records with equal keys keep the
+    order of the runs they came from so the sort is stable
+    """
+    tagged = [_tag(run, i) for i, run in enumerate(runs)]
+    for key, _, line in heapq.merge(*tagged):
+        yield key, line
+
+
+class ExternalSorter(object):
+    """
+    sorts a stream of SAM lines in order using at most about memory bytes,
+    spilling sorted runs to tmp_dir
+
+    example:
+    sorter = ExternalSorter("queryname", parse_memory("1G"), "/scratch")
+    with bam.open_writer("sample.namesorted.bam", config, sort=False) as out:
+        out.writelines(sorter.sort(bam.read_alignments("sample.bam", config)))
+    """
+
+    def __init__(self, order="coordinate", memory=parse_memory(DEFAULT_MEMORY),
+                 tmp_dir=None, max_open_runs=MAX_OPEN_RUNS):
+        if order not in ORDERS:
+            raise ValueError("order must be one of %s, not %s."
+                             % (ORDERS, order))
+        self.order = order
+        self.memory = memory
+        self.tmp_dir = tmp_dir
+        self.max_open_runs = max(2, max_open_runs)
+        self.runs = []
+
+    def _spill(self, records, sort_key):
+        records.sort(key=lambda x: x[0])
+        self.runs.append(_write_run(records, sort_key, self.work_dir))
+
+    def _merge_runs(self, sort_key):
+        # merge in passes so no more than max_open_runs are open at once
+        while len(self.runs) > self.max_open_runs:
+            merged = []
+            for i in range(0, len(self.runs), self.max_open_runs):
+                group = self.runs[i:i + self.max_open_runs]
+                merged.append(_write_run(
+                    _merge([_read_run(x, sort_key) for x in group]),
+                    sort_key, self.work_dir))
+                [os.remove(x) for x in group]
+            self.runs = merged
+        return _merge([_read_run(x, sort_key) for x in self.runs])
+
+    def sort(self, lines):
+        """
+        yields the header with its sort order set and then the alignments
+        of lines in order
+        """
+        header = []
+        records = []
+        used = 0
+        sort_key = None
+        self.runs = []
+        self.work_dir = tempfile.mkdtemp(prefix="sort", dir=self.tmp_dir)
+        try:
+            for line in lines:
+                if sort_key is None:
+                    if line.startswith("@"):
+                        header.append(line)
+                        continue
+                    sort_key = KEYS[self.order](_header_refs(header))
+                key = sort_key.key(line)
+                records.append((key, line))
+                used += len(line) + RECORD_OVERHEAD
+                if used >= self.memory:
+                    self._spill(records, sort_key)
+                    records = []
+                    used = 0
+            for line in _set_sort_order(header, self.order):
+                yield line
+            if sort_key is None:
+                return
+            if not self.runs:
+                records.sort(key=lambda x: x[0])
+                for _, line in records:
+                    yield line
+                return
+            if records:
+                self._spill(records, sort_key)
+                records = []
+            for _, line in self._merge_runs(sort_key):
+                yield line
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def _sort_config(config):
+    return config.get("stage", {}).get("sort", {})
+
+
+def sorter_from_config(config, order, out_file):
+    stage_config = _sort_config(config)
+    tmp_dir = stage_config.get("tmp_dir",
+                               os.path.join(os.path.dirname(
+                                   os.path.abspath(out_file)), "tmp"))
+    safe_makedir(tmp_dir)
+    return ExternalSorter(order,
+                          parse_memory(stage_config.get("memory",
+                                                        DEFAULT_MEMORY)),
+                          tmp_dir,
+                          int(stage_config.get("max_open_runs",
+                                               MAX_OPEN_RUNS)))
+
+
+def sort_file(in_file, out_file, config, order="coordinate"):
+    """
+    sorts the SAM or BAM in_file into out_file, BAM output is written with
+    samtools view and indexed if it is sorted by coordinate
+    """
+    if os.path.exists(out_file):
+        return out_file
+    sorter = sorter_from_config(config, order, out_file)
+    threads = bam.stage_threads(config, "sort")
+    with bam.open_writer(out_file, config, sort=False,
+                         index=order == "coordinate",
+                         threads=threads) as out_handle:
+        out_handle.writelines(sorter.sort(bam.read_alignments(in_file, config,
+                                                              threads)))
+    return out_file
+
+
+class UnsortedInput(Exception):
+    pass
+
+
+def _checked_coordinate_order(lines):
+    """
+    passes lines through as long as they are sorted by coordinate and
+    raises UnsortedInput as soon as they are not
+    """
+    header = []
+    sort_key = None
+    last = None
+    for line in lines:
+        if sort_key is None:
+            if line.startswith("@"):
+                header.append(line)
+                yield line
+                continue
+            if not header or "SO:coordinate" not in header[0]:
+                raise UnsortedInput()
+            sort_key = CoordinateKey(_header_refs(header))
+        # samtools and picard do not agree on the order within a position
+        key = sort_key.key(line)[:2]
+        if last is not None and key < last:
+            raise UnsortedInput()
+        last = key
+        yield line
+
+
+def sorted_bam(in_file, config):
+    """
+    makes a coordinate sorted, indexed BAM file from the SAM or BAM output
+    of an aligner in one pass. output that is already sorted is compressed
+    and indexed as it streams by instead of being sorted again, otherwise it
+    is sorted within the memory budget of the sort stage
+    """
+    out_file = _out_file(in_file, ".sorted", ".bam")
+    if os.path.exists(out_file):
+        return out_file
+    threads = bam.stage_threads(config, "sort")
+    try:
+        with bam.open_writer(out_file, config, sort=False,
+                             threads=threads) as out_handle:
+            out_handle.writelines(_checked_coordinate_order(
+                bam.read_alignments(in_file, config, threads)))
+        return out_file
+    except UnsortedInput:
+        logger.info("%s is not sorted by coordinate, sorting it." % in_file)
+    return sort_file(in_file, out_file, config, "coordinate")
+
+
+def _out_file(in_file, suffix, ext):
+    return os.path.splitext(in_file)[0] + suffix + ext
+
+
+def coordinate_sort_sam(in_file, config):
+    """
+    sort a SAM or BAM file by coordinate into a SAM file
+    """
+    return sort_file(in_file, _out_file(in_file, ".sorted", ".sam"), config,
+                     "coordinate")
+
+
+def bamsort(in_file, config):
+    """
+    sort a SAM or BAM file by coordinate into an indexed BAM file
+    """
+    return sort_file(in_file, _out_file(in_file, ".sorted", ".bam"), config,
+                     "coordinate")
+
+
+def bam_name_sort(in_file, config):
+    """
+    sort a SAM or BAM file by read name into a BAM file
+    """
+    return sort_file(in_file, _out_file(in_file, ".namesorted", ".bam"),
+                     config, "queryname")
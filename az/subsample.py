@@ -0,0 +1,161 @@
+"""
+random subsampling of single or paired FASTQ files for test runs of the
+pipeline, keeping the mates of paired reads together
+
+"""
+import gzip
+import json
+import os
+import random
+import zlib
+from itertools import izip
+from bcbio.utils import safe_makedir, file_exists
+from bipy.utils import append_stem
+from az.manifest import fingerprint
+
+# the number of reads kept if the test pipeline does not say how many
+DEFAULT_READS = 250000
+DEFAULT_SEED = 1234
+
+
+def open_fastq(in_file, mode="r"):
+    if in_file.endswith(".gz"):
+        return gzip.open(in_file, mode + "b")
+    return open(in_file, mode)
+
+
+def read_fastq(in_handle):
+    """
+    yields each record of a FASTQ file as a tuple of its four lines
+    """
+    lines = iter(in_handle)
+    for header in lines:
+        yield (header, next(lines), next(lines), next(lines))
+
+
+def read_name(record):
+    """
+    the name of a read without its /1 or /2 mate suffix
+    """
+    name = record[0][1:].split(None, 1)[0]
+    if name[-2:] in ("/1", "/2"):
+        name = name[:-2]
+    return name
+
+
+def _keep_by_hash(name, fraction):
+    return (zlib.crc32(name) & 0xffffffff) < fraction * 0x100000000
+
+
+def sample_fraction(records, fraction):
+    """
+    keep about fraction of the records in a single pass without holding any
+    of them in memory. the decision only depends on the read name, so the
+    same reads are kept from each file of a pair
+    """
+    for record in records:
+        if _keep_by_hash(read_name(record[0]), fraction):
+            yield record
+
+
+def sample_reads(records, reads, seed=DEFAULT_SEED):
+    """
+    keep exactly reads records chosen uniformly at random with reservoir
+    sampling, returned in the order they appeared in the input
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for i, record in enumerate(records):
+        if i < reads:
+            reservoir.append((i, record))
+        else:
+            j = rng.randint(0, i)
+            if j < reads:
+                reservoir[j] = (i, record)
+    reservoir.sort()
+    return [x[1] for x in reservoir]
+
+
+def subsample(in_files, out_files, reads=None, fraction=None,
+              seed=DEFAULT_SEED):
+    """
+    subsample a single FASTQ file or the two files of a pair, either to a
+    fraction of the reads or to a fixed number of reads
+    """
+    in_handles = [open_fastq(x) for x in in_files]
+    try:
+        records = izip(*map(read_fastq, in_handles))
+        if fraction is not None:
+            sampled = sample_fraction(records, fraction)
+        else:
+            sampled = sample_reads(records, reads, seed)
+        out_handles = [open_fastq(x, "w") for x in out_files]
+        try:
+            for record in sampled:
+                for out_handle, mate in zip(out_handles, record):
+                    out_handle.writelines(mate)
+        finally:
+            [x.close() for x in out_handles]
+    finally:
+        [x.close() for x in in_handles]
+    return out_files
+
+
+def _test_file(in_file, out_dir):
+    base = os.path.basename(in_file)
+    if base.endswith(".gz"):
+        base = base[:-3]
+    return os.path.join(out_dir, append_stem(base, "test"))
+
+
+def _params_file(out_files):
+    return out_files[0] + ".params.json"
+
+
+def _made_with(out_files, params):
+    # the subset is only reused if it was taken the same way from the same
+    # inputs, the settings it was taken with are kept next to it
+    params_file = _params_file(out_files)
+    if not all(map(file_exists, out_files + [params_file])):
+        return False
+    with open(params_file) as in_handle:
+        return json.load(in_handle) == params
+
+
+def make_test(in_files, config):
+    """
+    take a random subset of a single FASTQ file or a pair of FASTQ files for
+    testing. how much is kept is set by test_pipeline in the config, a
+    subset made before is reused as long as these settings and the inputs
+    stay the same:
+
+    test_pipeline: True  # keeps 250000 reads
+    test_pipeline:
+      reads: 100000      # or a fraction of them with fraction: 0.01
+      seed: 1234
+    """
+    if isinstance(in_files, basestring):
+        in_files = [in_files]
+    test_config = config.get("test_pipeline", {})
+    if not isinstance(test_config, dict):
+        test_config = {}
+    fraction = test_config.get("fraction")
+    reads = (None if fraction is not None else
+             test_config.get("reads", DEFAULT_READS))
+    params = {"reads": reads, "fraction": fraction,
+              "seed": test_config.get("seed", DEFAULT_SEED),
+              "inputs": [fingerprint(x) for x in in_files]}
+    results_dir = config["dir"]["results"]
+    out_dir = safe_makedir(os.path.join(results_dir, "test", "data"))
+    out_files = [_test_file(x, out_dir) for x in in_files]
+    if _made_with(out_files, params):
+        return out_files
+    tmp_files = [x + ".tmp" for x in out_files]
+    subsample(in_files, tmp_files, reads=reads, fraction=fraction,
+              seed=params["seed"])
+    [os.rename(x[0], x[1]) for x in zip(tmp_files, out_files)]
+    params_file = _params_file(out_files)
+    with open(params_file + ".tmp", "w") as out_handle:
+        json.dump(params, out_handle)
+    os.rename(params_file + ".tmp", params_file)
+    return out_files
@@ -0,0 +1,337 @@
+"""
+synthetic paired end alignments of the same reads to the human and the
+mouse genomes, for testing and benchmarking the pipeline at any size.
+
+each read pair comes from a transcript of a made up gene and is assigned to
+human, mouse or ambiguous. reads from one genome align to it with fewer
+mismatches than to the other genome, or do not align to the other genome at
+all, and ambiguous reads align equally well to both, so the disambiguation
+of every read is known. some reads are multimappers with extra secondary
+alignments. the reads are spliced across the exons of their transcript, so
+the files and the GTF files of the genes also work for counting and QC.
+
+the pairs are written in read name order as they are made, so even 100
+million of them are generated without holding them in memory. coordinate
+sorted files are sorted afterwards within a memory budget.
+
+"""
+import os
+import random
+from bcbio.utils import safe_makedir
+from az import bam, disambiguation
+from az.sorting import ExternalSorter, parse_memory, DEFAULT_MEMORY
+
+SORT_ORDERS = ("queryname", "coordinate", "unsorted")
+DEFAULT_SEED = 1234
+READ_LENGTH = 90
+INSERT_SIZES = (200, 320)
+MAX_GENES = 10000
+# unsorted files are shuffled in windows of this many lines
+SHUFFLE_WINDOW = 100000
+# random sequences and qualities the reads are drawn from
+POOL_SIZE = 4096
+GENOMES = {
+    disambiguation.HUMAN: [("1", 249250621), ("2", 243199373),
+                           ("3", 198022430), ("X", 155270560),
+                           ("MT", 16569)],
+    disambiguation.MOUSE: [("1", 195471971), ("2", 182113224),
+                           ("3", 160039680), ("X", 171031299),
+                           ("MT", 16299)]}
+GENE_PREFIX = {disambiguation.HUMAN: "HSG", disambiguation.MOUSE: "MMG"}
+
+
+class Gene(object):
+
+    def __init__(self, gene_id, chrom, strand, exons):
+        self.gene_id = gene_id
+        self.chrom = chrom
+        self.strand = strand
+        # zero based half open exons sorted by position
+        self.exons = exons
+        self.length = sum(end - start for start, end in exons)
+
+    def blocks(self, offset, length):
+        """
+        the one based position and cigar of length bases starting offset
+        bases into the spliced transcript
+        """
+        cigar = []
+        pos = None
+        last_end = None
+        for start, end in self.exons:
+            size = end - start
+            if offset >= size:
+                offset -= size
+                continue
+            block_start = start + offset
+            block = min(length, end - block_start)
+            if pos is None:
+                pos = block_start + 1
+            else:
+                cigar.append("%dN" % (block_start - last_end))
+            cigar.append("%dM" % block)
+            length -= block
+            last_end = block_start + block
+            offset = 0
+            if length == 0:
+                break
+        return pos, "".join(cigar)
+
+
+def make_genes(rand, genome, n):
+    """
+    n genes of two to four exons spread over the chromosomes of genome,
+    far enough apart that they do not overlap
+    """
+    chroms = [x for x in GENOMES[genome] if x[0] != "MT"]
+    genes = []
+    for k in range(n):
+        chrom, _ = chroms[k % len(chroms)]
+        position = 100000 + (k // len(chroms)) * 50000 + rand.randint(0, 20000)
+        exons = []
+        for _ in range(rand.randint(2, 4)):
+            length = rand.randint(150, 400)
+            exons.append((position, position + length))
+            position += length + rand.randint(500, 5000)
+        genes.append(Gene("%s%05d" % (GENE_PREFIX[genome], k), chrom,
+                          rand.choice("+-"), exons))
+    return genes
+
+
+def write_gtf(genes, out_file):
+    with open(out_file, "w") as out_handle:
+        for gene in genes:
+            for i, (start, end) in enumerate(gene.exons):
+                out_handle.write(
+                    "%s\tsynthetic\texon\t%d\t%d\t.\t%s\t.\tgene_id \"%s\"; "
+                    "transcript_id \"%s.1\"; exon_number \"%d\";\n"
+                    % (gene.chrom, start + 1, end, gene.strand, gene.gene_id,
+                       gene.gene_id, i + 1))
+    return out_file
+
+
+def sam_header(genome, sort_order):
+    return (["@HD\tVN:1.0\tSO:%s\n" % sort_order] +
+            ["@SQ\tSN:%s\tLN:%d\n" % x for x in GENOMES[genome]] +
+            ["@PG\tID:synthetic\tPN:az.synthetic\n"])
+
+
+class PairGenerator(object):
+    """
+    makes the alignments of each read pair to both genomes
+
+    example:
+    generator = PairGenerator(ambiguous=0.1, multimap=0.05, genes=500)
+    for name, category, human_lines, mouse_lines in generator.pairs(10000):
+        ...
+    """
+
+    def __init__(self, ambiguous=0.05, multimap=0.02, human=0.5,
+                 other_genome=0.7, genes=None, reads=None,
+                 seed=DEFAULT_SEED):
+        self.rand = random.Random(seed)
+        self.ambiguous = ambiguous
+        self.multimap = multimap
+        self.human = human
+        # how often a read from one genome also aligns to the other one
+        self.other_genome = other_genome
+        if genes is None:
+            genes = min(MAX_GENES, max(50, (reads or 0) // 1000))
+        self.genes = dict((x, make_genes(self.rand, x, genes))
+                          for x in GENOMES)
+        self.seqs = ["".join(self.rand.choice("ACGT")
+                             for _ in range(READ_LENGTH))
+                     for _ in range(POOL_SIZE)]
+        self.quals = ["".join(chr(self.rand.randint(53, 73))
+                              for _ in range(READ_LENGTH))
+                      for _ in range(POOL_SIZE)]
+
+    def _category(self):
+        x = self.rand.random()
+        if x < self.ambiguous:
+            return disambiguation.AMBIGUOUS
+        if x < self.ambiguous + (1 - self.ambiguous) * self.human:
+            return disambiguation.HUMAN
+        return disambiguation.MOUSE
+
+    def _pair(self, name, gene, mismatches, nh, secondary=False):
+        rand = self.rand
+        insert = min(rand.randint(*INSERT_SIZES), gene.length)
+        length = min(READ_LENGTH, insert)
+        start = rand.randint(0, gene.length - insert)
+        left = gene.blocks(start, length)
+        right = gene.blocks(start + insert - length, length)
+        # the first read is on the left for pairs from the forward strand
+        if rand.random() < 0.5:
+            flags = (99, 147)
+            reads = (left, right)
+        else:
+            flags = (83, 163)
+            reads = (right, left)
+        mapq = 255 if nh == 1 else 3
+        lines = []
+        for i in range(2):
+            pos, cigar = reads[i]
+            mate_pos = reads[1 - i][0]
+            tlen = insert if pos <= mate_pos else -insert
+            seq = self.seqs[rand.randint(0, POOL_SIZE - 1)][:length]
+            qual = self.quals[rand.randint(0, POOL_SIZE - 1)][:length]
+            flag = flags[i] | (0x100 if secondary else 0)
+            lines.append("%s\t%d\t%s\t%d\t%d\t%s\t=\t%d\t%d\t%s\t%s\t"
+                         "NM:i:%d\tNH:i:%d\n"
+                         % (name, flag, gene.chrom, pos, mapq, cigar,
+                            mate_pos, tlen, seq, qual, mismatches[i], nh))
+        return lines
+
+    def _alignments(self, name, genome, k, mismatches, nh):
+        genes = self.genes[genome]
+        lines = self._pair(name, genes[k], mismatches, nh)
+        for _ in range(nh - 1):
+            other = genes[self.rand.randint(0, len(genes) - 1)]
+            lines.extend(self._pair(name, other, mismatches, nh, True))
+        return lines
+
+    def pairs(self, reads):
+        """
+        yields (name, category, human lines, mouse lines) for reads pairs
+        in read name order, the lines of a genome the pair does not align
+        to are empty
+        """
+        rand = self.rand
+        width = len(str(reads))
+        n_genes = len(self.genes[disambiguation.HUMAN])
+        for i in range(reads):
+            name = "SYN:1:%0*d" % (width, i)
+            category = self._category()
+            k = rand.randint(0, n_genes - 1)
+            nh = rand.randint(2, 4) if rand.random() < self.multimap else 1
+            best = (rand.randint(0, 1), rand.randint(0, 1))
+            if category == disambiguation.AMBIGUOUS:
+                yield (name, category,
+                       self._alignments(name, disambiguation.HUMAN, k, best,
+                                        nh),
+                       self._alignments(name, disambiguation.MOUSE, k, best,
+                                        nh))
+                continue
+            other = [] if rand.random() >= self.other_genome else \
+                (best[0] + rand.randint(2, 4), best[1] + rand.randint(2, 4))
+            own = self._alignments(name, category, k, best, nh)
+            other_genome = (disambiguation.MOUSE
+                            if category == disambiguation.HUMAN
+                            else disambiguation.HUMAN)
+            other_lines = (self._alignments(name, other_genome, k, other, nh)
+                           if other else [])
+            if category == disambiguation.HUMAN:
+                yield name, category, own, other_lines
+            else:
+                yield name, category, other_lines, own
+
+
+def _shuffled(lines, rand, window=SHUFFLE_WINDOW):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == window:
+            rand.shuffle(chunk)
+            for x in chunk:
+                yield x
+            chunk = []
+    rand.shuffle(chunk)
+    for x in chunk:
+        yield x
+
+
+def _reorder(in_file, out_file, sort_order, config, memory, seed):
+    """
+    write the name sorted in_file to out_file in sort_order
+    """
+    with open(in_file) as in_handle:
+        header, lines = disambiguation.read_sam(in_handle)
+        header = [x.replace("SO:queryname", "SO:%s" % sort_order)
+                  for x in header]
+        if sort_order == "coordinate":
+            sorter = ExternalSorter("coordinate", memory,
+                                    os.path.dirname(out_file))
+            ordered = sorter.sort(_chain(header, lines))
+        else:
+            ordered = _chain(header, _shuffled(lines, random.Random(seed)))
+        with bam.open_writer(out_file, config, sort=False,
+                             index=sort_order == "coordinate") as out_handle:
+            out_handle.writelines(ordered)
+    return out_file
+
+
+def _chain(header, lines):
+    for line in header:
+        yield line
+    for line in lines:
+        yield line
+
+
+def generate(prefix, reads, ambiguous=0.05, multimap=0.02, human=0.5,
+             sort_order="queryname", output="sam", truth=True,
+             seed=DEFAULT_SEED, config=None, memory=None):
+    """
+    writes prefix.human.sam and prefix.mouse.sam (or .bam) with reads read
+    pairs, the GTF files of the genes they come from and, if truth is set,
+    prefix.truth.txt with the category of each read. returns a dict of the
+    files written
+
+    example:
+    files = generate("bench/s1", 10000, ambiguous=0.1, sort_order="unsorted")
+    files["human"] -> "bench/s1.human.sam"
+    """
+    if sort_order not in SORT_ORDERS:
+        raise ValueError("sort_order must be one of %s, not %s."
+                         % (SORT_ORDERS, sort_order))
+    config = config or {}
+    memory = memory or parse_memory(DEFAULT_MEMORY)
+    safe_makedir(os.path.dirname(os.path.abspath(prefix)))
+    generator = PairGenerator(ambiguous, multimap, human, reads=reads,
+                              seed=seed)
+    files = {}
+    for genome in GENOMES:
+        files[genome + "_gtf"] = write_gtf(generator.genes[genome],
+                                           "%s.%s.gtf" % (prefix, genome))
+        files[genome] = "%s.%s.%s" % (prefix, genome, output)
+    name_sorted = dict((x, "%s.%s.name.sam" % (prefix, x)) for x in GENOMES)
+    if sort_order == "queryname":
+        writers = dict((x, bam.open_writer(files[x], config, sort=False,
+                                           index=False)) for x in GENOMES)
+    else:
+        writers = dict((x, bam.SamWriter(name_sorted[x], config))
+                       for x in GENOMES)
+    truth_handle = None
+    if truth:
+        files["truth"] = prefix + ".truth.txt"
+        truth_handle = open(files["truth"], "w")
+    try:
+        for genome in GENOMES:
+            writers[genome].writelines(sam_header(genome, "queryname"))
+        for name, category, human_lines, mouse_lines in \
+                generator.pairs(reads):
+            writers[disambiguation.HUMAN].writelines(human_lines)
+            writers[disambiguation.MOUSE].writelines(mouse_lines)
+            if truth_handle:
+                truth_handle.write("%s\t%s\n" % (name, category))
+    except:
+        [x.abort() for x in writers.values()]
+        raise
+    finally:
+        if truth_handle:
+            truth_handle.close()
+    [x.close() for x in writers.values()]
+    if sort_order != "queryname":
+        for genome in GENOMES:
+            _reorder(name_sorted[genome], files[genome], sort_order, config,
+                     memory, seed)
+            os.remove(name_sorted[genome])
+    return files
+
+
+def read_truth(in_file):
+    """
+    dict of read name -> category from a truth file written by generate
+    """
+    with open(in_file) as in_handle:
+        return dict(x.rstrip("\n").split("\t") for x in in_handle)
@@ -0,0 +1,351 @@
+"""
+records what each stage costs for each sample, to find out where the time
+of a run goes.
+
+every call of a stage on an input writes a line to a JSON lines file under
+log_dir/trace with its start and end, the wall and CPU time, the CPU time of
+the programs it ran, its peak memory and the bytes it read and wrote. at the
+end of a run the records are turned into a trace that chrome://tracing or
+https://ui.perfetto.dev can show as a timeline, and a summary of the critical
+path, the slowest input of each stage, is written to the log.
+
+the stages of a pipeline script run one after the other and each waits for
+all of its inputs, so the run takes as long as the slowest input of each
+stage added up. those inputs are the critical path.
+
+the unified runner starts one trace for the whole run and hands it to the
+pipelines it runs, which then trace into it instead of starting their own.
+it also records each of its jobs, so the timeline covers the whole run and
+the chain of jobs that decided how long the run took is logged too.
+
+"""
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import resource
+import socket
+import time
+from bcbio.utils import safe_makedir
+from bcbio.log import logger
+from az.samples import sample_name
+
+
+# the stage of the records of the jobs of the unified runner
+JOB_STAGE = "job"
+# runs started by this process, pipelines run as threads of one process can
+# start in the same second
+_runs = itertools.count()
+
+
+def start_run(config, pipeline):
+    """
+    start tracing a run of pipeline, the trace file is kept in the config
+    so it goes along with it to the engines. a config handed a shared
+    trace by the unified runner keeps it
+    """
+    if config.get("trace", {}).get("shared"):
+        return config["trace"]["file"]
+    trace_dir = os.path.join(config.get("log_dir", "log"), "trace")
+    safe_makedir(trace_dir)
+    run = "%s-%s-%d-%d" % (pipeline, time.strftime("%Y%m%d-%H%M%S"),
+                           os.getpid(), next(_runs))
+    config["trace"] = {"run": run,
+                       "file": os.path.join(trace_dir, run + ".jsonl")}
+    return config["trace"]["file"]
+
+
+def shared_trace(config):
+    """
+    the trace of a run started with start_run, for handing to the pipelines
+    that run as part of it
+    """
+    return dict(config["trace"], shared=True)
+
+
+def trace_file(config):
+    return config.get("trace", {}).get("file")
+
+
+def _proc_values(proc_file, names, sep=":"):
+    values = {}
+    try:
+        with open(proc_file) as in_handle:
+            for line in in_handle:
+                name, _, value = line.partition(sep)
+                if name in names:
+                    values[name] = int(value.split()[0])
+    except IOError:
+        pass
+    return values
+
+
+def _reset_peak_rss():
+    # since linux 4.0 the peak RSS of a process can be reset, so the peak of
+    # a long running engine is the peak of this call and not of every call
+    # before it
+    try:
+        with open("/proc/self/clear_refs", "w") as out_handle:
+            out_handle.write("5")
+        return True
+    except IOError:
+        return False
+
+
+def _usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # rchar and wchar are what the process read and wrote, read_bytes and
+    # write_bytes what had to go to the disk. both include the programs it
+    # ran once they have finished
+    io = _proc_values("/proc/self/io", ("rchar", "wchar", "read_bytes",
+                                        "write_bytes"))
+    return {"time": time.time(),
+            "cpu": self_usage.ru_utime + self_usage.ru_stime,
+            "subprocess_cpu": children.ru_utime + children.ru_stime,
+            "subprocess_max_rss_kb": children.ru_maxrss,
+            "max_rss_kb": self_usage.ru_maxrss,
+            "io": io}
+
+
+def _label(item):
+    if item is None:
+        return None
+    try:
+        if isinstance(item, basestring):
+            return sample_name(item)
+        return sample_name([x for x in item if isinstance(x, basestring)])
+    except (TypeError, ValueError):
+        return str(item)
+
+
+def _record(before, after, stage, label, error, peak_reset):
+    io_before, io_after = before["io"], after["io"]
+    hwm = _proc_values("/proc/self/status", ("VmHWM",))
+    record = {"stage": stage,
+              "item": label,
+              "host": socket.gethostname(),
+              "pid": os.getpid(),
+              "start": before["time"],
+              "end": after["time"],
+              "wall": after["time"] - before["time"],
+              "cpu": after["cpu"] - before["cpu"],
+              "subprocess_cpu": (after["subprocess_cpu"] -
+                                 before["subprocess_cpu"]),
+              "max_rss_kb": (hwm["VmHWM"] if peak_reset and "VmHWM" in hwm
+                             else after["max_rss_kb"]),
+              # the largest program run by this process so far, the peak
+              # of programs can not be reset
+              "subprocess_max_rss_kb": after["subprocess_max_rss_kb"],
+              "read_bytes": (io_after.get("rchar", 0) -
+                             io_before.get("rchar", 0)),
+              "write_bytes": (io_after.get("wchar", 0) -
+                              io_before.get("wchar", 0)),
+              "disk_read_bytes": (io_after.get("read_bytes", 0) -
+                                  io_before.get("read_bytes", 0)),
+              "disk_write_bytes": (io_after.get("write_bytes", 0) -
+                                   io_before.get("write_bytes", 0)),
+              "error": error}
+    return record
+
+
+def _write(out_file, record):
+    # a single short write to a file opened for appending does not get
+    # mixed up with the writes of other engines
+    line = json.dumps(record, sort_keys=True) + "\n"
+    fd = os.open(out_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(out_file, stage, item=None, label=None):
+    """
+    records the resources used by the block as a call of stage on item,
+    named by label or the sample of item. nothing is recorded if out_file
+    is None
+
+    example:
+    with span(trace_file(config), "disambiguate", in_files):
+        out_files = self._disambiguate(*in_files)
+    """
+    if not out_file:
+        yield
+        return
+    peak_reset = _reset_peak_rss()
+    before = _usage()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        try:
+            _write(out_file, _record(before, _usage(), stage,
+                                     label or _label(item), error,
+                                     peak_reset))
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the trace of %s: %s"
+                           % (stage, e))
+
+
+class Traced(object):
+    """
+    calls fn recording a span for each call, for handing to view.map. the
+    calls are named by label if it is given, by the sample of their first
+    argument otherwise
+    """
+
+    def __init__(self, fn, stage, out_file, label=None):
+        self.fn = fn
+        self.stage = stage
+        self.out_file = out_file
+        self.label = label
+
+    def __call__(self, *args):
+        with span(self.out_file, self.stage, args[0] if args else None,
+                  self.label):
+            return self.fn(*args)
+
+
+def traced(config, stage, fn):
+    """
+    fn wrapped to record its calls if the run is being traced. stages that
+    record themselves set records_trace and are left alone
+    """
+    out_file = trace_file(config)
+    if not out_file or getattr(fn, "records_trace", False):
+        return fn
+    return Traced(fn, stage, out_file)
+
+
+def read_records(in_file):
+    if not os.path.exists(in_file):
+        return []
+    with open(in_file) as in_handle:
+        return [json.loads(x) for x in in_handle if x.strip()]
+
+
+def chrome_trace(records, out_file):
+    """
+    write records as a trace in the chrome trace event format, with a row
+    for each engine
+    """
+    if not records:
+        return None
+    origin = min(x["start"] for x in records)
+    engines = sorted(set((x["host"], x["pid"]) for x in records))
+    numbers = dict((x, i) for i, x in enumerate(engines))
+    events = [{"name": "process_name", "ph": "M", "pid": numbers[x], "tid": 0,
+               "args": {"name": "%s:%d" % x}} for x in engines]
+    for record in records:
+        args = dict((k, v) for k, v in record.items()
+                    if k not in ("start", "end", "host", "pid"))
+        events.append({"name": "%s %s" % (record["stage"],
+                                          record["item"] or ""),
+                       "cat": record["stage"],
+                       "ph": "X",
+                       "ts": int((record["start"] - origin) * 1e6),
+                       "dur": int(record["wall"] * 1e6),
+                       "pid": numbers[(record["host"], record["pid"])],
+                       "tid": 0,
+                       "args": args})
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, "w") as out_handle:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                  out_handle)
+    os.rename(tmp_file, out_file)
+    return out_file
+
+
+def critical_path(records):
+    """
+    the slowest call of each stage, in the order the stages started
+    """
+    stages = {}
+    for record in records:
+        stages.setdefault(record["stage"], []).append(record)
+    path = [max(x, key=lambda r: r["wall"]) for x in stages.values()]
+    return sorted(path, key=lambda x: min(r["start"] for r in
+                                          stages[x["stage"]])), stages
+
+
+def summary(records):
+    """
+    lines of a table with a row for each stage, the critical path marked by
+    its slowest input
+    """
+    if not records:
+        return []
+    path, stages = critical_path(records)
+    run_wall = (max(x["end"] for x in records) -
+                min(x["start"] for x in records))
+    lines = ["%-24s %6s %10s %10s %10s %10s  %-24s %10s %6s"
+             % ("stage", "calls", "wall", "cpu", "sub_cpu", "max_rss_mb",
+                "slowest", "its_wall", "share")]
+    for slowest in path:
+        calls = stages[slowest["stage"]]
+        lines.append("%-24s %6d %10.1f %10.1f %10.1f %10.1f  %-24s %10.1f "
+                     "%5.1f%%"
+                     % (slowest["stage"], len(calls),
+                        sum(x["wall"] for x in calls),
+                        sum(x["cpu"] for x in calls),
+                        sum(x["subprocess_cpu"] for x in calls),
+                        max(max(x["max_rss_kb"], x["subprocess_max_rss_kb"])
+                            for x in calls) / 1024.0,
+                        slowest["item"] or "", slowest["wall"],
+                        100.0 * slowest["wall"] / run_wall
+                        if run_wall else 0.0))
+    lines.append("critical path %.1f s of %.1f s run"
+                 % (sum(x["wall"] for x in path), run_wall))
+    return lines
+
+
+def job_path(records, depends):
+    """
+    the chain of jobs that decided how long a run of dependent jobs took,
+    the job that finished last, the job it waited on that finished last and
+    so on back to the start. depends has the jobs each job waited on
+    """
+    jobs = dict((x["item"], x) for x in records if x["stage"] == JOB_STAGE)
+    if not jobs:
+        return []
+    job = max(jobs.values(), key=lambda x: x["end"])
+    path = [job]
+    while True:
+        before = [jobs[x] for x in depends.get(job["item"], []) if x in jobs]
+        if not before:
+            break
+        job = max(before, key=lambda x: x["end"])
+        path.append(job)
+    return path[::-1]
+
+
+def finish_run(config, depends=None):
+    """
+    write the timeline and the summary of the traced run and log the summary.
+    a shared trace is left to the unified runner, which hands in the jobs
+    each of its jobs depends on
+    """
+    in_file = trace_file(config)
+    if not in_file or config["trace"].get("shared"):
+        return None
+    records = read_records(in_file)
+    prefix = os.path.splitext(in_file)[0]
+    chrome_trace(records, prefix + ".trace.json")
+    # the jobs run the stages, they are summed up on their own
+    lines = summary([x for x in records if x["stage"] != JOB_STAGE])
+    path = job_path(records, depends or {})
+    if path:
+        lines.append("job path %.1f s: %s" % (
+            path[-1]["end"] - path[0]["start"],
+            " -> ".join("%s (%.1f s)" % (x["item"], x["wall"])
+                        for x in path)))
+    with open(prefix + ".summary.txt", "w") as out_handle:
+        out_handle.writelines(x + "\n" for x in lines)
+    for line in lines:
+        logger.info(line)
+    return prefix + ".trace.json"
@@ -22,9 +22,10 @@ from bipy.toolbox.fastq import HardClipper
 from bipy.toolbox.tophat import Tophat
 from bipy.toolbox.rseqc import RNASeqMetrics
 from bipy.plugins import StageRepository
+from az.subsample import make_test
 
 import glob
-from itertools import product, repeat, islice
+from itertools import product, repeat
 import sh
 import os, fnmatch
 
@@ -46,25 +47,6 @@ def find_files(in_dir):
     return files
 
 
-def make_test(in_file, config, lines=1000000):
-    """
-    take a small subset of the input files for testing. only makes sense for
-    text files where lines gives an appopriate number of records, for example,
-    FASTQ files should be a multiple of 4.
-
-    """
-    results_dir = config["dir"]["results"]
-    out_dir = os.path.join(results_dir, "test", "data")
-    safe_makedir(out_dir)
-    out_file = os.path.join(out_dir,
-                            append_stem(os.path.basename(in_file), "test"))
-    with open(in_file) as in_handle, open(out_file, "w") as out_handle:
-        for line in islice(in_handle, lines):
-            out_handle.write(line)
-
-    return out_file
-
-
 def _get_stage_config(config, stage):
     return config["stage"][stage]
 
@@ -103,7 +85,10 @@ def main(config_file):
         results_dir = os.path.join(results_dir, "test_pipeline")
         config["dir"]["results"] = results_dir
         safe_makedir(results_dir)
-        curr_files = map(make_test, input_files, [config] * len(input_files))
+        # subsample each sample on its own engine, keeping pairs together
+        test_files = combine_pairs(input_files)
+        curr_files = list(flatten(view.map(make_test, test_files,
+                                           [config] * len(test_files))))
         logger.info("Converted %s to %s. " % (input_files, curr_files))
     else:
         curr_files = input_files
@@ -1,8 +1,168 @@
+"""
+runs the mouse and human mapping, the disambiguation and the mouse and human
+quantitation of every sample, each sample moving on as soon as its own
+inputs are ready.
+
+by default all of the phases run in this process against one view, started
+from the cluster section of the human mapping configuration, so the queue
+wait and the engine start up are only paid once and engines go from one
+phase to the next as soon as they are free. each phase still gets its own
+configuration. --separate runs each phase as its own script instead, once
+for all of the samples, so only the five scripts each start a view and the
+quantitation runs once. the mouse and human mapping run side by side, every
+other phase waits for the whole phase before it.
+
+python az_pipeline_unified.py mouse_mapping.yaml human_mapping.yaml \
+    disambiguate.yaml mouse_quantitation.yaml human_quantitation.yaml
+
+"""
 import sys
-import subprocess
+import copy
 import os
 import argparse
-import time
+import logging
+import multiprocessing
+import yaml
+
+from az.dag import DAGExecutor, CommandJob, FunctionJob
+from az.samples import sample_name
+from az.parallel import pipeline_view, SharedView, CancellableView
+from az import discovery, trace
+
+
+PHASES = ["mouse_mapping", "human_mapping", "disambiguate",
+          "mouse_quantitation", "human_quantitation"]
+
+
+def load_config(config_file):
+    with open(config_file) as in_handle:
+        return yaml.load(in_handle)
+
+
+def find_samples(config):
+    """
+    returns the names of the samples in the input directory of a mapping
+    configuration, paired files belong to the same sample
+    """
+    return map(sample_name, discovery.fastq_samples(config,
+                                                    config["dir"]["data"]))
+
+
+def default_jobs(cluster_config):
+    """
+    as many jobs as the cluster has engines, so each one-sample job can
+    keep an engine busy
+    """
+    cores_per_job = max(1, cluster_config.get("cores_per_job", 1))
+    cores = cluster_config.get("cores")
+    if not cores:
+        cores = multiprocessing.cpu_count()
+    return max(1, cores // cores_per_job)
+
+
+def add_jobs(executor, samples, make_job):
+    """
+    adds the jobs of every phase of every sample to executor, make_job(name,
+    phase, samples, depends) makes the job running phase on samples, all of
+    them if samples is None
+    """
+    quantitation_jobs = {"mouse": [], "human": []}
+    for sample in samples:
+        mapping_jobs = [executor.add(make_job("%s_mapping_%s" % (x, sample),
+                                              "%s_mapping" % x, [sample], []))
+                        for x in ["mouse", "human"]]
+        disambiguation_job = executor.add(
+            make_job("disambiguate_%s" % sample, "disambiguate", [sample],
+                     [x.name for x in mapping_jobs]))
+        for organism in ["mouse", "human"]:
+            job = executor.add(make_job("%s_quantitation_%s"
+                                        % (organism, sample),
+                                        "%s_quantitation" % organism,
+                                        [sample], [disambiguation_job.name]))
+            quantitation_jobs[organism].append(job.name)
+
+    # combine the counts across samples once every sample is quantitated
+    for organism in ["mouse", "human"]:
+        executor.add(make_job("%s_quantitation" % organism,
+                              "%s_quantitation" % organism, None,
+                              quantitation_jobs[organism]))
+
+
+def add_phase_jobs(executor, make_job):
+    """
+    adds one job per phase running it on every sample, for phases that pay
+    for their own view
+    """
+    mapping_jobs = [executor.add(make_job(x, x, None, []))
+                    for x in ["mouse_mapping", "human_mapping"]]
+    executor.add(make_job("disambiguate", "disambiguate", None,
+                          [x.name for x in mapping_jobs]))
+    for organism in ["mouse", "human"]:
+        executor.add(make_job("%s_quantitation" % organism,
+                              "%s_quantitation" % organism, None,
+                              ["disambiguate"]))
+
+
+def run_separate(config_files, max_jobs):
+    """
+    runs every phase as its own script on all of the samples, each script
+    starting its own view
+    """
+    this_path = os.path.abspath(os.path.dirname(__file__))
+    scripts = {"mapping": "mapping.py", "disambiguate": "disambiguate.py",
+               "quantitation": "quantitation.py"}
+
+    def make_job(name, phase, phase_samples, depends):
+        script = os.path.join(this_path, scripts[phase.split("_")[-1]])
+        cmd = ["python", script, config_files[phase]] + (phase_samples or [])
+        return CommandJob(name, cmd, depends=depends)
+
+    executor = DAGExecutor(max_jobs=max_jobs)
+    add_phase_jobs(executor, make_job)
+    return executor.run()
+
+
+def run_in_process(configs, samples, max_jobs):
+    """
+    runs every phase in this process on one view shared by all of them
+    """
+    # only needed here, the phases import the toolboxes they use
+    from bcbio.log import create_base_logger, setup_local_logging
+    import mapping
+    import disambiguate
+    import quantitation
+    mains = {"mapping": mapping.main, "disambiguate": disambiguate.main,
+             "quantitation": quantitation.main}
+    startup_config = configs["human_mapping"]
+    parallel = create_base_logger(startup_config, {"type": "ipython"})
+    setup_local_logging(startup_config, parallel)
+    # one trace for the whole run, the pipelines trace into it
+    run_config = {"log_dir": startup_config.get("log_dir", "log")}
+    trace_file = trace.start_run(run_config, "unified")
+
+    with pipeline_view(startup_config["cluster"]) as view:
+        shared = SharedView(view)
+
+        def make_job(name, phase, phase_samples, depends):
+            # the pipelines change their configuration as they run, so each
+            # job gets a copy of its own
+            config = copy.deepcopy(configs[phase])
+            config["parallel"] = parallel
+            config["trace"] = trace.shared_trace(run_config)
+            # a job cancelled after a failure stops at its next stage
+            job_view = CancellableView(shared)
+            main = trace.Traced(mains[phase.split("_")[-1]], trace.JOB_STAGE,
+                                trace_file, label=name)
+            return FunctionJob(name, main, [config, job_view, phase_samples],
+                               depends=depends, on_cancel=job_view.cancel)
+
+        executor = DAGExecutor(max_jobs=max_jobs)
+        add_jobs(executor, samples, make_job)
+        finished = executor.run()
+    trace.finish_run(run_config, dict((x.name, x.depends)
+                                      for x in executor.jobs.values()))
+    return finished
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='run the AZ mapping '
@@ -18,45 +178,35 @@ if __name__ == "__main__":
                         help="YAML file for running the mouse quantitation.")
     parser.add_argument('human_quantitation',
                         help="YAML file for running the human quantitation.")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Maximum number of jobs to run at once, by "
+                        "default cores / cores_per_job of the cluster of "
+                        "the human mapping. After a failure the running "
+                        "jobs finish the stage they are on before the run "
+                        "stops.")
+
+    parser.add_argument('--separate', action="store_true", default=False,
+                        help="Run each step as its own script on all of the "
+                        "samples with its own cluster instead of sharing "
+                        "one.")
 
     args = parser.parse_args()
-    this_path = os.path.abspath(os.path.dirname(__file__))
-    mapping_script_path = os.path.join(this_path, "mapping.py")
-    mouse_mapping_path = os.path.abspath(args.mouse_mapping)
-    human_mapping_path = os.path.abspath(args.human_mapping)
-    mouse_mapping_cmd = ["python", mapping_script_path, mouse_mapping_path]
-    human_mapping_cmd = ["python", mapping_script_path, human_mapping_path]
-    procs = []
-    for cmd in [mouse_mapping_cmd, human_mapping_cmd]:
-        procs.append(subprocess.Popen(cmd))
-    codes = [p.wait() for p in procs]
-    if not all([c == 0 for c in codes]):
-        print "One of the mapping scripts did not complete properly. Exiting."
-        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    config_files = dict((x, os.path.abspath(getattr(args, x)))
+                        for x in PHASES)
+    configs = dict((x, load_config(y)) for x, y in config_files.items())
+    jobs = args.jobs or default_jobs(configs["human_mapping"]["cluster"])
 
-    procs = []
-    disambiguation_script_path = os.path.join(this_path, "disambiguate.py")
-    disambiguation_path = os.path.abspath(args.disambiguate)
-    disambiguation_cmd = ["python", disambiguation_script_path,
-                          disambiguation_path]
-    for cmd in [disambiguation_cmd]:
-        procs.append(subprocess.Popen(cmd))
-    codes = [p.wait() for p in procs]
-    if not all([c == 0 for c in codes]):
-        print "The disambiguation script did not complete properly. Exiting."
-        sys.exit(1)
+    if args.separate:
+        finished = run_separate(config_files, jobs)
+    else:
+        # each sample moves on to its next step as soon as its own inputs
+        # are ready instead of waiting for every sample to finish each phase
+        samples = find_samples(configs["human_mapping"])
+        finished = run_in_process(configs, samples, jobs)
 
-    procs = []
-    quantitation_script_path = os.path.join(this_path, "quantitation.py")
-    mouse_quantitation_path = os.path.abspath(args.mouse_quantitation)
-    human_quantitation_path = os.path.abspath(args.human_quantitation)
-    mouse_quantitation_cmd = ["python", quantitation_script_path, mouse_quantitation_path]
-    human_quantitation_cmd = ["python", quantitation_script_path, human_quantitation_path]
-    for cmd in [mouse_quantitation_cmd, human_quantitation_cmd]:
-        procs.append(subprocess.Popen(cmd))
-    codes = [p.wait() for p in procs]
-    if not all([c == 0 for c in codes]):
-        print "One of the quantitation scripts did not complete properly. Exiting."
+    if not finished:
+        print "One of the pipeline steps did not complete properly. Exiting."
         sys.exit(1)
 
     print "Run complete."
@@ -0,0 +1,362 @@
+"""
+benchmarks disambiguation, sorting, counting and QC on synthetic human and
+mouse alignments of increasing size, reporting the reads per second and the
+peak memory of each. the results are appended to a JSON lines file, and
+with --baseline they are compared to an earlier run so a change that makes
+a stage slower or bigger fails the benchmark.
+
+the Python disambiguation is checked against the known origin of every
+synthetic read. if perl is around the Perl disamb_byMapping2.pl is run on the
+same reads and how far the two agree is reported for each category.
+
+example:
+python scripts/benchmark.py --reads 10000 100000 1000000 --out-dir bench
+python scripts/benchmark.py --reads 1000000 --baseline bench/results.jsonl
+
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import subprocess
+import sys
+import time
+from distutils.spawn import find_executable
+
+from bcbio.utils import safe_makedir
+from az import columns, disambiguation, synthetic, trace
+from az.annotation import GeneIndex, read_transcripts
+from az.counting import GeneCounter
+from az.qc import (BamStat, GeneBodyCoverage, JunctionAnnotation, RPKMCount,
+                   run_metrics)
+from az.sorting import ExternalSorter, parse_memory
+
+BENCHMARKS = ("disambiguate", "disambiguate_columnar", "disambiguate_perl",
+              "sort", "count", "qc")
+PERL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "disamb_byMapping2.pl")
+# the output files of the perl script and the category they hold
+PERL_OUTPUTS = [("disambiguousHuman", disambiguation.HUMAN),
+                ("disambiguousMouse", disambiguation.MOUSE),
+                ("ambiguousHuman", disambiguation.AMBIGUOUS),
+                ("ambiguousMouse", disambiguation.AMBIGUOUS)]
+
+
+def _read_names(sam_files):
+    names = set()
+    for sam_file in sam_files:
+        with open(sam_file) as in_handle:
+            for line in in_handle:
+                if not line.startswith("@"):
+                    names.add(disambiguation.read_name(line))
+    return names
+
+
+def run_disambiguate(data, out_dir, engine="python"):
+    prefix = os.path.join(out_dir, engine)
+    out_files = dict((x, "%s.%s.sam" % (prefix, x))
+                     for x in ("human", "human_ambiguous", "mouse",
+                               "mouse_ambiguous"))
+    handles = dict((x, open(y, "w")) for x, y in out_files.items())
+    try:
+        if engine == "columnar":
+            # includes writing the columns the first time
+            counts = columns.disambiguate(
+                data["human"], data["mouse"], handles["human"],
+                handles["human_ambiguous"], handles["mouse"],
+                handles["mouse_ambiguous"])
+        else:
+            with open(data["human"]) as human_in, \
+                    open(data["mouse"]) as mouse_in:
+                counts = disambiguation.disambiguate(
+                    human_in, mouse_in, handles["human"],
+                    handles["human_ambiguous"], handles["mouse"],
+                    handles["mouse_ambiguous"])
+    finally:
+        [x.close() for x in handles.values()]
+    return sum(counts.values())
+
+
+def python_categories(out_dir, engine="python"):
+    prefix = os.path.join(out_dir, engine)
+    return {disambiguation.HUMAN: _read_names([prefix + ".human.sam"]),
+            disambiguation.MOUSE: _read_names([prefix + ".mouse.sam"]),
+            disambiguation.AMBIGUOUS: _read_names(
+                [prefix + ".human_ambiguous.sam",
+                 prefix + ".mouse_ambiguous.sam"])}
+
+
+def run_perl(data, out_dir, perl_script=PERL_SCRIPT):
+    perl_dir = os.path.join(out_dir, "perl")
+    safe_makedir(perl_dir)
+    with open(os.path.join(perl_dir, "perl.log"), "w") as log_handle:
+        subprocess.check_call(["perl", perl_script, data["human"],
+                               data["mouse"], perl_dir],
+                              stdout=log_handle, stderr=log_handle)
+    return data["reads"]
+
+
+def perl_categories(data, out_dir):
+    perl_dir = os.path.join(out_dir, "perl")
+    name = os.path.splitext(os.path.basename(data["human"]))[0]
+    categories = dict((x, set()) for _, x in PERL_OUTPUTS)
+    for suffix, category in PERL_OUTPUTS:
+        categories[category].update(_read_names(
+            [os.path.join(perl_dir, "%s.%s.sam" % (name, suffix))]))
+    return categories
+
+
+def run_sort(data, out_dir, memory):
+    sorter = ExternalSorter("coordinate", memory, out_dir)
+    with open(data["human"]) as in_handle, \
+            open(os.path.join(out_dir, "human.sorted.sam"), "w") as out_handle:
+        out_handle.writelines(sorter.sort(in_handle))
+    return data["reads"]
+
+
+def sorted_sam(data, out_dir, memory):
+    """
+    the human alignments sorted by coordinate that counting and QC read,
+    sorting them first when the sort benchmark has not run on this size
+    """
+    out_file = os.path.join(out_dir, "human.sorted.sam")
+    if not os.path.exists(out_file):
+        logging.info("Sorting %s for counting and QC." % data["human"])
+        tmp_file = out_file + ".tmp"
+        sorter = ExternalSorter("coordinate", memory, out_dir)
+        with open(data["human"]) as in_handle, \
+                open(tmp_file, "w") as out_handle:
+            out_handle.writelines(sorter.sort(in_handle))
+        os.rename(tmp_file, out_file)
+    return out_file
+
+
+def run_count(data, out_dir):
+    counter = GeneCounter(GeneIndex.from_gtf(data["human_gtf"]),
+                          stranded="no")
+    with open(os.path.join(out_dir, "human.sorted.sam")) as in_handle:
+        counter.count(in_handle)
+    counter.write(os.path.join(out_dir, "human.counts"))
+    return data["reads"]
+
+
+def run_qc(data, out_dir):
+    transcripts = read_transcripts(data["human_gtf"])
+    metrics = [BamStat(), GeneBodyCoverage(transcripts),
+               JunctionAnnotation(transcripts), RPKMCount(transcripts)]
+    with open(os.path.join(out_dir, "human.sorted.sam")) as in_handle:
+        run_metrics(in_handle, metrics)
+    prefix = os.path.join(out_dir, "human")
+    metrics[0].write(prefix + ".bam_stat.txt")
+    metrics[1].write(prefix + ".geneBodyCoverage.txt", "human")
+    metrics[2].write(prefix + ".junction.xls", prefix + ".junction_summary.txt")
+    metrics[3].write(prefix + "_read_count.xls")
+    return data["reads"]
+
+
+def _child(fn, args, trace_file, name, queue):
+    try:
+        with trace.span(trace_file, name):
+            queue.put((fn(*args), None))
+    except Exception as e:
+        queue.put((None, "%s: %s" % (type(e).__name__, e)))
+
+
+def measure(fn, args, trace_file, name):
+    """
+    runs fn(*args) in a process of its own so its peak memory is its own,
+    returns the trace record of the run and the number of reads fn returned
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child,
+                                      args=(fn, args, trace_file, name, queue))
+    process.start()
+    # a child killed by the OS, say for running out of memory, never puts
+    # anything on the queue
+    while True:
+        try:
+            reads, error = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not process.is_alive() and queue.empty():
+                process.join()
+                raise RuntimeError("%s died with exit code %s"
+                                   % (name, process.exitcode))
+    process.join()
+    if error:
+        raise RuntimeError("%s failed: %s" % (name, error))
+    record = [x for x in trace.read_records(trace_file)
+              if x["stage"] == name][-1]
+    return record, reads
+
+
+def concordance(expected, observed):
+    """
+    for each category the fraction of the reads in either that are in both
+    """
+    result = {}
+    for category in expected:
+        union = expected[category] | observed.get(category, set())
+        both = expected[category] & observed.get(category, set())
+        result[category] = float(len(both)) / len(union) if union else 1.0
+    return result
+
+
+def truth_categories(truth_file):
+    categories = dict((x, set()) for x in (disambiguation.HUMAN,
+                                           disambiguation.MOUSE,
+                                           disambiguation.AMBIGUOUS))
+    for name, category in synthetic.read_truth(truth_file).items():
+        categories[category].add(name)
+    return categories
+
+
+def make_data(args, reads):
+    prefix = os.path.join(args.out_dir, "data", "synthetic_%d_%g_%g_%d"
+                          % (reads, args.ambiguous, args.multimap, args.seed))
+    data = {"human": prefix + ".human.sam", "mouse": prefix + ".mouse.sam",
+            "human_gtf": prefix + ".human.gtf",
+            "mouse_gtf": prefix + ".mouse.gtf",
+            "truth": prefix + ".truth.txt"}
+    # big inputs take a while to make, so they are kept between runs
+    if not all(os.path.exists(x) for x in data.values()):
+        start = time.time()
+        data = synthetic.generate(prefix, reads, args.ambiguous,
+                                  args.multimap, seed=args.seed,
+                                  memory=args.memory)
+        logging.info("Made %d synthetic read pairs in %.1f s."
+                     % (reads, time.time() - start))
+    data["reads"] = reads
+    return data
+
+
+def regressions(results, baseline_file, tolerance):
+    """
+    the results that are slower or use more memory than the last result of
+    the same benchmark and size in baseline_file by more than tolerance
+    """
+    baseline = {}
+    for record in trace.read_records(baseline_file):
+        baseline[(record["benchmark"], record["reads"])] = record
+    found = []
+    for result in results:
+        before = baseline.get((result["benchmark"], result["reads"]))
+        if not before:
+            continue
+        if result["reads_per_s"] < before["reads_per_s"] * (1 - tolerance):
+            found.append("%s on %d reads: %.0f reads/s, was %.0f"
+                         % (result["benchmark"], result["reads"],
+                            result["reads_per_s"], before["reads_per_s"]))
+        if result["max_rss_mb"] > before["max_rss_mb"] * (1 + tolerance):
+            found.append("%s on %d reads: %.1f MB, was %.1f MB"
+                         % (result["benchmark"], result["reads"],
+                            result["max_rss_mb"], before["max_rss_mb"]))
+    return found
+
+
+def run_size(args, reads, trace_file):
+    data = make_data(args, reads)
+    out_dir = os.path.join(args.out_dir, "work", "synthetic_%d" % reads)
+    safe_makedir(out_dir)
+    jobs = [("disambiguate", run_disambiguate, (data, out_dir)),
+            ("disambiguate_columnar", run_disambiguate,
+             (data, out_dir, "columnar")),
+            ("disambiguate_perl", run_perl, (data, out_dir, args.perl)),
+            ("sort", run_sort, (data, out_dir, args.memory)),
+            ("count", run_count, (data, out_dir)),
+            ("qc", run_qc, (data, out_dir))]
+    results = []
+    for name, fn, fn_args in jobs:
+        if name not in args.benchmarks:
+            continue
+        if name == "disambiguate_perl" and not find_executable("perl"):
+            logging.warning("perl is not installed, skipping %s." % name)
+            continue
+        if name in ("count", "qc"):
+            sorted_sam(data, out_dir, args.memory)
+        record, n = measure(fn, fn_args, trace_file, name)
+        max_rss = max(record["max_rss_kb"], record["subprocess_max_rss_kb"])
+        result = {"benchmark": name, "reads": reads,
+                  "wall": record["wall"],
+                  "cpu": record["cpu"] + record["subprocess_cpu"],
+                  "reads_per_s": n / record["wall"] if record["wall"] else 0.0,
+                  "max_rss_mb": max_rss / 1024.0,
+                  "time": record["start"]}
+        logging.info("%-22s %10d reads %8.1f s %10.0f reads/s %8.1f MB"
+                     % (name, reads, result["wall"], result["reads_per_s"],
+                        result["max_rss_mb"]))
+        results.append(result)
+
+    checks = {}
+    if "disambiguate" in args.benchmarks:
+        truth = truth_categories(data["truth"])
+        python = python_categories(out_dir)
+        checks["python_vs_truth"] = concordance(truth, python)
+        if any(x["benchmark"] == "disambiguate_perl" for x in results):
+            perl = perl_categories(data, out_dir)
+            checks["perl_vs_truth"] = concordance(truth, perl)
+            checks["python_vs_perl"] = concordance(python, perl)
+    if "disambiguate_columnar" in args.benchmarks:
+        checks["columnar_vs_truth"] = concordance(
+            truth_categories(data["truth"]),
+            python_categories(out_dir, "columnar"))
+    for check, values in sorted(checks.items()):
+        logging.info("%-22s %s" % (check, " ".join(
+            "%s %.4f" % x for x in sorted(values.items()))))
+    return results, checks
+
+
+def main(args):
+    safe_makedir(args.out_dir)
+    trace_file = os.path.join(args.out_dir, "trace.jsonl")
+    results_file = os.path.join(args.out_dir, "results.jsonl")
+    results = []
+    failed = []
+    for reads in args.reads:
+        size_results, checks = run_size(args, reads, trace_file)
+        results.extend(size_results)
+        for check in ("python_vs_truth", "columnar_vs_truth"):
+            values = checks.get(check, {})
+            if any(x < 1.0 for x in values.values()):
+                failed.append("%s disambiguation of %d reads does not match "
+                              "their origin: %s"
+                              % (check.split("_")[0], reads, values))
+    if args.baseline:
+        failed.extend(regressions(results, args.baseline, args.tolerance))
+    with open(results_file, "a") as out_handle:
+        for result in results:
+            out_handle.write(json.dumps(result, sort_keys=True) + "\n")
+    for line in failed:
+        logging.error(line)
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the pipeline on "
+                                     "synthetic human and mouse alignments")
+    parser.add_argument("--reads", type=int, nargs="+", default=[10000],
+                        help="Numbers of read pairs to benchmark on.")
+    parser.add_argument("--out-dir", default="benchmark",
+                        help="Directory for the inputs, outputs and results.")
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS),
+                        choices=BENCHMARKS, help="Benchmarks to run.")
+    parser.add_argument("--ambiguous", type=float, default=0.05,
+                        help="Fraction of reads that are ambiguous.")
+    parser.add_argument("--multimap", type=float, default=0.02,
+                        help="Fraction of reads with several alignments.")
+    parser.add_argument("--memory", type=parse_memory, default="768M",
+                        help="Memory for sorting the reads.")
+    parser.add_argument("--seed", type=int, default=synthetic.DEFAULT_SEED)
+    parser.add_argument("--perl", default=PERL_SCRIPT,
+                        help="Perl disambiguation script to compare to.")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare to.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction slower or bigger than the baseline "
+                        "that counts as a regression.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not main(args):
+        sys.exit(1)
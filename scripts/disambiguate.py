@@ -11,66 +11,78 @@ import sys
 import yaml
 #from bipy.log import setup_logging, logger
 from bcbio.log import create_base_logger, logger, setup_local_logging
-from bipy.utils import (combine_pairs, flatten, append_stem,
-                        prepare_ref_file, replace_suffix)
-from bipy.toolbox import (htseq_count, deseq, annotate, rseqc, sam)
-from bipy.toolbox.trim import Cutadapt
-from bipy.toolbox.fastqc import FastQC
-from bipy.toolbox.tophat import Tophat
-from bipy.toolbox.rseqc import RNASeqMetrics
+from bipy.utils import flatten
 from bcbio.utils import safe_makedir
-from bcbio.distributed.ipythontasks import _setup_logging
-from az.plugins.disambiguate import Disambiguate
-from cluster_helper.cluster import cluster_view
-
-from itertools import product,  islice
-import sh
+from az.samples import filter_samples
+from az.manifest import RunManifest, cached_map
+from az import trace
+from az import discovery
+from az import disambiguation
+from az.plugins.disambiguate import (Disambiguate, partition,
+                                     disambiguate_partition,
+                                     combine_partitions)
+from az.parallel import pipeline_view
+
+from itertools import chain
 import os
-import fnmatch
-
-def locate(pattern, root=os.curdir):
-    '''Locate all files matching supplied filename pattern in and below
-    supplied root directory.'''
-    for path, dirs, files in os.walk(os.path.abspath(root)):
-        for filename in fnmatch.filter(files, pattern):
-            yield os.path.join(path, filename)
+import glob
 
 def _emit_stage_message(stage, curr_files):
     logger.info("Running %s on %s" % (stage, curr_files))
 
 
-def find_sam_files(in_dir):
-    logger.info("Finding SAM files in %s." % (in_dir))
-    # the descriptive filenames are symbolic links so find all of them
-    files = list(locate("*.sam", in_dir))
-    logger.info("Found %s." % (files))
-    links = filter(os.path.islink, files)
-    links.sort()
-    logger.info("Found %s." % (links))
-    return links
-
-
-def find_bam_files(in_dir):
-    logger.info("Finding BAM files in %s." % (in_dir))
-    files = list(locate("*.sorted.bam", in_dir))
-    logger.info("Found %s." % (files))
-    return files
-
-
-def main(config, view):
+def run_partitioned(config, view, in_files):
+    """
+    split each (human, mouse) pair by read name and disambiguate all of the
+    partitions from all of the samples across the engines at once
+    """
+    # samples the manifest says are done are not split again
+    manifest = RunManifest(config)
+    disambiguate = Disambiguate(config)
+    done = [manifest.lookup(disambiguate.stage, x, disambiguate)
+            for x in in_files]
+    todo = [x for x, out_files in zip(in_files, done) if out_files is None]
+    if not todo:
+        return done
+    [manifest.invalidate(disambiguate.stage, x, disambiguate) for x in todo]
+    n = len(todo)
+    partitions = view.map(trace.traced(config, "partition", partition), todo,
+                          [config] * n)
+    jobs = list(chain.from_iterable(partitions))
+    logger.info("Disambiguating %d partitions of %s." % (len(jobs), todo))
+    job_out = view.map(trace.traced(config, "disambiguate_partition",
+                                    disambiguate_partition),
+                       jobs, [config] * len(jobs))
+    # regroup the partition results by sample
+    sample_out = []
+    for sample_partitions in partitions:
+        sample_out.append(job_out[:len(sample_partitions)])
+        job_out = job_out[len(sample_partitions):]
+    combined = view.map(trace.traced(config, "combine_partitions",
+                                     combine_partitions),
+                        todo, sample_out, [config] * n)
+    for in_file, out_files in zip(todo, combined):
+        manifest.record(disambiguate.stage, in_file, disambiguate, out_files)
+        done[in_files.index(in_file)] = out_files
+    return done
+
+
+def main(config, view, samples=None):
 
     # make the needed directories
     map(safe_makedir, config["dir"].values())
+    trace.start_run(config, "disambiguate")
 
     # specific for project
-    human_input = find_sam_files(config["input_dir_human"])
-    mouse_input = find_sam_files(config["input_dir_mouse"])
-    if len(human_input) != len(mouse_input):
-        logger.error("The length of the number of human SAM files does "
-                     "not match the length of the number of mouse SAM "
-                     "files, aborting.")
+    # human and mouse files are paired by sample name, not by sort order
+    try:
+        sample_files = discovery.genome_samples(config,
+                                                config["input_dir_human"],
+                                                config["input_dir_mouse"])
+    except ValueError as e:
+        logger.error("%s Aborting." % (e))
         sys.exit(1)
-    input_files = zip(human_input, mouse_input)
+    input_files = filter_samples(map(tuple, sample_files), samples)
 
     curr_files = input_files
 
@@ -80,14 +92,41 @@ def main(config, view):
         if stage == "disambiguate":
             logger.info("Disambiguating %s." % (curr_files))
             disambiguate = Disambiguate(config)
-            out_files = list(flatten(view.map(disambiguate, curr_files)))
-            bam_files = view.map(sam.sam2bam, out_files)
-            bam_sorted = view.map(sam.bamsort, bam_files)
-            view.map(sam.bamindex, bam_sorted)
+            if disambiguate.partitions > 1:
+                out_files = list(flatten(run_partitioned(config, view,
+                                                         curr_files)))
+            else:
+                out_files = list(flatten(view.map(disambiguate, curr_files)))
+            # purity of every sample disambiguated so far, counted while the
+            # reads were written. samples are often run one at a time
+            stats_files = sorted(glob.glob(os.path.join(
+                disambiguate.out_dir, "*.disambiguation_stats.json")))
+            if stats_files:
+                summary_file = disambiguation.summary_table(
+                    stats_files, os.path.join(disambiguate.out_dir,
+                                              "disambiguation_summary.tsv"))
+                logger.info("Disambiguation summary is in %s."
+                            % (summary_file))
+            # bam output is already sorted and indexed by the stage, an
+            # index of the ambiguous reads is left as it is
+            if disambiguate.output == "sam":
+                from bipy.toolbox import sam
+                sam_files = [x for x in out_files if x.endswith(".sam")]
+                bam_files = cached_map(view, config, "sam2bam", sam.sam2bam,
+                                       sam_files)
+                bam_sorted = cached_map(view, config, "bamsort", sam.bamsort,
+                                        bam_files)
+                cached_map(view, config, "bamindex", sam.bamindex,
+                           bam_sorted)
+
+    # where the time went
+    trace.finish_run(config)
 
 if __name__ == "__main__":
     # read in the config file and perform initial setup
     main_config_file = sys.argv[1]
+    # optionally only run on the named samples
+    samples = sys.argv[2:]
     with open(main_config_file) as config_in_handle:
         startup_config = yaml.load(config_in_handle)
     parallel = create_base_logger(startup_config, {"type": "ipython"})
@@ -95,19 +134,5 @@ if __name__ == "__main__":
     startup_config["parallel"] = parallel
          #setup_logging(startup_config)
 
-    cluster_config = startup_config["cluster"]
-    cores_per_job = cluster_config.get("cores_per_job", 1)
-    if startup_config["cluster"].get("local", False):
-        main(startup_config, DummyView())
-    else:
-        with cluster_view(cluster_config["scheduler"],
-                          cluster_config["queue"],
-                          cluster_config["cores"],
-                          cores_per_job) as view:
-            main(startup_config, view)
-
-
-class DummyView(object):
-
-    def __init__(self):
-        self.map = map
+    with pipeline_view(startup_config["cluster"]) as view:
+        main(startup_config, view, samples)
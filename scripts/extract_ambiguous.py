@@ -0,0 +1,41 @@
+"""
+writes out the ambiguous reads of a sample disambiguated with
+ambiguous: index, in the coordinates of one of the genomes. the output is a
+coordinate sorted, indexed BAM file if it ends in .bam and SAM otherwise.
+
+example:
+python scripts/extract_ambiguous.py results/disambiguate/s1.ambiguous.npz \
+    mouse s1.ambiguous.mouse.sorted.bam --config disambiguate.yaml
+
+"""
+import argparse
+import sys
+import yaml
+
+from az import bam
+from az.ambiguous import AmbiguousIndex, GENOMES
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write out the ambiguous "
+                                     "reads of an index in the coordinates of "
+                                     "one of the genomes")
+    parser.add_argument("index", help="Index of the ambiguous reads.")
+    parser.add_argument("genome", choices=GENOMES,
+                        help="Genome to write the alignments of.")
+    parser.add_argument("out_file", help="SAM or BAM file to write.")
+    parser.add_argument("--config",
+                        help="YAML file with the samtools program to use.")
+    args = parser.parse_args()
+    config = {}
+    if args.config:
+        with open(args.config) as in_handle:
+            config = yaml.load(in_handle)
+    index = AmbiguousIndex(args.index)
+    try:
+        index.extract(args.genome, args.out_file, config,
+                      bam.stage_threads(config, "disambiguate"))
+    except ValueError as e:
+        sys.stderr.write("%s\n" % (e))
+        sys.exit(1)
+    print "Wrote %d ambiguous reads to %s." % (len(index), args.out_file)
@@ -0,0 +1,141 @@
+"""
+benchmarks how long the pipeline modules and scripts take to import, each in
+a fresh interpreter like an engine unpickling a stage, and which of the slow
+toolboxes each of them pulls in. the results are appended to a JSON lines
+file, and with --baseline they are compared to an earlier run so a change
+that makes the imports slower fails the benchmark.
+
+example:
+python scripts/import_benchmark.py --out-dir bench
+python scripts/import_benchmark.py --baseline bench/imports.jsonl
+
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from bcbio.utils import safe_makedir
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULES = ["az.plugins", "az.plugins.disambiguate", "az.plugins.count",
+           "az.plugins.qc", "az.columns", "az.disambiguation",
+           os.path.join(SCRIPT_DIR, "mapping.py"),
+           os.path.join(SCRIPT_DIR, "disambiguate.py"),
+           os.path.join(SCRIPT_DIR, "quantitation.py")]
+# modules that are slow to import and only some stages need
+HEAVY = ["bipy.toolbox", "bipy.plugins", "bcbio.provenance",
+         "bcbio.distributed", "cluster_helper", "IPython", "sh", "numpy"]
+# prints the seconds the import took and the heavy modules it imported
+CHILD = """
+import imp, json, sys, time
+start = time.time()
+if %(module)r.endswith(".py"):
+    sys.path.insert(0, %(script_dir)r)
+    imp.load_source("imported", %(module)r)
+else:
+    __import__(%(module)r)
+print json.dumps([time.time() - start,
+                  [x for x in %(heavy)r if x in sys.modules]])
+"""
+
+
+def _name(module):
+    if module.endswith(".py"):
+        return os.path.basename(module)
+    return module
+
+
+def time_import(module, python=sys.executable):
+    """
+    the seconds importing module takes in a fresh interpreter, the seconds
+    the whole interpreter took and the heavy modules it imported
+    """
+    start = time.time()
+    output = subprocess.check_output(
+        [python, "-c", CHILD % {"module": module, "script_dir": SCRIPT_DIR,
+                                "heavy": HEAVY}])
+    wall = time.time() - start
+    seconds, heavy = json.loads(output.strip().splitlines()[-1])
+    return seconds, wall, [str(x) for x in heavy]
+
+
+def measure(module, repeats):
+    """
+    the fastest of repeats imports of module, the others are slower because
+    of the disk cache or other work on the machine
+    """
+    runs = [time_import(module) for _ in range(repeats)]
+    seconds, wall, heavy = min(runs)
+    return {"benchmark": "import", "module": _name(module),
+            "seconds": seconds, "interpreter_seconds": wall, "heavy": heavy,
+            "time": time.time()}
+
+
+def regressions(results, baseline_file, tolerance):
+    """
+    the modules that take longer to import than the last result for the
+    same module in baseline_file by more than tolerance
+    """
+    baseline = {}
+    with open(baseline_file) as in_handle:
+        for line in in_handle:
+            record = json.loads(line)
+            baseline[record["module"]] = record
+    found = []
+    for result in results:
+        before = baseline.get(result["module"])
+        if before and result["seconds"] > before["seconds"] * (1 + tolerance):
+            found.append("importing %s takes %.3f s, was %.3f s"
+                         % (result["module"], result["seconds"],
+                            before["seconds"]))
+    return found
+
+
+def main(args):
+    safe_makedir(args.out_dir)
+    results = []
+    failed = []
+    for module in args.modules:
+        try:
+            result = measure(module, args.repeats)
+        except subprocess.CalledProcessError:
+            failed.append("%s could not be imported" % _name(module))
+            continue
+        logging.info("%-26s %8.3f s import %8.3f s interpreter  %s"
+                     % (result["module"], result["seconds"],
+                        result["interpreter_seconds"],
+                        " ".join(result["heavy"])))
+        results.append(result)
+    if args.baseline:
+        failed.extend(regressions(results, args.baseline, args.tolerance))
+    with open(os.path.join(args.out_dir, "imports.jsonl"), "a") as out_handle:
+        for result in results:
+            out_handle.write(json.dumps(result, sort_keys=True) + "\n")
+    for line in failed:
+        logging.error(line)
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark how long the "
+                                     "pipeline takes to import")
+    parser.add_argument("--modules", nargs="+", default=MODULES,
+                        help="Modules or scripts to import.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Times to import each module, the fastest "
+                        "counts.")
+    parser.add_argument("--out-dir", default="benchmark",
+                        help="Directory for the results.")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare to.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction slower than the baseline that counts "
+                        "as a regression.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not main(args):
+        sys.exit(1)
@@ -9,49 +9,21 @@ data in useful ways
 """
 import sys
 import yaml
-from itertools import product, islice
+from itertools import product
 
-from cluster_helper.cluster import cluster_view
+from az.parallel import pipeline_view
 from bcbio.utils import safe_makedir
-from bipy.utils import (combine_pairs, append_stem)
-from bipy.toolbox import (htseq_count, rseqc, sam)
-from bipy.toolbox.trim import Cutadapt
-from bipy.toolbox.fastqc import FastQC
-from bipy.toolbox.fastq import HardClipper
-from bipy.toolbox.tophat import Tophat
-from bipy.toolbox.rseqc import RNASeqMetrics
-from bipy.plugins import StageRepository
-
-import os, fnmatch
+from az.samples import filter_samples
+from az.subsample import make_test
+from az.manifest import cached_map
+from az import trace
+from az import discovery
+from az.plugins import StageRepository
+from bipy.utils import (combine_pairs, flatten)
+
+import os
 from bcbio.log import create_base_logger, setup_local_logging, logger
 
-def locate(pattern, root=os.curdir):
-    '''Locate all files matching supplied filename pattern in and below
-    supplied root directory.'''
-    for path, dirs, files in os.walk(os.path.abspath(root)):
-        for filename in fnmatch.filter(files, pattern):
-            yield os.path.join(path, filename)
-
-
-def make_test(in_file, config, lines=1000000):
-    """
-    take a small subset of the input files for testing. only makes sense for
-    text files where lines gives an appopriate number of records, for example,
-    FASTQ files should be a multiple of 4.
-
-    """
-    results_dir = config["dir"]["results"]
-    out_dir = os.path.join(results_dir, "test", "data")
-    safe_makedir(out_dir)
-    out_file = os.path.join(out_dir,
-                            append_stem(os.path.basename(in_file), "test"))
-    with open(in_file) as in_handle, open(out_file, "w") as out_handle:
-        for line in islice(in_handle, lines):
-            out_handle.write(line)
-
-    return out_file
-
-
 def _get_stage_config(config, stage):
     return config["stage"][stage]
 
@@ -60,26 +32,34 @@ def _get_program(config, stage):
     return config["stage"][stage]["program"]
 
 
+def _native_sort(config):
+    return config["stage"].get("sort", {}).get("engine") == "native"
+
+
 def _emit_stage_message(stage, curr_files):
     logger.info("Running %s on %s" % (stage, curr_files))
 
 
-def main(config, view):
+def main(config, view, samples=None):
 
     # make the needed directories
     map(safe_makedir, config["dir"].values())
+    trace.start_run(config, "mapping")
 
     # specific for project
     input_dir = config["dir"]["data"]
     logger.info("Loading files from %s" % (input_dir))
-    input_files = list(locate("*.fq", input_dir))
-    input_files += list(locate("*.fastq", input_dir))
+    # one scan of the data directory, paired up by sample
+    sample_files = filter_samples(discovery.fastq_samples(config, input_dir),
+                                  samples)
+    input_files = list(flatten(sample_files))
     logger.info("Input files: %s" % (input_files))
 
     results_dir = config["dir"]["results"]
     safe_makedir(results_dir)
 
-    # make the stage repository
+    # make the stage repository, the stages are only imported when they are
+    # used so a run only imports the toolboxes of its own stages
     repository = StageRepository(config)
     logger.info("Stages found: %s" % (repository.plugins))
 
@@ -88,7 +68,12 @@ def main(config, view):
         results_dir = os.path.join(results_dir, "test_pipeline")
         config["dir"]["results"] = results_dir
         safe_makedir(results_dir)
-        curr_files = map(make_test, input_files, [config] * len(input_files))
+        # subsample each sample on its own engine, keeping pairs together
+        test_files = sample_files
+        curr_files = list(flatten(view.map(trace.traced(config, "make_test",
+                                                        make_test),
+                                           test_files,
+                                           [config] * len(test_files))))
         logger.info("Converted %s to %s. " % (input_files, curr_files))
     else:
         curr_files = input_files
@@ -97,28 +82,64 @@ def main(config, view):
     for stage in config["run"]:
         if stage == "fastqc":
             logger.info("Running fastqc on %s." % (curr_files))
-            stage_runner = FastQC(config)
-            view.map(stage_runner, curr_files)
+            stage_runner = repository[stage](config)
+            cached_map(view, config, stage, stage_runner, curr_files)
 
         if stage == "cutadapt":
             curr_files = combine_pairs(curr_files)
             logger.info("Running cutadapt on %s." % (curr_files))
-            stage_runner = Cutadapt(config)
-            curr_files = view.map(stage_runner, curr_files)
+            stage_runner = repository[stage](config)
+            curr_files = cached_map(view, config, stage, stage_runner,
+                                    curr_files)
+
+        if stage == "kmer_classify":
+            # only the reads that might be from this genome are mapped to it
+            logger.info("Sorting the reads of %s by k-mers." % (curr_files))
+            classifier = repository[stage](config)
+            curr_files = cached_map(view, config, stage, classifier,
+                                    curr_files)
 
         if stage == "tophat":
             logger.info("Running Tophat on %s." % (curr_files))
-            #tophat = repository["tophat"](config)
-            tophat = Tophat(config)
-            tophat_outputs = view.map(tophat, curr_files)
-            sortsam = view.map(sam.coordinate_sort_sam, tophat_outputs,
-                               [config] * len(tophat_outputs))
-            bamfiles = view.map(sam.sam2bam, sortsam)
-            bamsort = view.map(sam.bamsort, bamfiles)
-            view.map(sam.bamindex, bamsort)
+            tophat = repository[stage](config)
+            tophat_outputs = cached_map(view, config, stage, tophat,
+                                        curr_files)
+            if _native_sort(config):
+                # straight from the tophat output to a sorted, indexed BAM
+                # file, only sorting within the memory budget of the sort
+                # stage if tophat did not leave it sorted
+                from az import sorting
+                bamsort = cached_map(view, config, "sorted_bam",
+                                     sorting.sorted_bam, tophat_outputs,
+                                     [config] * len(tophat_outputs))
+                bamfiles = bamsort
+            else:
+                from bipy.toolbox import sam
+                sortsam = cached_map(view, config, "coordinate_sort_sam",
+                                     sam.coordinate_sort_sam, tophat_outputs,
+                                     [config] * len(tophat_outputs))
+                bamfiles = cached_map(view, config, "sam2bam", sam.sam2bam,
+                                      sortsam)
+                bamsort = cached_map(view, config, "bamsort", sam.bamsort,
+                                     bamfiles)
+                cached_map(view, config, "bamindex", sam.bamindex, bamsort)
             final_bamfiles = bamsort
             curr_files = tophat_outputs
 
+        if stage == "columns":
+            # the alignment summary the columnar disambiguation engine uses,
+            # written next to each tophat output
+            logger.info("Summarizing the alignments of %s." % (tophat_outputs))
+            from az import columns
+            cached_map(view, config, stage, columns.write_columns,
+                       tophat_outputs, [config] * len(tophat_outputs))
+
+        if stage == "tophat_disambiguate":
+            logger.info("Mapping and disambiguating %s." % (curr_files))
+            stage_runner = repository[stage](config)
+            curr_files = list(flatten(cached_map(view, config, stage,
+                                                 stage_runner, curr_files)))
+
         if stage == "disambiguate":
             logger.info("Disambiguating %s." % (curr_files))
             disambiguate = repository[stage](config)
@@ -126,34 +147,75 @@ def main(config, view):
 
         if stage == "htseq-count":
             logger.info("Running htseq-count on %s." % (bamfiles))
-            name_sorted = view.map(sam.bam_name_sort, bamfiles)
-            curr_files = view.map(sam.bam2sam, name_sorted)
-            htseq_args = zip(*product(curr_files, [config], [stage]))
-            htseq_outputs = view.map(htseq_count.run_with_config,
-                                     *htseq_args)
-            htseq_count.combine_counts(htseq_outputs)
+            if config["stage"][stage].get("engine") == "native":
+                # count straight from the coordinate sorted BAM files
+                counter = repository[stage](config)
+                htseq_outputs = cached_map(view, config, stage, counter,
+                                           bamfiles)
+            else:
+                from bipy.toolbox import htseq_count, sam
+                if _native_sort(config):
+                    from az import sorting
+                    name_sorted = cached_map(view, config, "bam_name_sort",
+                                             sorting.bam_name_sort, bamfiles,
+                                             [config] * len(bamfiles))
+                else:
+                    name_sorted = cached_map(view, config, "bam_name_sort",
+                                             sam.bam_name_sort, bamfiles)
+                curr_files = cached_map(view, config, "bam2sam", sam.bam2sam,
+                                        name_sorted)
+                htseq_args = zip(*product(curr_files, [config], [stage]))
+                htseq_outputs = cached_map(view, config, stage,
+                                           htseq_count.run_with_config,
+                                           *htseq_args)
+            # only combine the counts for the whole project, samples already
+            # in the count matrix are not read again
+            if not samples:
+                from az import matrix
+                matrix.combine_counts(htseq_outputs)
 
         if stage == "rnaseq_metrics":
             logger.info("Calculating RNASeq metrics on %s." % (curr_files))
-            #coverage = repository[stage](config)
-            coverage = RNASeqMetrics(config)
-            view.map(coverage, curr_files)
+            coverage = repository[stage](config)
+            cached_map(view, config, stage, coverage, curr_files)
 
         if stage == "hard_clip":
             logger.info("Trimming from the beginning of reads on %s." % (curr_files))
-            hard_clipper = HardClipper(config)
-            curr_files = view.map(hard_clipper, curr_files)
+            hard_clipper = repository[stage](config)
+            curr_files = cached_map(view, config, stage, hard_clipper,
+                                    curr_files)
 
         if stage == "rseqc":
             logger.info("Running rseqc on %s." % (curr_files))
-            curr_files = view.map(sam.sam2bam, curr_files)
-            rseq_args = zip(*product(curr_files, [config]))
-            view.map(rseqc.bam_stat, *rseq_args)
-            view.map(rseqc.genebody_coverage, *rseq_args)
-            view.map(rseqc.junction_annotation, *rseq_args)
-            view.map(sam.bamindex, curr_files)
-            RPKM_count_out = view.map(rseqc.RPKM_count, *rseq_args)
-            view.map(rseqc.fix_RPKM_count_file, RPKM_count_out)
+            from bipy.toolbox import rseqc, sam
+            curr_files = cached_map(view, config, "sam2bam", sam.sam2bam,
+                                    curr_files)
+            if config["stage"][stage].get("engine") == "native":
+                # every metric from a single pass over each BAM file
+                metrics = repository[stage](config)
+                metric_files = cached_map(view, config, stage, metrics,
+                                          curr_files)
+                RPKM_count_out = [x[-1] for x in metric_files]
+            else:
+                # the log.txt of each RSeQC program goes to the log_dir
+                from az.qc import KeepRseqcLog
+                log_dir = config.get("log_dir", "log")
+                rseq_args = zip(*product(curr_files, [config]))
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.bam_stat, log_dir), *rseq_args)
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.genebody_coverage, log_dir),
+                           *rseq_args)
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.junction_annotation, log_dir),
+                           *rseq_args)
+                cached_map(view, config, "bamindex", sam.bamindex,
+                           curr_files)
+                RPKM_count_out = cached_map(
+                    view, config, stage, KeepRseqcLog(rseqc.RPKM_count,
+                                                      log_dir), *rseq_args)
+            cached_map(view, config, stage, rseqc.fix_RPKM_count_file,
+                       RPKM_count_out)
             """
                             annotate_args = zip(*product(RPKM_count_fixed,
                                          ["gene_id"],
@@ -164,25 +226,18 @@ def main(config, view):
                      """
                      #view.map(rseqc.RPKM_saturation, *rseq_args)
 
+    # where the time went
+    trace.finish_run(config)
+
+
 if __name__ == "__main__":
     main_config_file = sys.argv[1]
+    # optionally only run on the named samples
+    samples = sys.argv[2:]
     with open(main_config_file) as config_in_handle:
         startup_config = yaml.load(config_in_handle)
     parallel = create_base_logger(startup_config, {"type": "ipython"})
     setup_local_logging(startup_config, parallel)
     startup_config["parallel"] = parallel
-    cluster_config = startup_config["cluster"]
-    cores_per_job = cluster_config.get("cores_per_job", 1)
-    if startup_config["cluster"].get("local", False):
-        main(startup_config, DummyView())
-    else:
-        with cluster_view(cluster_config["scheduler"],
-                          cluster_config["queue"],
-                          cluster_config["cores"],
-                          cores_per_job) as view:
-            main(startup_config, view)
-
-class DummyView(object):
-
-    def __init__(self):
-        self.map = map
+    with pipeline_view(startup_config["cluster"]) as view:
+        main(startup_config, view, samples)
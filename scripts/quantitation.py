@@ -7,41 +7,38 @@ you will have to write a couple of functions to group the input
 data in useful ways
 
 """
-from bipy.cluster import stop_cluster
 import sys
 import yaml
 from itertools import product
-import os, fnmatch
+import os
 
 from bcbio.utils import safe_makedir
-from bipy.toolbox import (htseq_count, rseqc, sam)
+from az.samples import filter_samples
+from az.manifest import cached_map
+from az import trace
+from az import discovery
+from az.plugins import StageRepository
 from bcbio.log import logger, setup_local_logging, create_base_logger
-from bipy.toolbox.rseqc import RNASeqMetrics
-from bipy.plugins import StageRepository
-from cluster_helper.cluster import cluster_view
+from az.parallel import pipeline_view
 
 
-def locate(pattern, root=os.curdir):
-    '''Locate all files matching supplied filename pattern in and below
-    supplied root directory.'''
-    for path, dirs, files in os.walk(os.path.abspath(root)):
-        for filename in fnmatch.filter(files, pattern):
-            yield os.path.join(path, filename)
-
-def main(config, view):
+def main(config, view, samples=None):
     # make the needed directories
     map(safe_makedir, config["dir"].values())
+    trace.start_run(config, "quantitation")
 
     # specific for project
     input_dir = config["input_dir"]
     logger.info("Loading files from %s" % (input_dir))
-    input_files = list(locate("*.disambiguous*.sorted.bam", input_dir))
+    input_files = discovery.disambiguated_samples(config, input_dir)
+    input_files = filter_samples(input_files, samples)
     logger.info("Input files: %s" % (input_files))
 
     results_dir = config["dir"]["results"]
     safe_makedir(results_dir)
 
-    # make the stage repository
+    # make the stage repository, the stages are only imported when they are
+    # used so a run only imports the toolboxes of its own stages
     repository = StageRepository(config)
     logger.info("Stages found: %s" % (repository.plugins))
 
@@ -51,29 +48,76 @@ def main(config, view):
     for stage in config["run"]:
         if stage == "htseq-count":
             logger.info("Running htseq-count on %s." % (input_files))
-            name_sorted = view.map(sam.bam_name_sort, input_files)
-            curr_files = view.map(sam.bam2sam, name_sorted)
-            htseq_args = zip(*product(curr_files, [config], [stage]))
-            htseq_outputs = view.map(htseq_count.run_with_config,
-                                     *htseq_args)
-            htseq_count.combine_counts(htseq_outputs)
+            if config["stage"][stage].get("engine") == "native":
+                # count straight from the coordinate sorted BAM files
+                counter = repository[stage](config)
+                htseq_outputs = cached_map(view, config, stage, counter,
+                                           input_files)
+            else:
+                from bipy.toolbox import htseq_count, sam
+                if config["stage"].get("sort", {}).get("engine") == "native":
+                    # sort within the memory budget of the sort stage
+                    from az import sorting
+                    name_sorted = cached_map(view, config, "bam_name_sort",
+                                             sorting.bam_name_sort,
+                                             input_files,
+                                             [config] * len(input_files))
+                else:
+                    name_sorted = cached_map(view, config, "bam_name_sort",
+                                             sam.bam_name_sort, input_files)
+                curr_files = cached_map(view, config, "bam2sam", sam.bam2sam,
+                                        name_sorted)
+                htseq_args = zip(*product(curr_files, [config], [stage]))
+                htseq_outputs = cached_map(view, config, stage,
+                                           htseq_count.run_with_config,
+                                           *htseq_args)
+            # only combine the counts for the whole project, samples already
+            # in the count matrix are not read again
+            if not samples:
+                from az import matrix
+                matrix.combine_counts(htseq_outputs)
 
         if stage == "rnaseq_metrics":
             logger.info("Calculating RNASeq metrics on %s." % (curr_files))
-            #coverage = repository[stage](config)
             #curr_files = view.map(sam.bam2sam, curr_files)
-            coverage = RNASeqMetrics(config)
-            view.map(coverage, curr_files)
+            coverage = repository[stage](config)
+            cached_map(view, config, stage, coverage, curr_files)
+
+        if stage == "rrna_fraction":
+            logger.info("Calculating rRNA and mitochondrial fractions on %s."
+                        % (curr_files))
+            fractions = repository[stage](config)
+            cached_map(view, config, stage, fractions, curr_files)
 
         if stage == "rseqc":
             logger.info("Running rseqc on %s." % (curr_files))
-            rseq_args = zip(*product(curr_files, [config]))
-            view.map(rseqc.bam_stat, *rseq_args)
-            view.map(rseqc.genebody_coverage, *rseq_args)
-            view.map(rseqc.junction_annotation, *rseq_args)
-            view.map(sam.bamindex, curr_files)
-            RPKM_count_out = view.map(rseqc.RPKM_count, *rseq_args)
-            view.map(rseqc.fix_RPKM_count_file, RPKM_count_out)
+            from bipy.toolbox import rseqc, sam
+            if config["stage"][stage].get("engine") == "native":
+                # every metric from a single pass over each BAM file
+                metrics = repository[stage](config)
+                metric_files = cached_map(view, config, stage, metrics,
+                                          curr_files)
+                RPKM_count_out = [x[-1] for x in metric_files]
+            else:
+                # the log.txt of each RSeQC program goes to the log_dir
+                from az.qc import KeepRseqcLog
+                log_dir = config.get("log_dir", "log")
+                rseq_args = zip(*product(curr_files, [config]))
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.bam_stat, log_dir), *rseq_args)
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.genebody_coverage, log_dir),
+                           *rseq_args)
+                cached_map(view, config, stage,
+                           KeepRseqcLog(rseqc.junction_annotation, log_dir),
+                           *rseq_args)
+                cached_map(view, config, "bamindex", sam.bamindex,
+                           curr_files)
+                RPKM_count_out = cached_map(
+                    view, config, stage, KeepRseqcLog(rseqc.RPKM_count,
+                                                      log_dir), *rseq_args)
+            cached_map(view, config, stage, rseqc.fix_RPKM_count_file,
+                       RPKM_count_out)
             #view.map(rseqc.junction_saturation, *rseq_args)
             #RPKM_args = zip(*product(final_bamfiles, [config]))
             #RPKM_count_out = view.map(rseqc.RPKM_count, *RPKM_args)
@@ -90,29 +134,20 @@ def main(config, view):
                      """
                      #view.map(rseqc.RPKM_saturation, *rseq_args)
 
-    # end gracefully
-    stop_cluster()
+    # where the time went
+    trace.finish_run(config)
 
 
 if __name__ == "__main__":
     # read in the config file and perform initial setup
     main_config_file = sys.argv[1]
+    # optionally only run on the named samples
+    samples = sys.argv[2:]
     with open(main_config_file) as config_in_handle:
         startup_config = yaml.load(config_in_handle)
     parallel = create_base_logger(startup_config, {"type": "ipython"})
     setup_local_logging(startup_config, parallel)
     startup_config["parallel"] = parallel
 
-    if startup_config["cluster"].get("local", False):
-        main(startup_config, DummyView())
-    else:
-        cluster_config = startup_config["cluster"]
-        with cluster_view(cluster_config["scheduler"],
-                          cluster_config["queue"],
-                          cluster_config["cores"]) as view:
-            main(startup_config, view)
-
-class DummyView(object):
-
-    def __init__(self):
-        self.map = map
+    with pipeline_view(startup_config["cluster"]) as view:
+        main(startup_config, view, samples)
@@ -11,5 +11,5 @@ setup(name='az',
       namespace_packages=['az'],
       packages=find_packages(),
       dependency_links=['https://github.com/roryk/bipy/tarball/master#egg=bipy-0.1.0'],
-      install_requires=["bipy == 0.1.0"],
+      install_requires=["bipy == 0.1.0", "numpy >= 1.15"],
       zip_safe=False)
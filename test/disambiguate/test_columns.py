@@ -0,0 +1,135 @@
+import unittest
+from StringIO import StringIO
+from itertools import product
+import numpy as np
+from az import ambiguous, columns, disambiguation
+import shutil
+import tempfile
+import os
+
+HUMAN_SAM = os.path.join("test", "data", "small_1.human.sam")
+MOUSE_SAM = os.path.join("test", "data", "small_1.mouse.sam")
+
+
+def _name_sorted(in_file):
+    with open(in_file) as in_handle:
+        header, lines = disambiguation.read_sam(in_handle)
+        return header + sorted(lines, key=disambiguation.read_name)
+
+
+def _lines(handle):
+    return sorted(x for x in handle.getvalue().splitlines(True)
+                  if not x.startswith("@"))
+
+
+class TestColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.human = os.path.join(self.tmp_dir, "small_1.human.sam")
+        self.mouse = os.path.join(self.tmp_dir, "small_1.mouse.sam")
+        shutil.copy(HUMAN_SAM, self.human)
+        shutil.copy(MOUSE_SAM, self.mouse)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_classify(self):
+        """
+        test that the vectorized rules decide like disambiguation.classify
+        """
+        combos = list(product([0, 1, 2, 3, 1000], repeat=4))
+        scores = np.array(combos)
+        codes = columns.classify(scores[:, :2], scores[:, 2:])
+        for code, combo in zip(codes, combos):
+            self.assertEqual(columns.CATEGORIES[code],
+                             disambiguation.classify(combo[:2], combo[2:]))
+
+    def test_matches_streaming(self):
+        """
+        test that the columnar engine puts the same alignments in the same
+        outputs as the streaming engine, without sorting the inputs
+        """
+        out_handles = [StringIO() for _ in range(4)]
+        expected_counts = disambiguation.disambiguate(
+            _name_sorted(HUMAN_SAM), _name_sorted(MOUSE_SAM), *out_handles)
+        expected = map(_lines, out_handles)
+        out_handles = [StringIO() for _ in range(4)]
+        counts = columns.disambiguate(self.human, self.mouse, *out_handles)
+        self.assertEqual(counts, expected_counts)
+        self.assertEqual(map(_lines, out_handles), expected)
+
+    def test_stats_match_streaming(self):
+        """
+        test that the vectorized stats are the same as the streaming ones
+        """
+        expected = disambiguation.DisambiguationStats()
+        disambiguation.disambiguate(
+            _name_sorted(HUMAN_SAM), _name_sorted(MOUSE_SAM),
+            *[StringIO() for _ in range(4)], stats=expected)
+        stats = disambiguation.DisambiguationStats()
+        columns.disambiguate(self.human, self.mouse,
+                             *[StringIO() for _ in range(4)], stats=stats)
+        self.assertEqual(stats.to_dict(), expected.to_dict())
+        stats_file, _ = stats.write(self.human + ".json", self.human + ".tsv",
+                                    "small_1")
+        summary_file = disambiguation.summary_table(
+            [stats_file], os.path.join(self.tmp_dir, "summary.tsv"))
+        with open(summary_file) as in_handle:
+            header, row = [x.rstrip("\n").split("\t") for x in in_handle]
+        row = dict(zip(header, row))
+        self.assertEqual(row["sample"], "small_1")
+        self.assertEqual(int(row["human_reads"]),
+                         expected.reads[disambiguation.HUMAN])
+
+    def test_ambiguous_index(self):
+        """
+        test that the reads extracted from the index of the ambiguous reads
+        are the ones the ambiguous outputs get
+        """
+        out_handles = [StringIO() for _ in range(4)]
+        expected_counts = columns.disambiguate(self.human, self.mouse,
+                                               *out_handles)
+        expected = {"human": _lines(out_handles[1]),
+                    "mouse": _lines(out_handles[3])}
+        index_file = os.path.join(self.tmp_dir, "small_1" + ambiguous.SUFFIX)
+        counts = columns.disambiguate(self.human, self.mouse, StringIO(),
+                                      None, StringIO(), None,
+                                      index_file=index_file)
+        self.assertEqual(counts, expected_counts)
+        index = ambiguous.AmbiguousIndex(index_file)
+        self.assertEqual(len(index), counts[disambiguation.AMBIGUOUS])
+        out_file = os.path.join(self.tmp_dir, "ambiguous.sam")
+        for genome in ambiguous.GENOMES:
+            index.extract(genome, out_file)
+            with open(out_file) as in_handle:
+                self.assertEqual(sorted(x for x in in_handle
+                                        if not x.startswith("@")),
+                                 expected[genome])
+        self.assertTrue(disambiguation.read_name(expected["human"][0])
+                        in index)
+        self.assertFalse("not a read" in index)
+        with open(self.mouse, "a") as out_handle:
+            out_handle.write(expected["mouse"][0])
+        self.assertRaises(ValueError, index.extract, "mouse", out_file)
+
+    def test_columns_follow_links(self):
+        """
+        test that the columns are kept next to the file a link points to and
+        are written again when the file changes
+        """
+        link = os.path.join(self.tmp_dir, "descriptive.sam")
+        os.symlink(self.human, link)
+        columns.write_columns(self.human, {})
+        self.assertTrue(columns.is_current(link))
+        loaded = columns.load_columns(link)
+        n = len([x for x in open(self.human) if not x.startswith("@")])
+        self.assertEqual(len(loaded["name_hashes"]), n)
+        with open(self.human, "a") as out_handle:
+            out_handle.write(open(self.human).readlines()[-1])
+        self.assertFalse(columns.is_current(link))
+        self.assertEqual(len(columns.load_columns(link)["flags"]), n + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
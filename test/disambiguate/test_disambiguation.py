@@ -0,0 +1,167 @@
+import unittest
+from StringIO import StringIO
+from az import disambiguation
+import os
+
+HUMAN_SAM = os.path.join("test", "data", "small_1.human.sam")
+MOUSE_SAM = os.path.join("test", "data", "small_1.mouse.sam")
+
+
+def _name_sorted(in_file):
+    with open(in_file) as in_handle:
+        header, lines = disambiguation.read_sam(in_handle)
+        return header + sorted(lines, key=disambiguation.read_name)
+
+
+def _names(lines):
+    return set(disambiguation.read_name(x) for x in lines
+               if not x.startswith("@"))
+
+
+class TestDisambiguation(unittest.TestCase):
+
+    def setUp(self):
+        self.human = _name_sorted(HUMAN_SAM)
+        self.mouse = _name_sorted(MOUSE_SAM)
+
+    def _run(self, human, mouse):
+        out_handles = [StringIO() for _ in range(4)]
+        counts = disambiguation.disambiguate(human, mouse, *out_handles)
+        outputs = [x.getvalue().splitlines(True) for x in out_handles]
+        return counts, outputs
+
+    def test_classify(self):
+        """
+        test the decision rules taken from disamb_byMapping2.pl
+
+        """
+        classify = disambiguation.classify
+        self.assertEqual(classify((1, 1), (1, 1)), disambiguation.AMBIGUOUS)
+        self.assertEqual(classify((1, 2), (2, 1)), disambiguation.AMBIGUOUS)
+        self.assertEqual(classify((1, 2), (3, 3)), disambiguation.HUMAN)
+        self.assertEqual(classify((2, 3), (1, 4)), disambiguation.MOUSE)
+        self.assertEqual(classify((1, 4), (1, 3)), disambiguation.MOUSE)
+
+    def test_every_read_assigned_once(self):
+        """
+        test that every read ends up in exactly one category
+
+        """
+        counts, outputs = self._run(self.human, self.mouse)
+        human, human_amb, mouse, mouse_amb = map(_names, outputs)
+        self.assertEqual(human_amb, mouse_amb)
+        self.assertFalse(human & mouse)
+        self.assertFalse((human | mouse) & human_amb)
+        self.assertEqual(human | mouse | human_amb,
+                         _names(self.human) | _names(self.mouse))
+        self.assertEqual(counts[disambiguation.HUMAN], len(human))
+        self.assertEqual(counts[disambiguation.MOUSE], len(mouse))
+        self.assertEqual(counts[disambiguation.AMBIGUOUS], len(human_amb))
+
+    def test_headers_copied(self):
+        """
+        test that each output keeps the header of its genome
+
+        """
+        _, outputs = self._run(self.human, self.mouse)
+        human_header, _ = disambiguation.read_sam(self.human)
+        mouse_header, _ = disambiguation.read_sam(self.mouse)
+        self.assertEqual(outputs[0][:len(human_header)], human_header)
+        self.assertEqual(outputs[3][:len(mouse_header)], mouse_header)
+
+    def test_stats(self):
+        """
+        test that the stats counted while writing match what was written
+
+        """
+        stats = disambiguation.DisambiguationStats()
+        out_handles = [StringIO() for _ in range(4)]
+        counts = disambiguation.disambiguate(self.human, self.mouse,
+                                             *out_handles, stats=stats)
+        outputs = [[x for x in y.getvalue().splitlines(True)
+                    if not x.startswith("@")] for y in out_handles]
+        self.assertEqual(stats.reads, counts)
+        self.assertEqual([stats.alignments[x] for x in
+                          disambiguation.OUTPUTS], map(len, outputs))
+        both = sum(counts.values()) - sum(stats.only.values())
+        self.assertEqual(sum(sum(x) for x in stats.differences.values()),
+                         both)
+        self.assertTrue(all(stats.pairs[x] <= stats.reads[x]
+                            for x in disambiguation.CATEGORIES))
+        self.assertEqual(sum(stats.merge(stats).reads.values()),
+                         2 * sum(counts.values()))
+
+    def test_stats_only_score_both(self):
+        """
+        test that counting the stats only scores the reads aligned to both
+        genomes and counts the ends of the others from their flags
+
+        """
+        scored = []
+        group_scores = disambiguation.group_scores
+
+        def counting_scores(lines):
+            scored.append(disambiguation.read_name(lines[0]))
+            return group_scores(lines)
+        disambiguation.group_scores = counting_scores
+        self.addCleanup(setattr, disambiguation, "group_scores", group_scores)
+        stats = disambiguation.DisambiguationStats()
+        disambiguation.disambiguate(self.human, self.mouse,
+                                    *[StringIO() for _ in range(4)],
+                                    stats=stats)
+        both = _names(self.human) & _names(self.mouse)
+        self.assertEqual(sorted(scored), sorted(list(both) * 2))
+        for genome, lines in ((disambiguation.HUMAN, self.human),
+                              (disambiguation.MOUSE, self.mouse)):
+            groups = [y for _, y in disambiguation.read_groups(
+                disambiguation.read_sam(lines)[1])]
+            for group in groups:
+                self.assertEqual(disambiguation.aligned_ends(group),
+                                 sum(x < disambiguation.UNMAPPED_SCORE
+                                     for x in group_scores(group)))
+            self.assertEqual(stats.only[genome], len(_names(lines) - both))
+
+    def test_preclassified_stats(self):
+        """
+        test that the reads sorted by k-mers are kept with the stats and
+        that stats written before them still load
+
+        """
+        stats = disambiguation.DisambiguationStats()
+        stats.preclassified[disambiguation.HUMAN] = 5
+        values = stats.to_dict()
+        self.assertEqual(disambiguation.DisambiguationStats.from_dict(
+            values).preclassified, {disambiguation.HUMAN: 5,
+                                    disambiguation.MOUSE: 0})
+        del values["preclassified"]
+        self.assertEqual(disambiguation.DisambiguationStats.from_dict(
+            values).preclassified[disambiguation.HUMAN], 0)
+        self.assertEqual(stats.merge(stats).preclassified[
+            disambiguation.HUMAN], 10)
+
+    def test_name_order(self):
+        """
+        test that the name order of samtools sort -n, which puts r9 before
+        r10, is not taken for the order the engine needs
+
+        """
+        line = "%s\t4\t*\t0\t0\t*\t*\t0\t0\tA\tI\n"
+        self.assertTrue(disambiguation.in_name_order(
+            [line % x for x in ("r10", "r10", "r9")]))
+        self.assertFalse(disambiguation.in_name_order(
+            [line % x for x in ("r9", "r10")]))
+        _, lines = disambiguation.read_sam(self.human)
+        self.assertTrue(disambiguation.in_name_order(lines))
+
+    def test_unsorted_input(self):
+        """
+        test that input not sorted by read name is rejected
+
+        """
+        with open(HUMAN_SAM) as in_handle:
+            human = in_handle.readlines()
+        self.assertRaises(ValueError, self._run, human, self.mouse)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDisambiguation)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from az import disambiguation
+from az.plugins.disambiguate import Disambiguate
+
+HUMAN_SAM = os.path.join("test", "data", "small_1.human.sam")
+MOUSE_SAM = os.path.join("test", "data", "small_1.mouse.sam")
+
+
+def _read(in_file):
+    with open(in_file) as in_handle:
+        header, lines = disambiguation.read_sam(in_handle)
+        return header, sorted(lines)
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_files = (HUMAN_SAM, MOUSE_SAM)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stage(self, partitions, name=None):
+        results = os.path.join(self.tmp_dir, name or "p%d" % partitions,
+                               "results")
+        config = {"dir": {"results": results},
+                  "stage": {"disambiguate": {"engine": "python",
+                                             "partitions": partitions}}}
+        return Disambiguate(config)
+
+    def test_round_trip(self):
+        """
+        test that disambiguating the partitions and combining them gives
+        the same outputs and stats as a single run, and that the partitions
+        are removed afterwards
+        """
+        single = self._stage(1)
+        expected = single._disambiguate(*self.in_files)
+        split = self._stage(4)
+        parts = split.partition(self.in_files)
+        self.assertEqual(len(parts), 4)
+        partition_out = [split.disambiguate_partition(x) for x in parts]
+        out_files = split.combine_partitions(self.in_files, partition_out)
+        self.assertEqual(map(os.path.basename, out_files),
+                         map(os.path.basename, expected))
+        for out_file, expected_file in zip(out_files, expected):
+            self.assertEqual(_read(out_file), _read(expected_file))
+        self.assertTrue(any(_read(x)[1] for x in out_files))
+        stats = []
+        for stage in (split, single):
+            with open(stage.stats_files(self.in_files)[0]) as in_handle:
+                stats.append(json.load(in_handle))
+        self.assertEqual(stats[0], stats[1])
+        self.assertFalse(os.path.exists(split._partition_dir(self.in_files)))
+
+    def test_claimed_name_order(self):
+        """
+        test that inputs claiming to be sorted by read name in another order
+        than the engine needs are sorted again instead of failing halfway
+        """
+        in_files = []
+        for in_file in self.in_files:
+            header, lines = _read(in_file)
+            # natural order like samtools sort -n, r9 before r10
+            lines.sort(key=lambda x: (len(disambiguation.read_name(x)),
+                                      disambiguation.read_name(x)))
+            out_file = os.path.join(self.tmp_dir, os.path.basename(in_file))
+            with open(out_file, "w") as out_handle:
+                out_handle.writelines(
+                    [x.replace("SO:coordinate", "SO:queryname")
+                     for x in header] + lines)
+            in_files.append(out_file)
+        expected = self._stage(1)._disambiguate(*self.in_files)
+        out_files = self._stage(1, "claimed")._disambiguate(*in_files)
+        for out_file, expected_file in zip(out_files, expected):
+            self.assertNotEqual(out_file, expected_file)
+            self.assertEqual(_read(out_file)[1], _read(expected_file)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
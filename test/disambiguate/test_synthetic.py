@@ -0,0 +1,84 @@
+import unittest
+from StringIO import StringIO
+from az import disambiguation, synthetic
+from az.sorting import CoordinateKey, _header_refs
+import shutil
+import tempfile
+import os
+
+
+def _alignments(in_file):
+    with open(in_file) as in_handle:
+        header, lines = disambiguation.read_sam(in_handle)
+        return header, list(lines)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp_dir, "synthetic")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_blocks(self):
+        """
+        test that reads crossing exons are spliced
+        """
+        gene = synthetic.Gene("g", "1", "+", [(100, 150), (300, 400)])
+        self.assertEqual(gene.blocks(0, 40), (101, "40M"))
+        self.assertEqual(gene.blocks(30, 40), (131, "20M150N20M"))
+        self.assertEqual(gene.blocks(60, 40), (311, "40M"))
+
+    def test_disambiguation_matches_truth(self):
+        """
+        test that disambiguating the generated reads puts every read where
+        it came from, including the multimappers
+        """
+        files = synthetic.generate(self.prefix, 2000, ambiguous=0.2,
+                                   multimap=0.2)
+        truth = synthetic.read_truth(files["truth"])
+        self.assertEqual(len(truth), 2000)
+        fractions = float(sum(x == disambiguation.AMBIGUOUS
+                              for x in truth.values())) / len(truth)
+        self.assertAlmostEqual(fractions, 0.2, delta=0.05)
+        out_handles = [StringIO() for _ in range(4)]
+        with open(files["human"]) as human, open(files["mouse"]) as mouse:
+            disambiguation.disambiguate(human, mouse, *out_handles)
+        categories = [disambiguation.HUMAN, disambiguation.AMBIGUOUS,
+                      disambiguation.MOUSE, disambiguation.AMBIGUOUS]
+        for handle, category in zip(out_handles, categories):
+            names = set(disambiguation.read_name(x) for x in
+                        handle.getvalue().splitlines(True)
+                        if not x.startswith("@"))
+            self.assertTrue(names)
+            self.assertTrue(all(truth[x] == category for x in names))
+
+    def test_sort_orders(self):
+        """
+        test that the same alignments come out in each sort order
+        """
+        lines = {}
+        for order in synthetic.SORT_ORDERS:
+            files = synthetic.generate(self.prefix + order, 500,
+                                       sort_order=order, truth=False)
+            header, lines[order] = _alignments(files["human"])
+            self.assertTrue(header[0].startswith("@HD"))
+            self.assertTrue("SO:%s" % order in header[0])
+            if order == "coordinate":
+                key = CoordinateKey(_header_refs(header))
+                keys = [key.key(x)[:2] for x in lines[order]]
+                self.assertEqual(keys, sorted(keys))
+            if order == "queryname":
+                names = map(disambiguation.read_name, lines[order])
+                self.assertEqual(names, sorted(names))
+        self.assertEqual(sorted(lines["queryname"]),
+                         sorted(lines["coordinate"]))
+        self.assertEqual(sorted(lines["queryname"]),
+                         sorted(lines["unsorted"]))
+        self.assertNotEqual(lines["queryname"], lines["unsorted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from az import bam
+
+HUMAN_SAM = os.path.join("test", "data", "small_1.human.sam")
+
+
+def _alignments(lines):
+    return [x for x in lines if not x.startswith("@")]
+
+
+@unittest.skipIf(find_executable("samtools") is None, "needs samtools")
+class TestBam(unittest.TestCase):
+
+    def setUp(self):
+        # shell characters in the path have to reach samtools as they are
+        self.tmp_dir = os.path.join(tempfile.mkdtemp(), "out dir $(touch x)")
+        os.makedirs(self.tmp_dir)
+        with open(HUMAN_SAM) as in_handle:
+            self.lines = in_handle.readlines()
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.tmp_dir))
+
+    def _round_trip(self, out_file, sort, threads):
+        with bam.open_writer(out_file, {}, sort=sort, index=False,
+                             threads=threads) as out_handle:
+            out_handle.writelines(self.lines)
+        self.assertFalse([x for x in os.listdir(self.tmp_dir)
+                          if ".tmp" in x])
+        return _alignments(bam.read_alignments(out_file, {}))
+
+    def test_paths_not_run_by_a_shell(self):
+        """
+        test that sorted and unsorted BAM files are written to a path with
+        spaces and shell characters in it, on one thread and on several
+        """
+        expected = sorted(_alignments(self.lines))
+        for threads in (1, 2):
+            out_file = os.path.join(self.tmp_dir, "s1 %d.bam" % threads)
+            self.assertEqual(sorted(self._round_trip(out_file, True,
+                                                     threads)), expected)
+            self.assertTrue(os.path.exists(out_file + ".bai"))
+            unsorted = os.path.join(self.tmp_dir, "u %d.bam" % threads)
+            self.assertEqual(self._round_trip(unsorted, False, threads),
+                             _alignments(self.lines))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "x")))
+        self.assertFalse(os.path.exists("x"))
+
+    def test_failure(self):
+        """
+        test that a failing pipeline raises and leaves no output behind
+        """
+        out_file = os.path.join(self.tmp_dir, "bad.bam")
+        writer = bam.open_writer(out_file, {}, threads=1)
+        writer.writelines(["not\ta\tSAM\tline\n"])
+        with self.assertRaises(Exception):
+            writer.close()
+        writer.abort()
+        self.assertFalse(os.path.exists(out_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import gzip
+import random
+import unittest
+from StringIO import StringIO
+from az import bgzf
+
+
+def _data(size):
+    rand = random.Random(1)
+    return "".join(rand.choice("ACGT") for _ in range(size))
+
+
+class TestBgzf(unittest.TestCase):
+
+    def _compress(self, data, threads):
+        out_handle = StringIO()
+        with bgzf.BgzfWriter(out_handle, threads=threads) as writer:
+            # odd sized writes so blocks are cut across them
+            for start in range(0, len(data), 10007):
+                writer.write(data[start:start + 10007])
+        return out_handle.getvalue()
+
+    def test_round_trip(self):
+        data = _data(300000)
+        compressed = self._compress(data, 1)
+        self.assertEqual(self._compress(data, 4), compressed)
+        self.assertTrue(compressed.endswith(bgzf.EOF_BLOCK))
+        # every block is a gzip member, so gzip reads the whole file
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(),
+                         data)
+        blocks = list(bgzf.read_blocks(StringIO(compressed)))
+        self.assertEqual(len(blocks), 300000 // bgzf.BLOCK_DATA + 2)
+        for threads in (1, 3):
+            self.assertEqual(bgzf.BgzfReader(StringIO(compressed),
+                                             threads).read(), data)
+
+    def test_recompress(self):
+        data = _data(100000)
+        out_handle = StringIO()
+        with bgzf.BgzfWriter(out_handle, level=0) as writer:
+            writer.write(data)
+        stored = out_handle.getvalue()
+        out_handle = StringIO()
+        bgzf.recompress(StringIO(stored), out_handle, threads=2)
+        self.assertTrue(len(out_handle.getvalue()) < len(stored))
+        self.assertEqual(bgzf.BgzfReader(StringIO(out_handle.getvalue()))
+                         .read(), data)
+
+    def test_corrupt(self):
+        compressed = self._compress(_data(1000), 1)
+        corrupt = compressed[:30] + chr(ord(compressed[30]) ^ 1) + \
+            compressed[31:]
+        with self.assertRaises(Exception):
+            bgzf.BgzfReader(StringIO(corrupt)).read()
+        with self.assertRaises(bgzf.BgzfError):
+            bgzf.BgzfReader(StringIO(compressed[:-40])).read()
+
+
+if __name__ == "__main__":
+    unittest.main()
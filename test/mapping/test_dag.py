@@ -0,0 +1,117 @@
+import imp
+import os
+import sys
+import threading
+import unittest
+from az.dag import DAGExecutor, FunctionJob
+from az.parallel import CancellableView
+
+UNIFIED = os.path.join(os.path.dirname(__file__), "..", "..", "scripts",
+                       "az_pipeline_unified.py")
+
+
+class SerialView(object):
+
+    def map(self, fn, *args):
+        return map(fn, *args)
+
+
+class TestDAG(unittest.TestCase):
+
+    def test_function_jobs(self):
+        """
+        test that function jobs run after the jobs they depend on
+        """
+        done = []
+        executor = DAGExecutor(max_jobs=2)
+        executor.add(FunctionJob("a", done.append, ["a"]))
+        executor.add(FunctionJob("b", done.append, ["b"]))
+        executor.add(FunctionJob("c", done.append, ["c"], depends=["a", "b"]))
+        self.assertTrue(executor.run())
+        self.assertEqual(sorted(done[:2]), ["a", "b"])
+        self.assertEqual(done[2], "c")
+
+    def test_function_exits(self):
+        """
+        test that a job calling sys.exit fails instead of ending its thread
+        and that the jobs depending on it do not start
+        """
+        done = []
+        executor = DAGExecutor(max_jobs=2)
+        executor.add(FunctionJob("a", sys.exit, [1]))
+        executor.add(FunctionJob("b", done.append, ["b"], depends=["a"]))
+        self.assertFalse(executor.run())
+        self.assertEqual(done, [])
+        executor = DAGExecutor()
+        executor.add(FunctionJob("a", sys.exit, [0]))
+        self.assertTrue(executor.run())
+
+    def test_cancel_function_job(self):
+        """
+        test that a function job mapping on a cancellable view stops at its
+        next stage when another job fails
+        """
+        view = CancellableView(SerialView())
+        started = threading.Event()
+        stages = []
+
+        def stage(x):
+            started.set()
+            # the executor cancels the job while this stage runs
+            view._cancelled.wait(10)
+            stages.append(x)
+            return x
+
+        def pipeline():
+            view.map(stage, ["first"])
+            view.map(stage, ["second"])
+
+        def fail():
+            started.wait(10)
+            raise ValueError("failed")
+        executor = DAGExecutor(max_jobs=2)
+        executor.add(FunctionJob("pipeline", pipeline,
+                                 on_cancel=view.cancel))
+        executor.add(FunctionJob("fail", fail))
+        self.assertFalse(executor.run())
+        self.assertEqual(stages, ["first"])
+
+    def test_default_jobs(self):
+        """
+        test that the unified runner runs as many jobs as the cluster has
+        engines by default
+        """
+        unified = imp.load_source("az_pipeline_unified", UNIFIED)
+        self.assertEqual(unified.default_jobs({"cores": 64}), 64)
+        self.assertEqual(unified.default_jobs({"cores": 64,
+                                               "cores_per_job": 8}), 8)
+        self.assertEqual(unified.default_jobs({"cores": 2,
+                                               "cores_per_job": 8}), 1)
+        self.assertTrue(unified.default_jobs({"local": True}) >= 1)
+
+    def test_separate_phases(self):
+        """
+        test that --separate runs each phase once on all of the samples,
+        after the phases it needs
+        """
+        unified = imp.load_source("az_pipeline_unified", UNIFIED)
+        done = []
+        lock = threading.Lock()
+
+        def run(phase, samples):
+            with lock:
+                done.append((phase, samples))
+
+        def make_job(name, phase, samples, depends):
+            return FunctionJob(name, run, [phase, samples], depends=depends)
+        executor = DAGExecutor(max_jobs=4)
+        unified.add_phase_jobs(executor, make_job)
+        self.assertTrue(executor.run())
+        phases = [x for x, _ in done]
+        self.assertEqual(sorted(phases), sorted(unified.PHASES))
+        self.assertEqual([x for _, x in done], [None] * 5)
+        self.assertEqual(phases.index("disambiguate"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
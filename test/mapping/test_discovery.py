@@ -0,0 +1,122 @@
+import unittest
+from az import discovery
+import shutil
+import tempfile
+import threading
+import os
+
+
+def _touch(path):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+
+
+def _age(root, seconds=60):
+    # directories changed just now are always listed again, so make them old
+    for path, _, _ in os.walk(root):
+        then = os.stat(path).st_mtime - seconds
+        os.utime(path, (then, then))
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = os.path.join(self.tmp_dir, "data")
+        for name in ["ctrl_1.fq", "ctrl_2.fq", "run/treat.fastq.gz",
+                     "run/notes.txt"]:
+            _touch(os.path.join(self.data, name))
+        self.manifest_file = os.path.join(self.tmp_dir, "samples.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan(self):
+        """
+        test that a single scan finds the files of all of the patterns
+        """
+        manifest = discovery.SampleManifest(self.manifest_file)
+        files = manifest.scan([self.data], discovery.FASTQ_PATTERNS)
+        self.assertEqual([os.path.relpath(x, self.data) for x in files],
+                         ["ctrl_1.fq", "ctrl_2.fq", "run/treat.fastq.gz"])
+        self.assertEqual(manifest.listed, 2)
+
+    def test_incremental(self):
+        """
+        test that only directories that changed are listed again
+        """
+        _age(self.data)
+        manifest = discovery.SampleManifest(self.manifest_file)
+        manifest.scan([self.data], discovery.FASTQ_PATTERNS)
+        manifest.save()
+        manifest = discovery.SampleManifest(self.manifest_file)
+        manifest.scan([self.data], discovery.FASTQ_PATTERNS)
+        self.assertEqual(manifest.listed, 0)
+        _touch(os.path.join(self.data, "run", "new_1.fq"))
+        manifest.save()
+        manifest = discovery.SampleManifest(self.manifest_file)
+        files = manifest.scan([self.data], discovery.FASTQ_PATTERNS)
+        self.assertEqual(manifest.listed, 1)
+        self.assertTrue(os.path.join(self.data, "run", "new_1.fq") in files)
+
+    def test_threads(self):
+        """
+        test that threads of one process finding the samples at the same
+        time all succeed
+        """
+        config = {"dir": {"manifest": os.path.join(self.tmp_dir, "manifest")}}
+        found = []
+
+        def find():
+            for _ in range(20):
+                found.append(discovery.fastq_samples(config, self.data))
+        threads = [threading.Thread(target=find) for _ in range(4)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        self.assertEqual(len(found), 80)
+        self.assertTrue(all(x == found[0] for x in found))
+
+    def test_pair_fastq(self):
+        samples = discovery.pair_fastq(["d/ctrl_1.fq", "d/ctrl_2.fq",
+                                        "d/treat.fq", "d/s1_R1.fastq"])
+        self.assertEqual(samples, {"ctrl": ["d/ctrl_1.fq", "d/ctrl_2.fq"],
+                                   "treat": ["d/treat.fq"],
+                                   "s1_R1": ["d/s1_R1.fastq"]})
+
+    def test_pair_genomes(self):
+        """
+        test that genomes are paired by sample and not by sort order
+        """
+        pairs = discovery.pair_genomes(["h/b.human.sam", "h/a.human.sam"],
+                                       ["m/a.mouse.sam", "m/b.mouse.sam"])
+        self.assertEqual(pairs, {"a": ["h/a.human.sam", "m/a.mouse.sam"],
+                                 "b": ["h/b.human.sam", "m/b.mouse.sam"]})
+        self.assertRaises(ValueError, discovery.pair_genomes,
+                          ["h/a.sam", "h/c.sam"], ["m/a.sam", "m/b.sam"])
+
+    def test_genome_samples(self):
+        """
+        test that only the symbolic links are found and are kept by sample
+        """
+        config = {"dir": {"manifest": os.path.join(self.tmp_dir, "m")}}
+        for genome in ["human", "mouse"]:
+            for sample in ["s1", "s2"]:
+                target = os.path.join(self.tmp_dir, genome, sample, "hits.sam")
+                _touch(target)
+                os.symlink(target, os.path.join(self.tmp_dir, genome,
+                                                "%s.sam" % sample))
+        pairs = discovery.genome_samples(config,
+                                         os.path.join(self.tmp_dir, "human"),
+                                         os.path.join(self.tmp_dir, "mouse"))
+        self.assertEqual([[os.path.relpath(x, self.tmp_dir) for x in y]
+                          for y in pairs],
+                         [["human/s1.sam", "mouse/s1.sam"],
+                          ["human/s2.sam", "mouse/s2.sam"]])
+        self.assertTrue(os.path.exists(discovery.manifest_file(
+            config, "genomes", [os.path.join(self.tmp_dir, "human"),
+                                os.path.join(self.tmp_dir, "mouse")])))
+
+
+if __name__ == "__main__":
+    unittest.main()
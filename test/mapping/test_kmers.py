@@ -0,0 +1,220 @@
+import unittest
+import json
+import random
+import shutil
+import tempfile
+import os
+import threading
+import numpy as np
+from az import kmers
+from az.plugins.kmer import KmerClassify, read_decisions
+
+COMPLEMENT = dict(zip("ACGT", "TGCA"))
+
+
+def _reverse_complement(seq):
+    return "".join(COMPLEMENT[x] for x in reversed(seq))
+
+
+def _value(seq):
+    value = 0
+    for base in seq:
+        value = value * 4 + "ACGT".index(base)
+    return value
+
+
+def _random_seq(rand, n):
+    return "".join(rand.choice("ACGT") for _ in range(n))
+
+
+class TestKmers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rand = random.Random(1)
+        shared = _random_seq(rand, 300)
+        self.human = _random_seq(rand, 600)
+        self.mouse = _random_seq(rand, 600)
+        self.shared = shared
+        self.human_fasta = self._fasta("human.fa", [self.human, shared])
+        self.mouse_fasta = self._fasta("mouse.fa", [self.mouse, shared])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _fasta(self, name, seqs):
+        out_file = os.path.join(self.tmp_dir, name)
+        with open(out_file, "w") as out_handle:
+            for i, seq in enumerate(seqs):
+                out_handle.write(">seq%d\n" % i)
+                for start in range(0, len(seq), 60):
+                    out_handle.write(seq[start:start + 60] + "\n")
+        return out_file
+
+    def test_canonical_kmers(self):
+        """
+        test that the k-mers are the smaller of each k-mer and its reverse
+        complement and that k-mers with an N are left out
+        """
+        seq = "ACGTTGCANNAGGCTTACGATCGGATTACAGGT"
+        for k in (3, 5, 32):
+            found, starts = kmers.canonical_kmers(kmers.encode(seq), k)
+            expected = [(i, min(_value(seq[i:i + k]),
+                                _value(_reverse_complement(seq[i:i + k]))))
+                        for i in range(len(seq) - k + 1)
+                        if "N" not in seq[i:i + k]]
+            self.assertEqual(starts.tolist(), [x for x, _ in expected])
+            self.assertEqual(found.tolist(), [x for _, x in expected])
+
+    def test_classify(self):
+        """
+        test that reads from either strand of one genome are sure and reads
+        of the sequence both genomes have are uncertain
+        """
+        index = kmers.KmerIndex.from_fasta(self.human_fasta, self.mouse_fasta,
+                                           k=21, sample=2, min_bases=0)
+        reads = [[self.human[100:150], _reverse_complement(self.human[300:350])],
+                 [_reverse_complement(self.mouse[200:260])],
+                 [self.shared[50:100], self.shared[150:200]],
+                 [self.human[100:150], self.mouse[100:150]]]
+        codes = index.classify(reads)
+        self.assertEqual(codes.tolist(), [kmers.HUMAN_CODE, kmers.MOUSE_CODE,
+                                          kmers.UNCERTAIN_CODE,
+                                          kmers.UNCERTAIN_CODE])
+
+    def test_genomes_required(self):
+        """
+        test that references too small to be whole genomes are refused, a
+        transcriptome would call reads of the other genome sure
+        """
+        self.assertRaises(ValueError, kmers.KmerIndex.from_fasta,
+                          self.human_fasta, self.mouse_fasta)
+        self.assertRaises(ValueError, kmers.KmerIndex.from_fasta,
+                          self.human_fasta, self.mouse_fasta, min_bases=901)
+
+    def test_compile_index(self):
+        """
+        test that the compiled index is loaded back the same and is only
+        compiled once
+        """
+        ref_dir = os.path.join(self.tmp_dir, "ref")
+        index_dir = kmers.compile_index(self.human_fasta, self.mouse_fasta,
+                                        ref_dir, k=21, sample=2, min_bases=0)
+        self.assertEqual(kmers.compile_index(self.human_fasta,
+                                             self.mouse_fasta, ref_dir,
+                                             k=21, sample=2, min_bases=0),
+                         index_dir)
+        loaded = kmers.load_index(self.human_fasta, self.mouse_fasta,
+                                  ref_dir, k=21, sample=2, min_bases=0)
+        built = kmers.KmerIndex.from_fasta(self.human_fasta, self.mouse_fasta,
+                                           k=21, sample=2, min_bases=0)
+        self.assertTrue(np.array_equal(loaded.human, built.human))
+        self.assertTrue(np.array_equal(loaded.mouse, built.mouse))
+        # next to the lock taken while compiling
+        self.assertEqual([x for x in os.listdir(os.path.join(ref_dir,
+                                                             "kmer_index"))
+                          if not x.endswith(".lock")],
+                         [os.path.basename(index_dir)])
+
+    def test_compile_once(self):
+        """
+        test that jobs compiling the same index at the same time wait for
+        the first one instead of compiling it too
+        """
+        built = []
+        from_fasta = kmers.KmerIndex.from_fasta.im_func
+
+        def counting_from_fasta(cls, *args):
+            built.append(args)
+            return from_fasta(cls, *args)
+        kmers.KmerIndex.from_fasta = classmethod(counting_from_fasta)
+        self.addCleanup(setattr, kmers.KmerIndex, "from_fasta",
+                        classmethod(from_fasta))
+        ref_dir = os.path.join(self.tmp_dir, "ref")
+        found = []
+
+        def compile_index():
+            found.append(kmers.compile_index(self.human_fasta,
+                                             self.mouse_fasta, ref_dir, k=21,
+                                             sample=2, min_bases=0))
+        threads = [threading.Thread(target=compile_index) for _ in range(4)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        self.assertEqual(len(built), 1)
+        self.assertEqual(len(set(found)), 1)
+        self.assertEqual(len(found), 4)
+
+    def _write_sample(self):
+        in_files = [os.path.join(self.tmp_dir, "s1_%d.fq" % x) for x in (1, 2)]
+        reads = [("h", self.human[0:50], self.human[400:450]),
+                 ("m", self.mouse[0:50], self.mouse[400:450]),
+                 ("u", self.shared[0:50], self.shared[200:250])]
+        for mate, in_file in enumerate(in_files):
+            with open(in_file, "w") as out_handle:
+                for read in reads:
+                    out_handle.write("@%s/%d\n%s\n+\n%s\n"
+                                     % (read[0], mate + 1, read[mate + 1],
+                                        "I" * 50))
+        return in_files
+
+    def _stage_config(self, genome):
+        return {"dir": {"results": os.path.join(self.tmp_dir, "results",
+                                                "%s_mapping" % genome),
+                        "ref": os.path.join(self.tmp_dir, "ref")},
+                "stage": {"kmer_classify": {
+                    "genome": genome, "human": self.human_fasta,
+                    "mouse": self.mouse_fasta, "k": 21, "sample": 2,
+                    "min_bases": 0}}}
+
+    def test_classify_once(self):
+        """
+        test that the human and mouse mapping of a sample running the stage
+        at the same time only classify the reads once
+        """
+        in_files = self._write_sample()
+        stages = [KmerClassify(self._stage_config(x)) for x in
+                  ("human", "mouse", "human", "mouse")]
+        classified = []
+        for stage in stages:
+            classify = stage.classify
+            stage.classify = lambda x, classify=classify: (
+                classified.append(x), classify(x))[1]
+        out_files = []
+        threads = [threading.Thread(target=lambda x=x: out_files.append(
+            x(in_files))) for x in stages]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        self.assertEqual(len(classified), 1)
+        self.assertEqual(len(out_files), 4)
+        self.assertTrue(all(map(os.path.exists, sum(out_files, []))))
+
+    def test_stage(self):
+        """
+        test that each genome gets its own and the uncertain reads, with the
+        mates kept together, and that the decisions are written
+        """
+        in_files = self._write_sample()
+        config = self._stage_config("human")
+        out_files = KmerClassify(config)(in_files)
+        self.assertEqual(out_files, [os.path.join(
+            self.tmp_dir, "results", "kmer_classify", "human",
+            os.path.basename(x)) for x in in_files])
+        for mate, out_file in enumerate(out_files):
+            with open(out_file) as in_handle:
+                names = in_handle.readlines()[::4]
+            self.assertEqual(names, ["@h/%d\n" % (mate + 1),
+                                     "@u/%d\n" % (mate + 1)])
+        config["stage"]["kmer_classify"]["genome"] = "mouse"
+        mouse_files = KmerClassify(config)(in_files)
+        with open(mouse_files[0]) as in_handle:
+            self.assertEqual(in_handle.readlines()[::4], ["@m/1\n", "@u/1\n"])
+        decisions_file = os.path.join(self.tmp_dir, "results",
+                                      "kmer_classify", "s1.kmer_decisions.json")
+        self.assertEqual(read_decisions(decisions_file),
+                         {"human": 1, "mouse": 1, "uncertain": 1})
+        with open(decisions_file) as in_handle:
+            self.assertEqual(json.load(in_handle)["sample"], "s1")
+
+
+if __name__ == "__main__":
+    unittest.main()
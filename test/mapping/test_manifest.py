@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+import unittest
+from az import trace
+from az.manifest import RunManifest, cached_map, content_hash
+
+
+def _copy(in_file, config=None):
+    # writes in_file with the suffix of the config to in_file.out
+    out_file = in_file + ".out"
+    with open(in_file) as in_handle, open(out_file, "w") as out_handle:
+        out_handle.write(in_handle.read() + (config or {}).get("suffix", ""))
+    return out_file
+
+
+def _same(in_file):
+    # a stage that passes its input on
+    return in_file
+
+
+class SerialView(object):
+    """
+    runs the calls in this process, counting them
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def map(self, fn, *args):
+        self.calls.extend(args[0])
+        return map(fn, *args)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"dir": {"manifest": os.path.join(self.tmp_dir,
+                                                        "manifest")},
+                       "stage": {"copy": {"program": None}}}
+        self.in_file = os.path.join(self.tmp_dir, "s1.txt")
+        with open(self.in_file, "w") as out_handle:
+            out_handle.write("reads\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_lookup_invalidate(self):
+        """
+        test that recorded work is found until it is invalidated, which
+        removes the outputs
+        """
+        manifest = RunManifest(self.config)
+        self.assertFalse(manifest.is_done("copy", self.in_file, _copy))
+        self.assertEqual(manifest.lookup("copy", self.in_file, _copy), None)
+        out_file = _copy(self.in_file)
+        manifest.record("copy", self.in_file, _copy, out_file)
+        self.assertTrue(manifest.is_done("copy", self.in_file, _copy))
+        self.assertEqual(manifest.lookup("copy", self.in_file, _copy),
+                         out_file)
+        self.assertFalse(manifest.is_done("copy", self.in_file, _same))
+        manifest.invalidate("copy", self.in_file, _copy)
+        self.assertFalse(os.path.exists(out_file))
+        self.assertTrue(os.path.exists(self.in_file))
+        self.assertFalse(manifest.is_done("copy", self.in_file, _copy))
+        # nothing recorded is nothing to remove
+        manifest.invalidate("copy", self.in_file, _copy)
+
+    def test_inputs_protected(self):
+        """
+        test that invalidating a stage that passed its input on leaves the
+        input alone and still removes directories it made
+        """
+        manifest = RunManifest(self.config)
+        out_dir = os.path.join(self.tmp_dir, "s1_out")
+        os.makedirs(out_dir)
+        open(os.path.join(out_dir, "part"), "w").close()
+        manifest.record("copy", self.in_file, _same, [self.in_file, out_dir])
+        manifest.invalidate("copy", self.in_file, _same)
+        self.assertTrue(os.path.exists(self.in_file))
+        self.assertFalse(os.path.exists(out_dir))
+
+    def test_truncated_output(self):
+        """
+        test that a truncated output makes cached_map run the input again
+        and the untouched ones are skipped
+        """
+        view = SerialView()
+        out_files = cached_map(view, self.config, "copy", _copy,
+                               [self.in_file])
+        self.assertEqual(cached_map(view, self.config, "copy", _copy,
+                                    [self.in_file]), out_files)
+        self.assertEqual(view.calls, [self.in_file])
+        with open(out_files[0], "r+") as out_handle:
+            out_handle.truncate(2)
+        cached_map(view, self.config, "copy", _copy, [self.in_file])
+        self.assertEqual(view.calls, [self.in_file] * 2)
+        with open(out_files[0]) as in_handle:
+            self.assertEqual(in_handle.read(), "reads\n")
+
+    def test_changed_args(self):
+        """
+        test that changing the other arguments of the calls runs them again
+        """
+        view = SerialView()
+        for suffix in ["a", "a", "b"]:
+            out_files = cached_map(view, self.config, "copy", _copy,
+                                   [self.in_file], [{"suffix": suffix}])
+        self.assertEqual(len(view.calls), 2)
+        with open(out_files[0]) as in_handle:
+            self.assertEqual(in_handle.read(), "reads\nb")
+
+    def test_new_run(self):
+        """
+        test that starting a new run, which gives the config a new trace,
+        does not make the calls that were handed the config run again
+        """
+        view = SerialView()
+        self.config["log_dir"] = os.path.join(self.tmp_dir, "log")
+        for parallel in ["a", "b"]:
+            trace.start_run(self.config, "test")
+            self.config["trace"]["run"] += parallel
+            self.config["parallel"] = {"cores": parallel}
+            cached_map(view, self.config, "copy", _copy, [self.in_file],
+                       [self.config])
+        self.assertEqual(view.calls, [self.in_file])
+
+    def test_content_hash(self):
+        """
+        test that the hash of a whole file is only computed again when its
+        size or modification time change
+        """
+        cache_dir = os.path.join(self.tmp_dir, "hashes")
+        # whole seconds, so setting them again gives the same time
+        os.utime(self.in_file, (1000000000, 1000000000))
+        first = content_hash(self.in_file, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        with open(self.in_file, "w") as out_handle:
+            out_handle.write("Reads\n")
+        os.utime(self.in_file, (1000000000, 1000000000))
+        self.assertEqual(content_hash(self.in_file, cache_dir), first)
+        os.utime(self.in_file, (1000000000, 1000000001))
+        self.assertNotEqual(content_hash(self.in_file, cache_dir), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import threading
+import unittest
+from az import parallel
+from az.parallel import LocalView, SharedView, local_view
+
+
+def _add(x, y):
+    return x + y
+
+
+def _pid(x):
+    return os.getpid()
+
+
+def _fail(x):
+    raise ValueError(x)
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_map(self):
+        with local_view(cores=2) as view:
+            self.assertEqual(view.map(_add, [1, 2, 3], [10, 20, 30]),
+                             [11, 22, 33])
+            self.assertEqual(view.map(_add, [], []), [])
+            self.assertNotIn(os.getpid(), view.map(_pid, range(4)))
+
+    def test_no_block(self):
+        with local_view(cores=2) as view:
+            result = view.map(_add, [1, 2], [3, 4], block=False)
+            self.assertEqual(result.get(), [4, 6])
+            self.assertTrue(result.ready())
+
+    def test_errors(self):
+        with local_view(cores=2) as view:
+            with self.assertRaises(ValueError):
+                view.map(_fail, [1])
+            with self.assertRaises(TypeError):
+                view.map(_add, [1], [2], blocking=False)
+
+    def test_processes(self):
+        view = LocalView(cores=1000, cores_per_job=1)
+        self.assertTrue(view.processes <= 1000)
+        view.close()
+        view = LocalView(cores=4, cores_per_job=10000)
+        self.assertEqual(view.processes, 1)
+        view.close()
+
+    def test_shared_view(self):
+        """
+        test that several threads can map on one view at once
+        """
+        poll_seconds, parallel.POLL_SECONDS = parallel.POLL_SECONDS, 0.01
+        self.addCleanup(setattr, parallel, "POLL_SECONDS", poll_seconds)
+        results = {}
+
+        def run(n):
+            results[n] = shared.map(_add, range(n), range(n))
+        with local_view(cores=2) as view:
+            shared = SharedView(view)
+            threads = [threading.Thread(target=run, args=(x,))
+                       for x in range(1, 6)]
+            [x.start() for x in threads]
+            [x.join() for x in threads]
+            self.assertEqual(shared.map(_add, [1], [2], block=False).get(),
+                             [3])
+            with self.assertRaises(ValueError):
+                shared.map(_fail, [1])
+        self.assertEqual(results, dict((x, range(0, 2 * x, 2))
+                                       for x in range(1, 6)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import subprocess
+import sys
+import unittest
+from az import plugins
+from az.plugins import StageRepository
+from az.sorting import ExternalSorter
+
+
+class TestPlugins(unittest.TestCase):
+
+    def test_lazy_lookup(self):
+        """
+        test that stages are only imported when they are looked up
+        """
+        repository = StageRepository({}, {"sort": "az.sorting:ExternalSorter"})
+        self.assertEqual(repository.plugins, ["sort"])
+        self.assertTrue("sort" in repository)
+        self.assertEqual(repository.loaded, {})
+        self.assertTrue(repository["sort"] is ExternalSorter)
+        self.assertEqual(repository.loaded.keys(), ["sort"])
+
+    def test_stage_names(self):
+        """
+        test that the az stages are registered under their own stage names
+        """
+        repository = StageRepository({})
+        for stage, path in plugins.STAGES.items():
+            if path.startswith("az."):
+                self.assertEqual(repository[stage].stage, stage)
+
+    def test_disambiguate_imports(self):
+        """
+        test that unpickling the disambiguate stage on an engine does not
+        pull in numpy, only the engines that use it do
+        """
+        imported = subprocess.check_output(
+            [sys.executable, "-c", "import sys, az.plugins.disambiguate; "
+             "print sorted(x for x in ['numpy', 'az.columns', 'az.kmers'] "
+             "if x in sys.modules)"])
+        self.assertEqual(imported.strip(), "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()
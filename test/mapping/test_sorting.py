@@ -0,0 +1,84 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from az import sorting
+
+HEADER = ["@HD\tVN:1.0\tSO:unsorted\n", "@SQ\tSN:2\tLN:1000\n",
+          "@SQ\tSN:1\tLN:1000\n"]
+
+
+def _line(name, flag, chrom, pos):
+    return "\t".join([name, str(flag), chrom, str(pos), "255", "10M", "*",
+                      "0", "0", "A" * 10, "I" * 10]) + "\n"
+
+
+class TestSorting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rand = random.Random(1)
+        self.lines = []
+        for i in range(500):
+            chrom = rand.choice(["1", "2"])
+            self.lines.append(_line("r%d" % i, 65, chrom,
+                                    rand.randint(1, 990)))
+            self.lines.append(_line("r%d" % i, 129, chrom,
+                                    rand.randint(1, 990)))
+        self.lines.append(_line("u1", 4, "*", 0))
+        rand.shuffle(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _sort(self, order, memory):
+        sorter = sorting.ExternalSorter(order, memory, self.tmp_dir,
+                                        max_open_runs=3)
+        return list(sorter.sort(HEADER + self.lines)), sorter
+
+    def test_parse_memory(self):
+        self.assertEqual(sorting.parse_memory("2G"), 2 * 1024 ** 3)
+        self.assertEqual(sorting.parse_memory("512m"), 512 * 1024 ** 2)
+        self.assertEqual(sorting.parse_memory(1000), 1000)
+
+    def test_coordinate(self):
+        out, sorter = self._sort("coordinate", 10000)
+        self.assertTrue(len(sorter.runs) > 1)
+        self.assertEqual(out[0], "@HD\tVN:1.0\tSO:coordinate\n")
+        self.assertEqual(out[1:3], HEADER[1:])
+        alignments = out[3:]
+        self.assertEqual(sorted(alignments), sorted(self.lines))
+        refs = {"2": 0, "1": 1, "*": 2}
+        keys = [(refs[x.split("\t")[2]], int(x.split("\t")[3]))
+                for x in alignments]
+        self.assertEqual(keys[:-1], sorted(keys[:-1]))
+        self.assertTrue(alignments[-1].startswith("u1\t"))
+        # in memory sorts give the same result
+        self.assertEqual(self._sort("coordinate", 10 ** 9)[0], out)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_queryname(self):
+        out, _ = self._sort("queryname", 10000)
+        self.assertEqual(out[0], "@HD\tVN:1.0\tSO:queryname\n")
+        alignments = out[3:]
+        self.assertEqual(sorted(alignments), sorted(self.lines))
+        names = [x.split("\t")[0] for x in alignments]
+        self.assertEqual(names, sorted(names))
+        flags = [int(x.split("\t")[1]) for x in alignments]
+        for i in range(0, len(names) - 1):
+            if names[i] == names[i + 1]:
+                self.assertTrue(flags[i] & 0x40 and flags[i + 1] & 0x80)
+
+    def test_checked_coordinate_order(self):
+        out, _ = self._sort("coordinate", 10 ** 9)
+        self.assertEqual(list(sorting._checked_coordinate_order(out)), out)
+        with self.assertRaises(sorting.UnsortedInput):
+            list(sorting._checked_coordinate_order(HEADER + self.lines))
+        with self.assertRaises(sorting.UnsortedInput):
+            list(sorting._checked_coordinate_order(out[:3] + out[4:] +
+                                                   out[3:4]))
+
+
+if __name__ == "__main__":
+    unittest.main()
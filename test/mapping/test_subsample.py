@@ -0,0 +1,111 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from az import subsample
+
+READS = 1000
+
+
+def _write_pair(prefix, suffix):
+    files = [prefix + "_%d.fq%s" % (x, suffix) for x in (1, 2)]
+    for mate, in_file in enumerate(files):
+        out_handle = subsample.open_fastq(in_file, "w")
+        for i in range(READS):
+            out_handle.write("@r%d/%d\n%s\n+\n%s\n"
+                             % (i, mate + 1, "ACGT"[(i + mate) % 4] * 20,
+                                "I" * 20))
+        out_handle.close()
+    return files
+
+
+def _names(in_file):
+    with subsample.open_fastq(in_file) as in_handle:
+        return [subsample.read_name(x)
+                for x in subsample.read_fastq(in_handle)]
+
+
+class TestSubsample(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _out_files(self, name):
+        return [os.path.join(self.tmp_dir, "%s_%d.fq.gz" % (name, x))
+                for x in (1, 2)]
+
+    def test_reads(self):
+        """
+        test that exactly reads pairs are kept in their input order, with
+        the mates in sync, the same ones for the same seed
+        """
+        in_files = _write_pair(os.path.join(self.tmp_dir, "s1"), ".gz")
+        out_files = subsample.subsample(in_files, self._out_files("a"),
+                                        reads=100)
+        first, second = map(_names, out_files)
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 100)
+        self.assertEqual(first, sorted(first, key=lambda x: int(x[1:])))
+        again = subsample.subsample(in_files, self._out_files("b"),
+                                    reads=100)
+        self.assertEqual(map(_names, again), [first, first])
+        # more reads than there are keeps all of them
+        subsample.subsample(in_files, self._out_files("c"), reads=2 * READS)
+        self.assertEqual(len(_names(self._out_files("c")[1])), READS)
+
+    def test_fraction(self):
+        """
+        test that about fraction of the pairs are kept, with the mates in
+        sync, from plain and gzipped files alike
+        """
+        plain = _write_pair(os.path.join(self.tmp_dir, "p"), "")
+        zipped = _write_pair(os.path.join(self.tmp_dir, "z"), ".gz")
+        kept = []
+        for name, in_files in [("p", plain), ("z", zipped)]:
+            out_files = subsample.subsample(
+                in_files, self._out_files(name + "_out"), fraction=0.2)
+            first, second = map(_names, out_files)
+            self.assertEqual(first, second)
+            kept.append(first)
+        self.assertEqual(kept[0], kept[1])
+        self.assertTrue(0.1 * READS < len(kept[0]) < 0.3 * READS)
+        # the outputs really are gzipped
+        with gzip.open(self._out_files("z_out")[0]) as in_handle:
+            self.assertTrue(in_handle.readline().startswith("@r"))
+
+    def test_make_test(self):
+        """
+        test that make_test takes the number of reads from the config,
+        reuses the subset it made before and takes a new one when the
+        settings change
+        """
+        in_files = _write_pair(os.path.join(self.tmp_dir, "s1"), ".gz")
+        config = {"dir": {"results": os.path.join(self.tmp_dir, "results")},
+                  "test_pipeline": {"reads": 10}}
+        out_files = subsample.make_test(in_files, config)
+        self.assertEqual([os.path.basename(x) for x in out_files],
+                         ["s1_1_test.fq", "s1_2_test.fq"])
+        self.assertEqual(map(len, map(_names, out_files)), [10, 10])
+        # a subset that is reused is not written again
+        os.utime(out_files[0], (1000000000, 1000000000))
+        subsample.make_test(in_files, config)
+        self.assertEqual(os.path.getmtime(out_files[0]), 1000000000)
+        config["test_pipeline"]["reads"] = 20
+        self.assertEqual(map(len, map(_names, subsample.make_test(
+            in_files, config))), [20, 20])
+        first = _names(out_files[0])
+        config["test_pipeline"]["seed"] = 1
+        self.assertNotEqual(_names(subsample.make_test(in_files, config)[0]),
+                            first)
+        del config["test_pipeline"]["reads"]
+        config["test_pipeline"]["fraction"] = 0.5
+        self.assertTrue(20 < len(_names(subsample.make_test(
+            in_files, config)[0])) < READS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+from az import disambiguation
+from az.plugins import custom_tophat
+from az.plugins.custom_tophat import TophatDisambiguate
+
+HUMAN_SAM = os.path.join("test", "data", "small_1.human.sam")
+MOUSE_SAM = os.path.join("test", "data", "small_1.mouse.sam")
+
+
+class FakeTophat(object):
+    """
+    stands in for tophat, links a copy of a SAM file under a descriptive
+    name like tophat does
+    """
+    sam_file = None
+
+    def __init__(self, config):
+        self.config = config
+        self.tmp_dir = config["dir"]["tmp"]
+
+    def __call__(self, in_file):
+        tophat_dir = os.path.join(self.tmp_dir, "tophat",
+                                  os.path.basename(self.sam_file))
+        os.makedirs(tophat_dir)
+        real_file = os.path.join(tophat_dir, "accepted_hits.sam")
+        shutil.copy(self.sam_file, real_file)
+        out_file = os.path.join(self.tmp_dir, os.path.basename(self.sam_file))
+        os.symlink(real_file, out_file)
+        return out_file
+
+
+class FakeHuman(FakeTophat):
+    stage = "tophat_human"
+    sam_file = HUMAN_SAM
+
+
+class FakeMouse(FakeTophat):
+    stage = "tophat_mouse"
+    sam_file = MOUSE_SAM
+
+
+class TestTophatDisambiguate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"dir": {"results": os.path.join(self.tmp_dir,
+                                                       "results"),
+                               "manifest": os.path.join(self.tmp_dir,
+                                                        "manifest"),
+                               "tmp": self.tmp_dir},
+                       "parallel": {"type": "local", "cores": 1},
+                       "stage": {"tophat_disambiguate": {"cleanup": True},
+                                 "disambiguate": {"engine": "python"}}}
+        for name, fake in (("TophatHuman", FakeHuman),
+                           ("TophatMouse", FakeMouse)):
+            self.addCleanup(setattr, custom_tophat, name,
+                            getattr(custom_tophat, name))
+            setattr(custom_tophat, name, fake)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_call(self):
+        """
+        test that both alignments of a sample are disambiguated and that
+        cleanup removes the tophat SAM files and their links
+        """
+        stage = TophatDisambiguate(self.config)
+        out_files = stage(["s1_1.fq", "s1_2.fq"])
+        self.assertEqual(len(out_files), 4)
+        self.assertTrue(all(map(os.path.exists, out_files)))
+        with open(out_files[0]) as in_handle:
+            self.assertTrue(disambiguation.read_sam(in_handle)[1])
+        for sam_file in (HUMAN_SAM, MOUSE_SAM):
+            base = os.path.basename(sam_file)
+            self.assertFalse(os.path.lexists(os.path.join(self.tmp_dir,
+                                                          base)))
+            self.assertFalse(os.path.exists(os.path.join(
+                self.tmp_dir, "tophat", base, "accepted_hits.sam")))
+
+    def test_keep_without_cleanup(self):
+        """
+        test that the tophat SAM files are kept unless cleanup is set
+        """
+        self.config["stage"]["tophat_disambiguate"]["cleanup"] = False
+        TophatDisambiguate(self.config)(["s1_1.fq", "s1_2.fq"])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmp_dir, os.path.basename(HUMAN_SAM))))
+
+    def test_threads_split(self):
+        """
+        test that the two tophat runs share the threads of the engine
+        """
+        self.config["cluster"] = {"cores_per_job": 8}
+        self.config["stage"]["tophat_mouse"] = {"options": {"p": 6}}
+        stage = TophatDisambiguate(self.config)
+        human, mouse = [x.config for x in stage.aligners]
+        self.assertEqual(human["stage"]["tophat_human"]["options"],
+                         {"num-threads": 4})
+        self.assertEqual(human["cluster"]["cores_per_job"], 4)
+        self.assertEqual(mouse["stage"]["tophat_mouse"]["options"],
+                         {"num-threads": 3})
+        self.config["cluster"] = {"cores_per_job": 1}
+        stage = TophatDisambiguate(self.config)
+        self.assertEqual(stage.aligners[0].config["cluster"]
+                         ["cores_per_job"], 1)
+        self.assertEqual(self.config["stage"]["tophat_mouse"]["options"],
+                         {"p": 6})
+
+    def test_cleanup_index_refused(self):
+        """
+        test that cleaning up is refused when the index of the ambiguous
+        reads points into the tophat SAM files
+        """
+        self.config["stage"]["disambiguate"] = {"engine": "columnar",
+                                                "ambiguous": "index"}
+        self.assertRaises(SystemExit, TophatDisambiguate, self.config)
+        self.config["stage"]["tophat_disambiguate"]["cleanup"] = False
+        self.assertEqual(TophatDisambiguate(self.config).disambiguate.ambiguous,
+                         "index")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from az import trace
+from az.parallel import local_view
+
+
+def _work(in_file, seconds):
+    subprocess.check_call(["sleep", str(seconds)])
+    with open(in_file, "w") as out_handle:
+        out_handle.write("x" * 100000)
+    return in_file
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"log_dir": os.path.join(self.tmp_dir, "log")}
+        trace.start_run(self.config, "test")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_span(self):
+        in_file = os.path.join(self.tmp_dir, "s1_1.fq")
+        fn = trace.traced(self.config, "work", _work)
+        fn(in_file, 0.1)
+        with self.assertRaises(ValueError):
+            with trace.span(trace.trace_file(self.config), "fail"):
+                raise ValueError("failed")
+        work, fail = trace.read_records(trace.trace_file(self.config))
+        self.assertEqual(work["stage"], "work")
+        self.assertEqual(work["item"], "s1_1")
+        self.assertTrue(work["wall"] >= 0.1)
+        self.assertTrue(work["write_bytes"] >= 100000)
+        self.assertTrue(work["max_rss_kb"] > 0)
+        self.assertIsNone(work["error"])
+        self.assertEqual(fail["error"], "ValueError: failed")
+
+    def test_untraced(self):
+        self.assertIs(trace.traced({}, "work", _work), _work)
+
+    def test_finish_run(self):
+        in_files = [os.path.join(self.tmp_dir, "s%d.sam" % i)
+                    for i in range(3)]
+        with local_view(cores=2) as view:
+            view.map(trace.traced(self.config, "slow", _work), in_files,
+                     [0.3, 0.1, 0.1])
+            view.map(trace.traced(self.config, "fast", _work), in_files,
+                     [0.0, 0.0, 0.1])
+        records = trace.read_records(trace.trace_file(self.config))
+        path, _ = trace.critical_path(records)
+        self.assertEqual([(x["stage"], x["item"]) for x in path],
+                         [("slow", "s0"), ("fast", "s2")])
+        trace_json = trace.finish_run(self.config)
+        with open(trace_json) as in_handle:
+            events = json.load(in_handle)["traceEvents"]
+        self.assertEqual(len([x for x in events if x["ph"] == "X"]), 6)
+        prefix = os.path.splitext(trace.trace_file(self.config))[0]
+        self.assertEqual(trace_json, prefix + ".trace.json")
+        self.assertTrue(os.path.exists(prefix + ".summary.txt"))
+
+    def test_runs_in_one_process(self):
+        """
+        test that runs started by one process in the same second get their
+        own trace files
+        """
+        files = [trace.start_run(dict(self.config), "test")
+                 for _ in range(3)]
+        self.assertEqual(len(set(files)), 3)
+
+    def test_shared_run(self):
+        """
+        test that the pipelines of the unified runner trace into its run,
+        which records the chain of jobs the run waited on
+        """
+        trace_file = trace.trace_file(self.config)
+        jobs = {"map_a": [], "map_b": [], "count": ["map_a", "map_b"]}
+        # count waits on map_a, which finishes last
+        for name, seconds in [("map_b", 0.0), ("map_a", 0.2),
+                              ("count", 0.0)]:
+            config = {"log_dir": self.config["log_dir"],
+                      "trace": trace.shared_trace(self.config)}
+            self.assertEqual(trace.start_run(config, "mapping"), trace_file)
+
+            def pipeline(config, seconds):
+                trace.traced(config, "work", _work)(
+                    os.path.join(self.tmp_dir, "s1.sam"), seconds)
+                self.assertIsNone(trace.finish_run(config))
+            trace.Traced(pipeline, trace.JOB_STAGE, trace_file,
+                         label=name)(config, seconds)
+        records = trace.read_records(trace_file)
+        self.assertEqual(len(records), 6)
+        self.assertEqual([x["item"] for x in trace.job_path(records, jobs)],
+                         ["map_a", "count"])
+        trace.finish_run(self.config, jobs)
+        prefix = os.path.splitext(trace_file)[0]
+        with open(prefix + ".summary.txt") as in_handle:
+            lines = in_handle.readlines()
+        self.assertTrue(lines[-1].startswith("job path"))
+        # the jobs are not summed up with the stages they ran
+        self.assertEqual([x.split()[0] for x in lines[1:-2]], ["work"])
+
+
+if __name__ == "__main__":
+    unittest.main()
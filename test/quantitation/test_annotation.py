@@ -0,0 +1,108 @@
+import unittest
+import tempfile
+import shutil
+import os
+from az.annotation import (GeneIndex, is_refflat, load_index, index_dir,
+                           read_transcripts, compile_transcripts,
+                           load_transcripts)
+from az import manifest
+
+GTF = """\
+1\ttest\texon\t101\t200\t.\t+\t.\tgene_id "A"; transcript_id "A.1";
+1\ttest\texon\t301\t400\t.\t+\t.\tgene_id "A"; transcript_id "A.1";
+1\ttest\texon\t351\t450\t.\t-\t.\tgene_id "B"; transcript_id "B.1";
+1\ttest\texon\t40001\t40100\t.\t.\t.\tgene_id "D"; transcript_id "D.1";
+2\ttest\texon\t1001\t1100\t.\t-\t.\tgene_id "C"; transcript_id "C.1";
+"""
+
+REFFLAT = """\
+A\tA.1\t1\t+\t100\t400\t100\t400\t2\t100,300,\t200,400,
+B\tB.1\t1\t-\t350\t450\t350\t450\t1\t350,\t450,
+D\tD.1\t1\t.\t40000\t40100\t40000\t40100\t1\t40000,\t40100,
+C\tC.1\t2\t-\t1000\t1100\t1000\t1100\t1\t1000,\t1100,
+"""
+
+QUERIES = [("1", 190, 210, None), ("1", 360, 370, None),
+           ("1", 360, 370, "-"), ("1", 40050, 40060, "+"),
+           ("2", 1050, 1060, "+"), ("3", 0, 100, None),
+           ("1", 16000, 50000, None)]
+
+
+class TestAnnotation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gtf = os.path.join(self.tmp_dir, "genes.gtf")
+        self.refflat = os.path.join(self.tmp_dir, "refFlat.txt")
+        with open(self.gtf, "w") as out_handle:
+            out_handle.write(GTF)
+        with open(self.refflat, "w") as out_handle:
+            out_handle.write(REFFLAT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _lookup(self, index):
+        return [sorted(index.genes[x] for x in index.overlapping(*query))
+                for query in QUERIES]
+
+    def test_overlapping(self):
+        self.assertEqual(self._lookup(GeneIndex.from_gtf(self.gtf)),
+                         [["A"], ["A", "B"], ["B"], ["D"], [], [], ["D"]])
+
+    def test_refflat(self):
+        self.assertTrue(is_refflat(self.refflat))
+        self.assertFalse(is_refflat(self.gtf))
+        self.assertEqual(self._lookup(GeneIndex.from_gtf(self.refflat)),
+                         self._lookup(GeneIndex.from_gtf(self.gtf)))
+
+    def test_compiled(self):
+        """
+        the compiled index gives the same answers and is reused
+        """
+        ref_dir = os.path.join(self.tmp_dir, "ref")
+        index = load_index(self.gtf, ref_dir)
+        self.assertEqual(self._lookup(index),
+                         self._lookup(GeneIndex.from_gtf(self.gtf)))
+        compiled = index_dir(self.gtf, ref_dir)
+        self.assertTrue(os.path.exists(compiled))
+        self.assertEqual(os.listdir(os.path.dirname(compiled)),
+                         [os.path.basename(compiled)])
+        load_index(self.gtf, ref_dir)
+        self.assertEqual(len(os.listdir(os.path.dirname(compiled))), 1)
+
+    def test_compiled_transcripts(self):
+        """
+        the compiled transcripts load back as read_transcripts gives them,
+        for GTF and refFlat files
+        """
+        ref_dir = os.path.join(self.tmp_dir, "ref")
+        for annotation in (self.gtf, self.refflat):
+            compiled = compile_transcripts(annotation, ref_dir)
+            self.assertEqual(load_transcripts(compiled),
+                             read_transcripts(annotation))
+            self.assertEqual(compile_transcripts(annotation, ref_dir),
+                             compiled)
+
+    def test_same_size_edit(self):
+        """
+        an edit in the middle of a large annotation that keeps its size and
+        escapes the fingerprint still gets a new index
+        """
+        ref_dir = os.path.join(self.tmp_dir, "ref")
+        big = os.path.join(self.tmp_dir, "big.gtf")
+        with open(self.gtf) as in_handle, open(big, "w") as out_handle:
+            out_handle.write(in_handle.read())
+            out_handle.write("#" + "x" * (3 * manifest.SAMPLE_BYTES) + "\n")
+        before = (index_dir(big, ref_dir), manifest.fingerprint(big))
+        with open(big, "r+") as out_handle:
+            out_handle.seek(os.path.getsize(big) // 2)
+            out_handle.write("y")
+        stat = os.stat(big)
+        os.utime(big, (stat.st_atime, stat.st_mtime + 1))
+        self.assertEqual(manifest.fingerprint(big), before[1])
+        self.assertNotEqual(index_dir(big, ref_dir), before[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
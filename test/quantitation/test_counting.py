@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import os
+from az.annotation import GeneIndex
+from az.counting import GeneCounter, aligned_blocks
+
+GTF = """\
+1\ttest\texon\t101\t200\t.\t+\t.\tgene_id "A"; transcript_id "A.1";
+1\ttest\texon\t301\t400\t.\t+\t.\tgene_id "A"; transcript_id "A.1";
+1\ttest\texon\t351\t450\t.\t-\t.\tgene_id "B"; transcript_id "B.1";
+2\ttest\texon\t1001\t1100\t.\t-\t.\tgene_id "C"; transcript_id "C.1";
+"""
+
+
+def _sam(name, flag, chrom, pos, cigar, mate_chrom="*", mate_pos=0,
+         mapq=255, nh=1):
+    return "\t".join([name, str(flag), chrom, str(pos), str(mapq), cigar,
+                      mate_chrom, str(mate_pos), "0", "*", "*",
+                      "NH:i:%d" % nh]) + "\n"
+
+
+class TestCounting(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.gtf = tempfile.mkstemp(suffix=".gtf")
+        with os.fdopen(handle, "w") as out_handle:
+            out_handle.write(GTF)
+        self.index = GeneIndex.from_gtf(self.gtf)
+
+    def tearDown(self):
+        os.remove(self.gtf)
+
+    def _count(self, lines, stranded="no"):
+        counter = GeneCounter(self.index, stranded=stranded)
+        counter.count(lines)
+        counts = dict(zip(self.index.genes, counter.counts))
+        counts.update(counter.special)
+        return counts
+
+    def test_aligned_blocks(self):
+        self.assertEqual(list(aligned_blocks(101, "10M100N5M2I5M3D4M")),
+                         [(100, 110), (210, 215), (215, 220), (223, 227)])
+
+    def test_overlapping(self):
+        self.assertEqual(self.index.overlapping("1", 190, 210), set([0]))
+        self.assertEqual(self.index.overlapping("1", 360, 370), set([0, 1]))
+        self.assertEqual(self.index.overlapping("1", 360, 370, "-"),
+                         set([1]))
+        self.assertEqual(self.index.overlapping("3", 0, 100), set())
+
+    def test_union(self):
+        lines = ["@HD\tVN:1.0\tSO:coordinate\n",
+                 _sam("r1", 0, "1", 150, "20M"),
+                 _sam("r2", 0, "1", 360, "20M"),
+                 _sam("r3", 0, "1", 600, "20M"),
+                 _sam("r4", 0, "1", 150, "20M", nh=2),
+                 _sam("r5", 0, "1", 150, "20M", mapq=3),
+                 _sam("r6", 4, "*", 0, "*"),
+                 _sam("r7", 16, "2", 1010, "20M")]
+        counts = self._count(lines)
+        self.assertEqual(counts["A"], 1)
+        self.assertEqual(counts["C"], 1)
+        self.assertEqual(counts["__ambiguous"], 1)
+        self.assertEqual(counts["__no_feature"], 1)
+        self.assertEqual(counts["__alignment_not_unique"], 1)
+        self.assertEqual(counts["__too_low_aQual"], 1)
+        self.assertEqual(counts["__not_aligned"], 1)
+
+    def test_stranded(self):
+        lines = [_sam("r1", 0, "1", 360, "20M"),
+                 _sam("r2", 16, "2", 1010, "20M")]
+        self.assertEqual(self._count(lines, "yes")["A"], 1)
+        self.assertEqual(self._count(lines, "yes")["C"], 1)
+        self.assertEqual(self._count(lines, "reverse")["B"], 1)
+        self.assertEqual(self._count(lines, "reverse")["__no_feature"], 1)
+
+    def test_pairs(self):
+        """
+        the mates of a pair are counted once, together, even when they
+        are far apart in the file
+        """
+        lines = [_sam("p1", 99, "1", 150, "20M", "=", 310),
+                 _sam("p2", 99, "1", 160, "20M", "=", 380),
+                 _sam("p1", 147, "1", 310, "20M", "=", 150),
+                 _sam("p2", 147, "1", 380, "20M", "=", 160),
+                 _sam("p3", 73, "1", 170, "20M", "=", 170),
+                 _sam("p3", 133, "1", 170, "*", "=", 170),
+                 _sam("p4", 77, "*", 0, "*"),
+                 _sam("p4", 141, "*", 0, "*")]
+        counts = self._count(lines)
+        self.assertEqual(counts["A"], 2)
+        self.assertEqual(counts["__ambiguous"], 1)
+        self.assertEqual(counts["__not_aligned"], 1)
+
+    def test_secondary(self):
+        lines = [_sam("r1", 0, "1", 150, "20M", nh=2),
+                 _sam("r1", 256, "2", 1010, "20M", nh=2)]
+        self.assertEqual(self._count(lines)["__alignment_not_unique"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
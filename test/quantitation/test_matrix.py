@@ -0,0 +1,103 @@
+import unittest
+import shutil
+import tempfile
+import os
+import numpy as np
+from az import matrix
+from az.matrix import CountMatrix
+
+GENES = ["A", "B", "C", "__no_feature"]
+
+
+def _write_counts(out_file, counts):
+    with open(out_file, "w") as out_handle:
+        for gene, count in zip(GENES, counts):
+            out_handle.write("%s\t%d\n" % (gene, count))
+    return out_file
+
+
+class TestMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.matrix_dir = os.path.join(self.tmp_dir, "combined.matrix")
+        self.count_files = [
+            _write_counts(os.path.join(self.tmp_dir, "s%d.counts" % i),
+                          [i, 10 * i, 0, 100 + i]) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        """
+        test that samples are appended one at a time and only read again
+        when their counts change
+        """
+        counts = CountMatrix(self.matrix_dir)
+        self.assertEqual(counts.update(self.count_files[:2]), 2)
+        counts = CountMatrix(self.matrix_dir)
+        self.assertEqual(counts.update(self.count_files), 1)
+        self.assertEqual(counts.samples, ["s0", "s1", "s2"])
+        self.assertEqual(counts.genes, GENES)
+        self.assertEqual(counts.counts[:, 2].tolist(), [2, 20, 0, 102])
+        _write_counts(self.count_files[1], [7, 7, 7, 7])
+        counts = CountMatrix(self.matrix_dir)
+        self.assertEqual(counts.update(self.count_files), 1)
+        self.assertEqual(counts.select(["s2", "s1"]).tolist(),
+                         [[2, 7], [20, 7], [0, 7], [102, 7]])
+        self.assertRaises(KeyError, counts.select, ["s9"])
+
+    def test_unlisted_row_dropped(self):
+        """
+        test that a row appended by a run that died before listing its
+        sample is dropped
+        """
+        counts = CountMatrix(self.matrix_dir)
+        counts.update(self.count_files[:1])
+        with open(os.path.join(self.matrix_dir, "counts"), "ab") as handle:
+            handle.write(np.ones(len(GENES), dtype=matrix.DTYPE).tostring())
+        counts = CountMatrix(self.matrix_dir)
+        counts.update(self.count_files[1:2])
+        self.assertEqual(counts.counts.T.tolist(), [[0, 0, 0, 100],
+                                                    [1, 10, 0, 101]])
+
+    def test_combine_counts(self):
+        """
+        test that the combined table has every sample and that counts of
+        other genes start the matrix over
+        """
+        out_file = matrix.combine_counts(self.count_files)
+        self.assertEqual(out_file, os.path.join(self.tmp_dir,
+                                                "combined.counts"))
+        with open(out_file) as in_handle:
+            rows = [x.rstrip("\n").split("\t") for x in in_handle]
+        self.assertEqual(rows[0], ["id", "s0", "s1", "s2"])
+        self.assertEqual(rows[4], ["__no_feature", "100", "101", "102"])
+        with open(self.count_files[0], "a") as out_handle:
+            out_handle.write("D\t5\n")
+        matrix.combine_counts(self.count_files[:1])
+        self.assertEqual(CountMatrix(self.matrix_dir).genes, GENES + ["D"])
+
+    def test_dropped_samples(self):
+        """
+        test that samples without a count file any more leave the combined
+        table and the matrix, and the rest keep their counts
+        """
+        out_file = matrix.combine_counts(self.count_files)
+        renamed = os.path.join(self.tmp_dir, "s3.counts")
+        os.rename(self.count_files[0], renamed)
+        matrix.combine_counts([self.count_files[2], renamed])
+        with open(out_file) as in_handle:
+            rows = [x.rstrip("\n").split("\t") for x in in_handle]
+        self.assertEqual(rows[0], ["id", "s2", "s3"])
+        self.assertEqual(rows[4], ["__no_feature", "102", "100"])
+        counts = CountMatrix(self.matrix_dir)
+        self.assertEqual(counts.samples, ["s2", "s3"])
+        self.assertEqual(counts.counts.T.tolist(), [[2, 20, 0, 102],
+                                                    [0, 0, 0, 100]])
+        self.assertFalse([x for x in os.listdir(self.tmp_dir)
+                          if ".tmp." in x])
+
+
+if __name__ == "__main__":
+    unittest.main()
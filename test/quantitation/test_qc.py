@@ -0,0 +1,133 @@
+import unittest
+import os
+import shutil
+import tempfile
+from az.counting import Alignment
+from az import qc
+
+TRANSCRIPTS = [("1", "+", "A", [(100, 200), (300, 400)]),
+               ("1", "+", "A", [(100, 200), (350, 450)]),
+               ("1", "-", "B", [(1000, 1200)])]
+
+
+def _alignment(name, flag, pos, cigar, mapq=255, chrom="1", mate_pos=0):
+    length = sum(int(n) for n, op in qc.CIGAR_RE.findall(cigar)
+                 if op in "MIS=X")
+    return Alignment("\t".join([name, str(flag), chrom, str(pos), str(mapq),
+                                cigar, "=" if mate_pos else "*",
+                                str(mate_pos), "0", "A" * length,
+                                "I" * length]))
+
+
+def _fake_rseqc(in_file, config):
+    # appends to log.txt in the current directory like the RSeQC programs
+    with open(qc.RSEQC_LOG, "a") as out_handle:
+        out_handle.write("Processing %s ...\n" % (os.path.basename(in_file)))
+    out_file = os.path.join(config["dir"]["results"], "rseqc", "out.txt")
+    with open(in_file) as in_handle, open(out_file, "w") as out_handle:
+        out_handle.write(in_handle.read())
+    return out_file
+
+
+class TestQC(unittest.TestCase):
+
+    def test_introns(self):
+        self.assertEqual(list(qc.introns(181, "20M100N10M")),
+                         [(200, 300)])
+        self.assertEqual(list(qc.introns(1, "10M5D10M")), [])
+
+    def test_bam_stat(self):
+        stat = qc.BamStat()
+        for alignment in [_alignment("r1", 99, 150, "20M", mate_pos=190),
+                          _alignment("r1", 147, 190, "10M100N10M",
+                                     mate_pos=150),
+                          _alignment("r2", 0, 150, "20M", mapq=3),
+                          _alignment("r3", 256, 150, "20M"),
+                          _alignment("r4", 4, 0, "*"),
+                          _alignment("r5", 1024, 150, "20M")]:
+            stat.add(alignment)
+        counts = stat.counts
+        self.assertEqual(counts["total"], 6)
+        self.assertEqual(counts["unique"], 2)
+        self.assertEqual(counts["splice"], 1)
+        self.assertEqual(counts["proper_pair"], 2)
+        self.assertEqual(counts["multiple"], 1)
+        self.assertEqual(counts["non_primary"], 1)
+        self.assertEqual(counts["unmapped"], 1)
+        self.assertEqual(counts["duplicate"], 1)
+
+    def test_percentiles(self):
+        positions = qc._percentile_positions([(0, 101)])
+        self.assertEqual(positions.tolist(), range(1, 101))
+        self.assertEqual(qc._percentile_positions([(0, 99)]).tolist(), [])
+        # interpolated between two exons, halves rounded to even
+        self.assertEqual(qc._percentile_positions([(0, 50), (1000, 1051)])
+                         .tolist()[47:51], [48, 49, 1000, 1001])
+
+    def test_gene_body_coverage(self):
+        coverage = qc.GeneBodyCoverage(TRANSCRIPTS)
+        coverage.add(_alignment("r1", 0, 1001, "100M"))
+        totals = coverage.coverage()
+        # the minus strand gene's first half is the 3' end
+        self.assertEqual(list(totals[50:]), [1] * 50)
+        self.assertEqual(sum(totals[:50]), 0)
+
+    def test_overlapping_mates(self):
+        coverage = qc.GeneBodyCoverage(TRANSCRIPTS)
+        coverage.add(_alignment("r1", 99, 1001, "100M", mate_pos=1051))
+        coverage.add(_alignment("r1", 147, 1051, "100M", mate_pos=1001))
+        self.assertEqual(max(coverage.coverage()), 1)
+
+    def test_junctions(self):
+        junctions = qc.JunctionAnnotation(TRANSCRIPTS)
+        for alignment in [_alignment("r1", 0, 181, "20M100N10M"),
+                          _alignment("r2", 0, 181, "20M150N10M"),
+                          _alignment("r3", 0, 171, "30M130N10M"),
+                          _alignment("r4", 0, 181, "20M10N10M")]:
+            junctions.add(alignment)
+        annotations = dict((x, junctions.annotate(*x))
+                           for x in junctions.junctions)
+        self.assertEqual(annotations, {("1", 200, 300): "annotated",
+                                       ("1", 200, 350): "annotated",
+                                       ("1", 200, 330): "partial_novel"})
+        self.assertEqual(junctions.filtered, 1)
+
+    def test_rpkm(self):
+        rpkm = qc.RPKMCount(TRANSCRIPTS)
+        for alignment in [_alignment("r1", 0, 101, "20M"),
+                          _alignment("r2", 0, 181, "20M100N20M"),
+                          _alignment("r3", 0, 601, "20M"),
+                          _alignment("r4", 0, 1101, "20M", mapq=0)]:
+            rpkm.add(alignment)
+        rpkm._flush()
+        counts = dict(zip([x[2] for x in rpkm.genes], rpkm.counts))
+        self.assertEqual(counts, {"A": 3, "B": 0})
+        self.assertEqual(rpkm.total, 3)
+
+    def test_rseqc_log(self):
+        """
+        test that the log RSeQC writes to the current directory ends up in
+        the log directory and the relative paths still work
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        self.addCleanup(os.chdir, cwd)
+        os.makedirs(os.path.join("results", "rseqc"))
+        with open("h.bam", "w") as out_handle:
+            out_handle.write("reads")
+        keeper = qc.KeepRseqcLog(_fake_rseqc, "log")
+        self.assertEqual(keeper.__name__, "_fake_rseqc")
+        for _ in range(2):
+            out_file = keeper("h.bam", {"dir": {"results": "results"}})
+        self.assertFalse(os.path.exists(qc.RSEQC_LOG))
+        with open(out_file) as in_handle:
+            self.assertEqual(in_handle.read(), "reads")
+        self.assertEqual(os.listdir("log"), ["rseqc.log"])
+        with open(os.path.join("log", "rseqc.log")) as in_handle:
+            self.assertEqual(in_handle.read(), "Processing h.bam ...\n" * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from az import rrna
+
+INTERVALS = """@HD\tVN:1.0\tSO:coordinate
+@SQ\tSN:1\tLN:10000
+@SQ\tSN:MT\tLN:16569
+1\t101\t200\t+\trRNA_a
+1\t151\t300\t+\trRNA_b
+1\t1001\t1100\t-\trRNA_c
+"""
+
+
+def _line(name, flag, chrom, pos, cigar):
+    return "\t".join([name, str(flag), chrom, str(pos), "255", cigar, "*",
+                      "0", "0", "A", "I"]) + "\n"
+
+
+class TestRRNA(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.interval_file = tempfile.mkstemp(suffix=".bed")
+        with os.fdopen(handle, "w") as out_handle:
+            out_handle.write(INTERVALS)
+
+    def tearDown(self):
+        os.remove(self.interval_file)
+
+    def test_read_interval_list(self):
+        chroms, intervals = rrna.read_interval_list(self.interval_file)
+        self.assertEqual(chroms, ["1", "MT"])
+        starts, ends = intervals["1"]
+        self.assertEqual(starts.tolist(), [100, 1000])
+        self.assertEqual(ends.tolist(), [300, 1100])
+
+    def test_overlaps(self):
+        found = rrna.overlaps(np.array([100, 1000]), np.array([300, 1100]),
+                              np.array([50, 50, 300, 1099, 2000]),
+                              np.array([100, 101, 400, 1150, 2010]))
+        self.assertEqual(found.tolist(), [False, True, False, True, False])
+
+    def test_fractions(self):
+        lines = ["@SQ\tSN:1\tLN:10000\n",
+                 _line("r1", 0, "1", 90, "20M"),
+                 _line("r2", 0, "1", 50, "10M1000N10M"),
+                 _line("r3", 0, "1", 400, "20M"),
+                 _line("r4", 0, "MT", 10, "20M"),
+                 _line("r5", 0, "2", 10, "20M"),
+                 _line("r6", 4, "*", 0, "*"),
+                 _line("r1", 256, "1", 150, "20M")]
+        counter = rrna.FractionCounter(
+            *rrna.read_interval_list(self.interval_file), batch_size=2)
+        summary = dict(counter.count(lines).summary())
+        self.assertEqual(summary["total_reads"], 6)
+        self.assertEqual(summary["mapped_reads"], 5)
+        self.assertEqual(summary["rrna_reads"], 2)
+        self.assertEqual(summary["mitochondrial_reads"], 1)
+        self.assertAlmostEqual(summary["rrna_fraction"], 0.4)
+        self.assertEqual(counter.chroms, ["1", "MT", "2"])
+        self.assertEqual(counter.chrom_counts.tolist(), [3, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()